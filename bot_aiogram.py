@@ -1,5 +1,10 @@
 import math
+import time
+import asyncio
 import logging
+from collections import OrderedDict
+from functools import lru_cache
+from datetime import datetime
 from typing import (
     List,
     Tuple,
@@ -7,6 +12,8 @@ from typing import (
     Optional,
     Dict,
     Union,
+    Callable,
+    TYPE_CHECKING,
 )
 
 from aiogram import Bot, Dispatcher, executor, types, filters
@@ -16,16 +23,46 @@ from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ContentTyp
 from data import (
     get_route,
     get_stop,
+    get_stop_coordinates,
     get_forecast_by_stop,
     get_routes_by_stop,
     get_nearest_stops,
     get_stops_by_route,
-    get_stops_in_group,
+    get_stops_in_bbox,
+    get_route_shape,
+    get_route_stats,
+    get_feed_version,
+    get_stop_group,
+    get_stop_group_by_stop,
+    get_stop_neighbours,
     search_stop_groups_by_name,
+    search_stop_groups_by_prefix,
     get_random_stop_id,
+    plan_journey,
+    default_feed,
+    ensure_loaded,
+)
+from favourites import FavouritesStore, MAX_FAVOURITES
+from middlewares import (
+    AdmissionControl,
+    CallbackDedupMiddleware,
+    ReadinessMiddleware,
+    edit_if_changed,
+)
+from forecasts import (
+    MSK,
+    Arrival,
+    ForecastCache,
+    ForecastUnavailable,
+    PopularityTracker,
+    Prewarmer,
 )
 from bot_conf import BOT_TOKEN
 
+if TYPE_CHECKING:
+    from planner import Journey
+    from route_map import RouteMapCache
+
 logging.basicConfig(level=logging.INFO)
 
 logger = logging.getLogger(__name__)
@@ -33,6 +70,15 @@ logger.setLevel(logging.INFO)
 
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher(bot)
+callback_dedup = CallbackDedupMiddleware()
+dp.middleware.setup(callback_dedup)
+# the default feed is loaded in background (see on_startup)
+readiness = ReadinessMiddleware(
+    lambda: default_feed().loaded, commands=["start", "help"]
+)
+dp.middleware.setup(readiness)
+admission = AdmissionControl()
+dp.middleware.setup(admission)
 
 
 TRANSPORT_TYPE_EMOJI = {"bus": "🚌", "trolley": "🚎", "tram": "🚊", "ship": "🚢"}
@@ -59,6 +105,10 @@ async def start_message(message: types.Message):
 
 🚌 можно посмотреть маршрут транспорта, который подходит к остановке
 
+🧭 можно узнать, как добраться от одной остановки до другой: 👉 /trip
+
+⭐ нажмите ⭐ на остановке, чтобы добавить её в избранное: 👉 /favourites
+
 🎲 можно посмотреть случайную остановку: 👉 /random\\_stop
 
 _Данные о транспорте получены благодаря:_
@@ -86,6 +136,16 @@ _Данные о транспорте получены благодаря:_
                 )
             ],
             [InlineKeyboardButton("🎲Случайная остановка", callback_data="random_stop")],
+            [
+                InlineKeyboardButton(
+                    "⭐ Избранное", callback_data="FavouritesMsgBlock show"
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    "🔎 Поиск остановок", switch_inline_query_current_chat=""
+                )
+            ],
         ]
     )
     await message.answer(text, reply_markup=kbd, parse_mode="markdown")
@@ -112,7 +172,8 @@ def make_keyboard(
 
 
 def make_paginator(
-    items: List[Tuple[str, str]],
+    count: int,
+    get_item: Callable[[int], Tuple[str, str]],
     previous_page_cmd: str,
     next_page_cmd: str,
     title: Optional[str] = None,
@@ -121,12 +182,14 @@ def make_paginator(
     always_show_buttons=False,
 ) -> Tuple[str, InlineKeyboardMarkup]:
     """
-    :param items: Truple of option name and callback_data
+    :param count: total number of items
+    :param get_item: returns option name and callback_data by item index,
+        it is called only for the items of the current page
     :param always_show_buttons: show arrow buttons even if all items is in one page
     """
-    assert len(items) > 0
-    max_page_num = math.ceil(len(items) / page_size) - 1
-    # num of pages must be >= len(items) / page_size
+    assert count > 0
+    max_page_num = math.ceil(count / page_size) - 1
+    # num of pages must be >= count / page_size
     # numeration starts from 0
     assert 0 <= cur_page
     assert cur_page <= max_page_num
@@ -134,13 +197,14 @@ def make_paginator(
     if title:
         msg += title + "\n"
     s = cur_page * page_size
-    e = min(len(items), (cur_page + 1) * page_size)
-    for i in range(s, e):
-        msg += f"*{i+1}.* {items[i][0]} \n"
-    msg += f"_{s+1} - {e} из {len(items)}_\n"
+    e = min(count, (cur_page + 1) * page_size)
+    items = [get_item(i) for i in range(s, e)]
+    for i, it in enumerate(items, start=s):
+        msg += f"*{i+1}.* {it[0]} \n"
+    msg += f"_{s+1} - {e} из {count}_\n"
 
     kbd = make_keyboard(
-        [(str(i + 1), items[i][1]) for i in range(s, e)]
+        [(str(i + 1), it[1]) for i, it in enumerate(items, start=s)]
     ).inline_keyboard
     ctrls = []
     if cur_page == 0:
@@ -161,46 +225,60 @@ def make_paginator(
     return msg, InlineKeyboardMarkup(inline_keyboard=kbd)
 
 
-def forecast_json_to_text(forecast_json, stop_id):
+def forecast_to_text(arrivals: List[Arrival], stale_age: Optional[float] = None) -> str:
     """
     Converts result of get_forecast_by_stop into human-readable form.
+    Arrivals that have already passed are skipped.
+
+    :param stale_age: seconds since the forecast was received,
+        if it is not fresh
     """
     # TRANSLATION = {'bus': 'автобус', 'trolley': 'троллейбус',
     #                'tram': 'трамвай', 'ship': 'аквабус'}
-    assert forecast_json["success"]
     msg = ""
-    routes = set()
-    for p in forecast_json["result"]:
-        route_id = int(p["routeId"])
-        route = get_route(route_id)
+    now = datetime.now(MSK)
+    for a in arrivals:
+        if a.time < now:
+            continue
+        route = get_route(a.route_id)
         msg += (
             "_"
-            + p["arrivingTime"].split()[1][:-3]
-            + "_................."
+            + a.time.strftime("%H:%M")
+            + f"_ ({a.minutes_until(now)} мин)..........."
             + TRANSPORT_TYPE_EMOJI[route.transport_type]
             + "*"
             + route.route_short_name.ljust(3)
             + "*\n"
         )
-        routes.add(route_id)
+    if len(msg) == 0:
+        msg += "_не найдено ни одного автобуса, "
+        msg += "посмотрите другие остановки._\n"
+    if stale_age is not None:
+        msg += f"_⚠️ данные получены {math.ceil(stale_age / 60)} мин. назад_\n"
     return msg
 
 
+popularity = PopularityTracker()
+forecast_cache = ForecastCache(get_forecast_by_stop, popularity=popularity)
+prewarmer = Prewarmer(forecast_cache, popularity)
+
+
 def stop_info(stop_id):
     """
     :result: human-readable arrival time forecast for the stop
     in markdown format
-    and forecast_json (так надо)
+    and list of arrivals
     """
-    forecast_json = get_forecast_by_stop(stop_id)
     stop = get_stop(stop_id)
     msg = "*" + stop.stop_name
     msg += "*\n"
-    msg += forecast_json_to_text(forecast_json, stop_id)
-    if len(forecast_json_to_text(forecast_json, stop_id)) == 0:
-        msg += "_не найдено ни одного автобуса, "
-        msg += "посмотрите другие остановки._\n"
-    return msg, forecast_json
+    try:
+        forecast = forecast_cache.get(stop_id)
+    except ForecastUnavailable:
+        msg += "_прогноз временно недоступен, попробуйте позже._\n"
+        return msg, []
+    msg += forecast_to_text(forecast.data, forecast.age if forecast.stale else None)
+    return msg, forecast.data
 
 
 def stop_info_message(stop_id) -> Dict[str, Any]:
@@ -211,8 +289,8 @@ def stop_info_message(stop_id) -> Dict[str, Any]:
 
     :return: kwargs to bot.send_message() or types.Message().answer(), etc"""
     logger.info("form stop info message")
-    message, forecast_json = stop_info(stop_id)
-    rl = [int(p["routeId"]) for p in forecast_json["result"]]
+    message, arrivals = stop_info(stop_id)
+    rl = [a.route_id for a in arrivals]
     routes = get_routes_by_stop(stop_id)
     if not set(rl).issubset([i[0] for i in routes]):
         logger.exception("Fantom bus!")
@@ -235,31 +313,49 @@ def stop_info_message(stop_id) -> Dict[str, Any]:
                 "Обновить", callback_data=f"BusStopMsgBlock refresh {stop_id}"
             ),
             InlineKeyboardButton(
-                "Похожие", callback_data=f"SearchStopsMsgBlock stop_group {stop_id}"
+                "Похожие",
+                callback_data=f"SearchStopsMsgBlock near {stop_id}",
+            ),
+            InlineKeyboardButton("🧭", callback_data=f"TripMsgBlock point s{stop_id}"),
+            InlineKeyboardButton(
+                "⭐", callback_data=f"FavouritesMsgBlock toggle {stop_id}"
             ),
         ]
     )
     return {"text": message, "reply_markup": kbd, "parse_mode": "markdown"}
 
 
+async def stop_message(stop_id: int) -> Dict[str, Any]:
+    """
+    stop_info_message() that doesn't block the event loop:
+    if the forecast is not cached, it is requested in a thread.
+    """
+    if forecast_cache.is_cached(stop_id):
+        return stop_info_message(stop_id)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, stop_info_message, stop_id)
+
+
 @dp.callback_query_handler(lambda x: x.data.startswith("BusStopMsgBlock"))
 async def bus_stop_cb_handler(callback: types.CallbackQuery):
     params = callback.data.split()
     assert params[0] == "BusStopMsgBlock"
     if params[1] == "refresh":
-        assert callback.message is not None
-        msg = "Обновление..."
-        await callback.message.edit_text(msg)
-        params[1] = "appear_here"
-    if params[1] in ("appear_here", "newmsg"):
+        # the message is not edited to a placeholder, so a refresh
+        # that brings nothing new doesn't edit it at all
+        await callback.answer("Обновление...")
+    if params[1] in ("appear_here", "newmsg", "refresh"):
         logger.info("callback: BusStop message")
         assert get_stop(int(params[2])) is not None
         assert callback.message is not None
-        if params[1] == "appear_here":
-            await callback.message.edit_text(**stop_info_message(int(params[2])))
+        if params[1] == "newmsg":
+            await callback.message.reply(**await stop_message(int(params[2])))
         else:
-            await callback.message.reply(**stop_info_message(int(params[2])))
-        await callback.answer()
+            await edit_if_changed(
+                callback.message, **await stop_message(int(params[2]))
+            )
+        if params[1] != "refresh":
+            await callback.answer()
 
 
 @dp.message_handler(filters.RegexpCommandsFilter(regexp_commands=["stop_([0-9]+)"]))
@@ -267,7 +363,7 @@ async def stop_command_handler(message: types.Message):
     """Handles commands like /stop_12345, where 12345 is stop_id."""
     assert message.text.startswith("/stop_")
     stop_id = int(message.text.replace("/stop_", ""))
-    await message.reply(**stop_info_message(stop_id))
+    await message.reply(**await stop_message(stop_id))
 
 
 @dp.message_handler(commands=["nevskii"])
@@ -276,7 +372,7 @@ async def nevskii_command_handler(message: types.Message):
     Forecast for stop "metro Nevskii prospect"
     """
     logger.info("/nevskii command handler")
-    await message.reply(**stop_info_message(15495))
+    await message.reply(**await stop_message(15495))
 
 
 @dp.message_handler(commands=["random_stop"])
@@ -286,7 +382,7 @@ async def random_stop_command_handler(x: Union[types.Message, types.CallbackQuer
     Forecast for random stop
     """
     logger.info("/nevskii command handler")
-    m = stop_info_message(get_random_stop_id())
+    m = await stop_message(get_random_stop_id())
     m["reply_markup"].inline_keyboard[-1].append(
         types.InlineKeyboardButton("🎲Случайная", callback_data="random_stop")
     )
@@ -308,16 +404,25 @@ def nearest_stops_message(latitude: float, longitude: float, n=10) -> Dict[str,
     logger.info(f"form nearest_stops message")
     stops = get_nearest_stops(latitude, longitude, n=n)
     title = "*Ближайшие остановки:*"
-    items = []  # type: List[Tuple[str, str]]
-    for i in stops:
-        items.append(
-            (
-                TRANSPORT_TYPE_EMOJI[get_stop(i).transport_type]
-                + get_stop(i).stop_name,
-                f"BusStopMsgBlock newmsg {i}",
-            )
+
+    def item(i: int) -> Tuple[str, str]:
+        stop = get_stop(stops[i])
+        return (
+            TRANSPORT_TYPE_EMOJI[stop.transport_type] + stop.stop_name,
+            f"BusStopMsgBlock newmsg {stops[i]}",
         )
-    msg, kbd = make_paginator(items, "", "", title=title, always_show_buttons=False)
+
+    msg, kbd = make_paginator(
+        len(stops), item, "", "", title=title, always_show_buttons=False
+    )
+    kbd.inline_keyboard.append(
+        [
+            InlineKeyboardButton(
+                "🧭 Маршрут отсюда",
+                callback_data=f"TripMsgBlock point l{latitude:.6f},{longitude:.6f}",
+            )
+        ]
+    )
     return {"text": msg, "reply_markup": kbd, "parse_mode": "markdown"}
 
 
@@ -331,6 +436,10 @@ async def nearest_stops_test_message_handler(message: types.Message):
 async def nearest_stops_message_handler(message: types.Message):
     lat = message.location.latitude
     lon = message.location.longitude
+    origin = pop_trip_point(message.from_user.id)
+    if origin is not None:
+        await message.reply(**await plan_trip(origin, f"l{lat:.6f},{lon:.6f}"))
+        return
     await message.reply(**nearest_stops_message(lat, lon))
 
 
@@ -350,6 +459,28 @@ async def nearest_stops_callback_handler(callback: types.CallbackQuery):
         await callback.answer()
 
 
+HEADWAY_BAND_NAMES = ["утром", "днём", "вечером", "поздно"]
+
+
+def route_stats_to_text(route_id: int, direction: int) -> str:
+    """How often the route runs, from the precomputed schedule stats."""
+    stats = get_route_stats(route_id, direction)
+    if stats is None:
+        return ""
+    msg = (
+        f"_Рейсов в день: {stats.trips}, с {format_time(stats.first_departure)}"
+        f" до {format_time(stats.last_departure)}_\n"
+    )
+    headways = [
+        f"{name} {round(h / 60)} мин"
+        for name, h in zip(HEADWAY_BAND_NAMES, stats.headways)
+        if h is not None
+    ]
+    if headways:
+        msg += "_Интервал: " + ", ".join(headways) + "_\n"
+    return msg
+
+
 def route_message(
     route_id: int, direction: int, page_num: Optional[int] = None
 ) -> Dict[str, Any]:
@@ -363,13 +494,19 @@ def route_message(
     msg += "*\n"
     msg += "*" + get_route(route_id).route_long_name + "*\n"
     msg += ("_Обратное" if direction else "_Прямое") + " направление_\n"
+    msg += route_stats_to_text(route_id, direction)
     msg += "\n"
     stops = get_stops_by_route(route_id, direction)
-    options = []
-    for s in stops:
-        options.append((get_stop(s).stop_name, "BusStopMsgBlock appear_here " + str(s)))
+
+    def option(i: int) -> Tuple[str, str]:
+        return (
+            get_stop(stops[i]).stop_name,
+            "BusStopMsgBlock appear_here " + str(stops[i]),
+        )
+
     m, kbd = make_paginator(
-        options,
+        len(stops),
+        option,
         cur_page=page_num,
         previous_page_cmd="RouteMsgBlock appear_here "
         + f"{route_id} {direction} {page_num-1}",
@@ -386,6 +523,12 @@ def route_message(
             callback_data="RouteMsgBlock appear_here " + f"{route_id} {1-direction} 0",
         ),
     )
+    kbd.inline_keyboard[-1].insert(
+        -1,
+        InlineKeyboardButton(
+            "🗺", callback_data=f"RouteMsgBlock map {route_id} {direction}"
+        ),
+    )
     return {"text": msg, "reply_markup": kbd, "parse_mode": "markdown"}
 
 
@@ -401,14 +544,325 @@ async def route_callback_handler(callback: types.CallbackQuery):
         else:
             page_num = None
         if params[1] == "appear_here":
-            await callback.message.edit_text(**route_message(r, d, page_num))
+            await edit_if_changed(callback.message, **route_message(r, d, page_num))
         else:
             await callback.message.answer(**route_message(r, d, page_num))
         await callback.answer()
+    elif params[1] == "map":
+        await callback.answer()
+        await send_route_map(callback.message, int(params[2]), int(params[3]))
+
+
+@lru_cache(maxsize=None)
+def get_route_maps() -> "RouteMapCache":
+    from route_map import RouteMapCache
+
+    return RouteMapCache("route_maps", get_feed_version())
+
+
+def render_route(route_id: int, direction: int) -> bytes:
+    from route_map import render_route_map
+
+    points = get_stop_coordinates(get_stops_by_route(route_id, direction))
+    line = get_route_shape(route_id, direction) or points
+    lats = [p[0] for p in line]
+    lons = [p[1] for p in line]
+    context = get_stop_coordinates(
+        get_stops_in_bbox(min(lats), min(lons), max(lats), max(lons))
+    )
+    return render_route_map(line, points, context)
+
+
+async def send_route_map(message: types.Message, route_id: int, direction: int):
+    """Sends the map drawn once per feed version, then only its file_id."""
+    route = get_route(route_id)
+    assert route is not None
+    caption = (
+        TRANSPORT_TYPE_EMOJI[route.transport_type]
+        + route.route_short_name
+        + (" обратное" if direction else " прямое")
+        + " направление"
+    )
+    file_id = get_route_maps().get_file_id(route_id, direction)
+    if file_id is not None:
+        await message.answer_photo(file_id, caption=caption)
+        return
+    loop = asyncio.get_running_loop()
+    path = await loop.run_in_executor(
+        None,
+        get_route_maps().get_or_render,
+        route_id,
+        direction,
+        lambda: render_route(route_id, direction),
+    )
+    with open(path, "rb") as f:
+        m = await message.answer_photo(f, caption=caption)
+    get_route_maps().set_file_id(route_id, direction, m.photo[-1].file_id)
+
+
+# the first point of a trip waits that long for the second one, seconds
+TRIP_POINT_TTL = 300
+MAX_TRIP_POINTS = 10000
+
+# user_id -> (the first point of the trip being planned, time it was chosen)
+_trip_points: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+
+
+def set_trip_point(user_id: int, point: str):
+    _trip_points.pop(user_id, None)
+    _trip_points[user_id] = (point, time.monotonic())
+    while len(_trip_points) > MAX_TRIP_POINTS:
+        _trip_points.popitem(last=False)
+
+
+def get_trip_point(user_id: int) -> Optional[str]:
+    """:return: the first point chosen less than TRIP_POINT_TTL ago"""
+    entry = _trip_points.get(user_id)
+    if entry is None:
+        return None
+    if time.monotonic() - entry[1] > TRIP_POINT_TTL:
+        del _trip_points[user_id]
+        return None
+    return entry[0]
+
+
+def pop_trip_point(user_id: int) -> Optional[str]:
+    point = get_trip_point(user_id)
+    _trip_points.pop(user_id, None)
+    return point
+
+
+def parse_trip_point(point: str) -> Union[int, Tuple[float, float]]:
+    """
+    :param point: "s<stop_id>" or "l<lat>,<lon>"
+    :return: stop_id or (lat, lon)
+    """
+    if point.startswith("l"):
+        lat, lon = point[1:].split(",")
+        return (float(lat), float(lon))
+    assert point.startswith("s")
+    return int(point[1:])
+
+
+def trip_point_name(point: str) -> str:
+    p = parse_trip_point(point)
+    if isinstance(p, tuple):
+        return "📍местоположение"
+    return get_stop(p).stop_name
+
+
+def format_time(seconds: int) -> str:
+    return f"{seconds // 3600 % 24:02}:{seconds // 60 % 60:02}"
+
+
+def journey_to_text(journey: "Journey") -> str:
+    msg = f"*{format_time(journey.departure)} — {format_time(journey.arrival)}*"
+    msg += f", пересадок: {journey.transfers}\n"
+    for leg in journey.legs:
+        if leg.kind == "walk":
+            minutes = max(1, round((leg.arrival - leg.departure) / 60))
+            msg += f"🚶 {minutes} мин пешком"
+            if leg.to_stop is not None:
+                msg += " до " + get_stop(leg.to_stop).stop_name
+            msg += "\n"
+        else:
+            assert leg.from_stop is not None and leg.to_stop is not None
+            assert leg.route_id is not None
+            route = get_route(leg.route_id)
+            msg += TRANSPORT_TYPE_EMOJI[route.transport_type]
+            msg += "*" + route.route_short_name + "* "
+            msg += (
+                f"_{format_time(leg.departure)}_ " + get_stop(leg.from_stop).stop_name
+            )
+            msg += f" → _{format_time(leg.arrival)}_ " + get_stop(leg.to_stop).stop_name
+            msg += "\n"
+    return msg
 
 
-def search_stop_by_name_message(query: str) -> Dict[str, Any]:
-    stop_groups = search_stop_groups_by_name(query)
+def trip_message(origin: str, destination: str) -> Dict[str, Any]:
+    """Forms message with journeys from origin to destination.
+
+    :param origin: "s<stop_id>" or "l<lat>,<lon>"
+    :param destination: "s<stop_id>" or "l<lat>,<lon>"
+    :return: kwargs to bot.send_message() or types.Message().answer(), etc"""
+    logger.info("form trip message")
+    journeys = plan_journey(
+        parse_trip_point(origin),
+        parse_trip_point(destination),
+        datetime.now(MSK),
+    )
+    msg = f"*{trip_point_name(origin)}* → *{trip_point_name(destination)}*\n\n"
+    if len(journeys) == 0:
+        msg += "_Маршрут не найден, попробуйте выбрать другие остановки._\n"
+    for j in journeys:
+        msg += journey_to_text(j) + "\n"
+    kbd = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(
+                    "Обновить",
+                    callback_data=f"TripMsgBlock plan {origin} {destination}",
+                ),
+                InlineKeyboardButton(
+                    EMOJI["change_direction"],
+                    callback_data=f"TripMsgBlock plan {destination} {origin}",
+                ),
+                InlineKeyboardButton(EMOJI["close"], callback_data="common delete_me"),
+            ]
+        ]
+    )
+    return {"text": msg, "reply_markup": kbd, "parse_mode": "markdown"}
+
+
+async def plan_trip(origin: str, destination: str) -> Dict[str, Any]:
+    """trip_message() in a thread, planning may take a while."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, trip_message, origin, destination)
+
+
+@dp.message_handler(commands=["trip"])
+async def trip_command_handler(message: types.Message):
+    """Handles commands like /trip 15495 2080, where numbers are stop_id."""
+    args = message.get_args().split()
+    if len(args) == 2 and all(i.isdigit() for i in args):
+        await message.reply(**await plan_trip(f"s{args[0]}", f"s{args[1]}"))
+        return
+    await message.reply(
+        "Нажмите 🧭 на остановке или «Маршрут отсюда» у ближайших остановок,"
+        " а затем выберите, куда нужно попасть: другую остановку или"
+        " местоположение.\nИли напишите /trip _откуда_ _куда_ (номера остановок).",
+        parse_mode="markdown",
+    )
+
+
+@dp.callback_query_handler(lambda x: x.data.startswith("TripMsgBlock"))
+async def trip_callback_handler(callback: types.CallbackQuery):
+    params = callback.data.split()
+    assert params[0] == "TripMsgBlock"
+    if params[1] == "point":
+        user_id = callback.from_user.id
+        origin = get_trip_point(user_id)
+        if origin is None or origin == params[2]:
+            set_trip_point(user_id, params[2])
+            await callback.message.answer(
+                f"Откуда: *{trip_point_name(params[2])}*\n"
+                "Теперь выберите, куда: нажмите 🧭 на другой остановке"
+                " или отправьте местоположение.",
+                parse_mode="markdown",
+                reply_markup=InlineKeyboardMarkup(
+                    inline_keyboard=[
+                        [
+                            InlineKeyboardButton(
+                                "Отмена", callback_data="TripMsgBlock cancel"
+                            )
+                        ]
+                    ]
+                ),
+            )
+        else:
+            pop_trip_point(user_id)
+            await callback.message.answer(**await plan_trip(origin, params[2]))
+        await callback.answer()
+    elif params[1] == "plan":
+        await edit_if_changed(callback.message, **await plan_trip(params[2], params[3]))
+        await callback.answer()
+    elif params[1] == "cancel":
+        pop_trip_point(callback.from_user.id)
+        await callback.message.delete()
+        await callback.answer("Построение маршрута отменено")
+
+
+favourites = FavouritesStore("favourites.sqlite")
+
+
+def favourite_stop_name(stop_id: int) -> str:
+    """The stop may be gone from the feed since it was added."""
+    try:
+        return get_stop(stop_id).stop_name
+    except Exception as e:
+        logger.warning(f"cannot get stop {stop_id}: {e!r}")
+        return str(stop_id)
+
+
+async def favourites_message(user_id: int) -> Dict[str, Any]:
+    """Forms message with forecasts for all favourite stops of the user.
+
+    Forecasts are requested concurrently.
+
+    :return: kwargs to bot.send_message() or types.Message().answer(), etc"""
+    logger.info("form favourites message")
+    stops = await favourites.get(user_id)
+    if len(stops) == 0:
+        return {
+            "text": "У вас пока нет избранных остановок.\n"
+            "Нажмите ⭐ на остановке, чтобы добавить её сюда.",
+        }
+    loop = asyncio.get_running_loop()
+    infos = await asyncio.gather(
+        *[loop.run_in_executor(None, stop_info, i) for i in stops],
+        return_exceptions=True,
+    )
+    names = [favourite_stop_name(i) for i in stops]
+    msg = "⭐ *Избранное*\n\n"
+    for stop_id, name, info in zip(stops, names, infos):
+        if isinstance(info, BaseException):
+            logger.warning(f"cannot get forecast for stop {stop_id}: {info!r}")
+            msg += "*" + name + "*\n"
+            msg += "_прогноз недоступен_\n"
+        else:
+            # the stop name and a few nearest arrivals
+            msg += "\n".join(info[0].split("\n")[:6]).rstrip("\n") + "\n"
+        msg += "\n"
+    kbd = make_keyboard(
+        [(name, f"BusStopMsgBlock newmsg {i}") for i, name in zip(stops, names)],
+        columns=1,
+    )
+    kbd.inline_keyboard.append(
+        [
+            InlineKeyboardButton(
+                "Обновить", callback_data="FavouritesMsgBlock refresh"
+            ),
+            InlineKeyboardButton(EMOJI["close"], callback_data="common delete_me"),
+        ]
+    )
+    return {"text": msg, "reply_markup": kbd, "parse_mode": "markdown"}
+
+
+@dp.message_handler(commands=["favourites", "fav"])
+async def favourites_command_handler(message: types.Message):
+    await message.reply(**await favourites_message(message.from_user.id))
+
+
+@dp.callback_query_handler(lambda x: x.data.startswith("FavouritesMsgBlock"))
+async def favourites_callback_handler(callback: types.CallbackQuery):
+    params = callback.data.split()
+    assert params[0] == "FavouritesMsgBlock"
+    user_id = callback.from_user.id
+    if params[1] == "toggle":
+        stop_id = int(params[2])
+        if stop_id in await favourites.get(user_id):
+            await favourites.remove(user_id, stop_id)
+            await callback.answer("Удалено из избранного")
+        elif await favourites.add(user_id, stop_id):
+            await callback.answer("⭐ Добавлено в избранное: /favourites")
+        else:
+            await callback.answer(
+                f"В избранном уже {MAX_FAVOURITES} остановок", show_alert=True
+            )
+    elif params[1] == "show":
+        await callback.message.answer(**await favourites_message(user_id))
+        await callback.answer()
+    elif params[1] == "refresh":
+        await edit_if_changed(callback.message, **await favourites_message(user_id))
+        await callback.answer()
+
+
+def search_stop_by_name_message(query: str, fast: bool = False) -> Dict[str, Any]:
+    """:param fast: search by word prefixes instead of the fuzzy search"""
+    if fast:
+        stop_groups = search_stop_groups_by_prefix(query, limit=10)
+    else:
+        stop_groups = search_stop_groups_by_name(query)
     # formatting query into markdown
     # (see https://core.telegram.org/bots/api#formatting-options)
     fq = query
@@ -421,34 +875,35 @@ def search_stop_by_name_message(query: str) -> Dict[str, Any]:
             "parse_mode": "markdown",
         }
     title = 'Остановки по запросу "' + fq + '":'
-    items = []
-    for stop_group_name in stop_groups:
-        stop_ex_id = get_stops_in_group(stop_group_name)[0]
-        items.append(
-            (stop_group_name, f"SearchStopsMsgBlock stop_group_newmsg {stop_ex_id}")
-        )
-    message, kbd = make_paginator(items, " ", " ", title=title, page_size=10)
+
+    def item(i: int) -> Tuple[str, str]:
+        group = get_stop_group(stop_groups[i])
+        return (group.name, f"SearchStopsMsgBlock group_newmsg {group.group_id}")
+
+    message, kbd = make_paginator(
+        len(stop_groups), item, " ", " ", title=title, page_size=10
+    )
     return {"text": message, "reply_markup": kbd, "parse_mode": "markdown"}
 
 
-def stop_group_message(stop_ex_id: int, page_num: int = 0) -> Dict[str, Any]:
-    stop_group_name = get_stop(stop_ex_id).stop_name.lower()
-    stops = get_stops_in_group(stop_group_name)
-    options = []
-    for i in stops:
-        s = get_stop(i)
+def stop_group_message(group_id: int, page_num: int = 0) -> Dict[str, Any]:
+    stops = get_stop_group(group_id).stop_ids
+
+    def option(i: int) -> Tuple[str, str]:
+        s = get_stop(stops[i])
         n = TRANSPORT_TYPE_EMOJI[s.transport_type]
         n += "*" + s.stop_name + "*\n"
         n += ", ".join(
-            [get_route(r).route_short_name for r, d in get_routes_by_stop(i)]
+            [get_route(r).route_short_name for r, d in get_routes_by_stop(stops[i])]
         )
-        options.append((n, f"BusStopMsgBlock appear_here {i}"))
+        return (n, f"BusStopMsgBlock appear_here {stops[i]}")
 
     pt = "Какая остановка Вам нужна?"
-    ppc = f"SearchStopsMsgBlock stop_group {stop_ex_id} {page_num-1}"
-    npc = f"SearchStopsMsgBlock stop_group {stop_ex_id} {page_num+1}"
+    ppc = f"SearchStopsMsgBlock group {group_id} {page_num-1}"
+    npc = f"SearchStopsMsgBlock group {group_id} {page_num+1}"
     m, k = make_paginator(
-        options,
+        len(stops),
+        option,
         title=pt,
         previous_page_cmd=ppc,
         next_page_cmd=npc,
@@ -457,32 +912,103 @@ def stop_group_message(stop_ex_id: int, page_num: int = 0) -> Dict[str, Any]:
     return {"text": m, "reply_markup": k, "parse_mode": "markdown"}
 
 
+def nearby_stops_message(stop_id: int, page_num: int = 0) -> Dict[str, Any]:
+    """Forms message with the stop and the stops within walking distance."""
+    stops = [(stop_id, 0.0)] + get_stop_neighbours(stop_id)
+
+    def option(i: int) -> Tuple[str, str]:
+        s = get_stop(stops[i][0])
+        n = TRANSPORT_TYPE_EMOJI[s.transport_type]
+        n += "*" + s.stop_name + "*"
+        if i > 0:
+            n += f" · {stops[i][1]:.0f} м"
+        n += "\n"
+        n += ", ".join(
+            [get_route(r).route_short_name for r, d in get_routes_by_stop(stops[i][0])]
+        )
+        return (n, f"BusStopMsgBlock appear_here {stops[i][0]}")
+
+    m, k = make_paginator(
+        len(stops),
+        option,
+        title="Остановки рядом:",
+        previous_page_cmd=f"SearchStopsMsgBlock near {stop_id} {page_num-1}",
+        next_page_cmd=f"SearchStopsMsgBlock near {stop_id} {page_num+1}",
+        cur_page=page_num,
+    )
+    return {"text": m, "reply_markup": k, "parse_mode": "markdown"}
+
+
+# Telegram caches inline results for the same query, seconds
+INLINE_CACHE_TIME = 300
+
+
+@lru_cache(maxsize=1024)
+def stop_group_inline_result(group_id: int) -> types.InlineQueryResultArticle:
+    group = get_stop_group(group_id)
+    route_names = []
+    for route_id, _ in group.routes:
+        route = get_route(route_id)
+        name = TRANSPORT_TYPE_EMOJI[route.transport_type] + route.route_short_name
+        if name not in route_names:
+            route_names.append(name)
+    text = group.title + "\n"
+    for i in group.stop_ids:
+        text += TRANSPORT_TYPE_EMOJI[get_stop(i).transport_type] + f" /stop_{i}\n"
+    return types.InlineQueryResultArticle(
+        id=str(group_id),
+        title=group.title,
+        description=" ".join(route_names),
+        input_message_content=types.InputTextMessageContent(message_text=text),
+    )
+
+
+@dp.inline_handler()
+async def inline_query_handler(query: types.InlineQuery):
+    """Autocompletion of stop names: @PiterBusBot невск..."""
+    results = [
+        stop_group_inline_result(i) for i in search_stop_groups_by_prefix(query.query)
+    ]
+    await query.answer(results, cache_time=INLINE_CACHE_TIME)
+
+
 @dp.message_handler()
-async def search_stop_message_handler(message: types.Message):
+async def search_stop_message_handler(message: types.Message, overloaded: bool = False):
+    """:param overloaded: set by admission control, use the cheap search"""
     query = message.text
-    await message.reply(**search_stop_by_name_message(query))
+    await message.reply(**search_stop_by_name_message(query, fast=overloaded))
 
 
 @dp.callback_query_handler(lambda x: x.data.startswith("SearchStopsMsgBlock"))
 async def search_stop_callback_handler(callback: types.CallbackQuery):
     params = callback.data.split()
     assert params[0] == "SearchStopsMsgBlock"
-    if params[1] == "stop_group" or params[1] == "stop_group_newmsg":
+    if params[1] in ("stop_group", "stop_group_newmsg"):
+        # old messages refer to a group by an example stop_id
+        params[1] = params[1].replace("stop_group", "group")
+        params[2] = str(get_stop_group_by_stop(int(params[2])).group_id)
+    if params[1] == "group" or params[1] == "group_newmsg":
         logger.info("callback: Search stop: stop group block sending")
-        logger.debug(f"stop group stop_id: {params[2]}")
+        logger.debug(f"stop group id: {params[2]}")
         if len(params) == 3:
             msg = stop_group_message(int(params[2]))
         else:
             # there is page num
             pn = int(params[3])
-            stop_ex_id = int(params[2])
-            msg = stop_group_message(stop_ex_id, pn)
+            group_id = int(params[2])
+            msg = stop_group_message(group_id, pn)
 
-        if params[1] == "stop_group":
-            await callback.message.edit_text(**msg)
-        else:  # stop_group_newmsg
+        if params[1] == "group":
+            await edit_if_changed(callback.message, **msg)
+        else:  # group_newmsg
             await callback.message.reply(**msg)
         await callback.answer()
+    elif params[1] == "near":
+        page_num = int(params[3]) if len(params) >= 4 else 0
+        await edit_if_changed(
+            callback.message, **nearby_stops_message(int(params[2]), page_num)
+        )
+        await callback.answer()
 
 
 @dp.callback_query_handler()
@@ -504,8 +1030,23 @@ async def callback_handler(callback: types.CallbackQuery) -> None:
         raise ValueError(f"Unknown callback: {callback.data}")
 
 
+async def on_startup(dp: Dispatcher):
+    # the bot answers /start while the feed is being loaded
+    # and the journey planner is compiled
+    asyncio.get_running_loop().run_in_executor(None, ensure_loaded)
+    prewarmer.start()
+
+
+async def on_shutdown(dp: Dispatcher):
+    logger.info(f"admission control: {admission.stats()}")
+    prewarmer.stop()
+    await favourites.close()
+
+
 def start_bot():
-    executor.start_polling(dp, skip_updates=True)
+    executor.start_polling(
+        dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown
+    )
 
 
 if __name__ == "__main__":
@@ -1,96 +1,233 @@
-import pandas as pd
+"""
+GTFS feeds of the city transport and the forecasts API.
+
+Feeds are listed in FEEDS_FILE (only SPb if there is no such file)
+and loaded on the first call that needs them (or by ensure_loaded()
+in background), so importing the module is cheap. Functions of this
+module find the feed by the ids (see feeds.py) or by the location.
+
+Loaded feeds use MAX_FEEDS_MEMORY at most: the least recently used
+ones are unloaded and will be loaded again when needed. Stop name
+searches use the name indexes that stay in memory, so they don't
+load the unloaded feeds.
+"""
 import math
 import json
-from random import choice
-import zipfile
-import requests
-import os
-from typing import Optional, List, Tuple
+import heapq
+import hashlib
 import logging
-
-from rtree import index as rtree_index  # type: ignore
-from fuzzywuzzy import process
-from fuzzywuzzy import fuzz
+import threading
+from typing import (
+    Callable,
+    Optional,
+    List,
+    Tuple,
+    Dict,
+    TypeVar,
+    Union,
+    TYPE_CHECKING,
+)
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from forecasts import Arrival
+from feeds import (
+    FEED_ID_SPAN,
+    BBox,
+    Feed,
+    FeedConfig,
+    RouteStats,
+    StopGroup,
+    normalize_name,
+)
+import feeds
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from planner import Planner, Journey
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-_route_df: Optional[pd.DataFrame] = None
-_stop_df: Optional[pd.DataFrame] = None
-_stop_times_df: Optional[pd.DataFrame] = None
-_trips_df: Optional[pd.DataFrame] = None
-
-
-def update_feed_files():
-    URL = "http://transport.orgp.spb.ru/\
-Portal/transport/internalapi/gtfs/feed.zip"
-    with open("feed.zip", "wb") as f:
-        r = requests.get(URL)
-        f.write(r.content)
-        f.close()
-    with zipfile.ZipFile("feed.zip") as z:
-        z.extractall("feed")
-    os.remove("feed.zip")
-
-
-def _load_databases():
-    logger.info("loading databases...")
-    global _route_df
-    global _stop_df
-    global _stop_times_df
-    global _trips_df
-    if not (
-        os.path.exists("feed/routes.txt")
-        and os.path.exists("feed/stops.txt")
-        and os.path.exists("feed/stop_times.txt")
-        and os.path.exists("feed/trips.txt")
-    ):
-        logger.warn("downloading files...")
-        update_feed_files()
-        logger.info("files downloaded")
-    _route_df = pd.read_csv("feed/routes.txt")
-    _stop_df = pd.read_csv("feed/stops.txt")
-    _stop_times_df = pd.read_csv("feed/stop_times.txt")
-    _trips_df = pd.read_csv("feed/trips.txt")
-
-
-def _preprocess_stops():
-    logger.info("preprocessing stops...")
-    global _koeff
-    global _stop_rtree_idx
-    _center_lat = (_stop_df.stop_lat.max() + _stop_df.stop_lat.min()) / 2
-    # approx. distance = sqrt(dLat^2 + (dLon*cos(lat))^2)
-    # _koeff = cos(lat)
-    _koeff = math.cos(math.radians(_center_lat))
-    _stop_rtree_idx = rtree_index.Index()
-    for i in _stop_df[["stop_id", "stop_lat", "stop_lon"]].itertuples():
-        _stop_rtree_idx.add(i.stop_id, (i.stop_lat, i.stop_lon * _koeff))
-
-
-def get_route(route_id: int) -> pd.Series:
+T = TypeVar("T")
+
+FORECAST_URL = "https://transport.orgp.spb.ru/\
+Portal/transport/internalapi/forecast/bystop?stopID="
+
+SPB_FEED = FeedConfig(
+    name="spb",
+    directory="feed",
+    url="http://transport.orgp.spb.ru/Portal/transport/internalapi/gtfs/feed.zip",
+    forecast_url=FORECAST_URL,
+    id_offset=0,
+)
+
+# list of FeedConfig fields, e.g.
+# [{"name": "spb", "directory": "feed", ...}, {"name": "msk", ...}]
+FEEDS_FILE = "feeds.json"
+MAX_FEEDS_MEMORY = 4 * 2**30  # bytes
+
+# the first feed is the default one, it is never unloaded
+_feeds: List[Feed] = []
+_feeds_lock = threading.Lock()
+
+
+def _load_feed_configs() -> List[FeedConfig]:
+    try:
+        with open(FEEDS_FILE, "r") as f:
+            return [FeedConfig(**i) for i in json.loads(f.read())]
+    except FileNotFoundError:
+        return [SPB_FEED]
+
+
+def add_feed(config: FeedConfig) -> Feed:
+    if config.id_offset % FEED_ID_SPAN:
+        raise ValueError(f"id_offset must be a multiple of {FEED_ID_SPAN}")
+    for i in _feeds:
+        if i.name == config.name or i.config.id_offset == config.id_offset:
+            raise ValueError(f"feed {config.name} conflicts with {i.name}")
+    feed = Feed(config, pinned=not _feeds)
+    _feeds.append(feed)
+    _search_stop_groups_by_prefix.cache_clear()
+    return feed
+
+
+def get_feeds() -> List[Feed]:
+    return list(_feeds)
+
+
+def get_feed(name: str) -> Feed:
+    for i in _feeds:
+        if i.name == name:
+            return i
+    raise ValueError(f"Cannot find feed {name}")
+
+
+def default_feed() -> Feed:
+    return _feeds[0]
+
+
+def get_feed_by_id(id: int) -> Feed:
+    """:param id: stop_id, route_id or stop group id"""
+    for i in _feeds:
+        if i.contains_id(id):
+            return i
+    raise ValueError(f"There is no feed for id {id}")
+
+
+def _bbox_dist(bbox: BBox, lat: float, lon: float) -> float:
+    min_lat, min_lon, max_lat, max_lon = bbox
+    d_lat = max(min_lat - lat, 0, lat - max_lat)
+    d_lon = max(min_lon - lon, 0, lon - max_lon) * math.cos(math.radians(lat))
+    return math.hypot(d_lat, d_lon)
+
+
+def get_feed_by_location(lat: float, lon: float) -> Feed:
+    """:return: the feed covering the location, or the nearest one"""
+    return min(_feeds, key=lambda f: _bbox_dist(f.bbox(), lat, lon))
+
+
+def _use(feed: Feed) -> Feed:
+    """Loads the feed if needed, unloading the others if memory is short."""
+    if not feed.loaded:
+        feed.tables()
+        evict_feeds(keep=feed)
+    return feed
+
+
+def _indexed(feed: Feed) -> Feed:
+    """Loads the feed only if its stop names are not indexed yet."""
+    return feed if feed.name_indexed else _use(feed)
+
+
+def _built(feed: Feed, build: Callable[[], T]) -> T:
+    """
+    Calls build() that may build an index of the feed on demand,
+    the other feeds are unloaded if memory becomes short.
+    """
+    before = feed.memory_usage()
+    ret = build()
+    if feed.memory_usage() > before:
+        evict_feeds(keep=feed)
+    return ret
+
+
+def evict_feeds(keep: Optional[Feed] = None, max_memory: Optional[int] = None):
+    """
+    Unloads the least recently used feeds while the loaded ones
+    use more than max_memory (MAX_FEEDS_MEMORY by default).
+    """
+    if max_memory is None:
+        max_memory = MAX_FEEDS_MEMORY
+    with _feeds_lock:
+        usage = {f.name: f.memory_usage() for f in _feeds if f.loaded}
+        total = sum(usage.values())
+        candidates = sorted(
+            (f for f in _feeds if f.loaded and not f.pinned and f is not keep),
+            key=lambda f: f.last_used,
+        )
+        for f in candidates:
+            if total <= max_memory:
+                break
+            total -= usage[f.name]
+            f.unload()
+
+
+def memory_usage() -> Dict[str, int]:
+    """:return: {feed name: bytes} for the loaded feeds"""
+    return {f.name: f.memory_usage() for f in _feeds if f.loaded}
+
+
+def ensure_loaded():
+    """
+    Loads the default feed, then compiles its journey planner, which
+    takes several seconds for a city-sized feed.
+    """
+    _use(default_feed())
+    get_planner()
+
+
+def update_feed_files(feed: Optional[Feed] = None):
+    feeds.update_feed_files((feed or default_feed()).config)
+
+
+def search_stop_groups_by_prefix(query: str, limit=20) -> List[int]:
+    """
+    Fast search for autocompletion: every word of the query must be
+    a prefix of some word of the stop group name.
+
+    Results are sorted: the same name first, then names starting
+    with the query, then groups with more routes.
+    :return: list of stop group ids
+    """
+    key = " ".join(normalize_name(query))
+    return list(_search_stop_groups_by_prefix(key, limit))
+
+
+@lru_cache(maxsize=4096)
+def _search_stop_groups_by_prefix(key: str, limit: int) -> List[int]:
+    found = heapq.merge(
+        *[_indexed(f).search_stop_groups_by_prefix(key, limit) for f in _feeds]
+    )
+    return [i[1] for i, _ in zip(found, range(limit))]
+
+
+def get_route(route_id: int) -> "pd.Series":
     """
     :return: Series object with properties:
     - route_short_name
     - route_transport_type
     - route_long_name
     """
-    # TODO: return dict or something else
-    assert _route_df is not None
-    r = _route_df[_route_df.route_id == route_id]
-    if len(r) == 0:
-        raise ValueError(
-            f"""Cannot find routes with id {route_id},
-            maybe your databases (feed) are outdated?"""
-        )
-    return r.iloc[0]
+    return _use(get_feed_by_id(route_id)).get_route(route_id)
 
 
-def get_random_stop_id():
-    return choice(_stop_df.stop_id)
+def get_random_stop_id() -> int:
+    return _use(default_feed()).get_random_stop_id()
 
 
-def get_stop(stop_id: int):
+def get_stop(stop_id: int) -> "pd.Series":
     """
     :param stop_id: aka stop_code
     :return: Series object with properties:
@@ -99,12 +236,18 @@ def get_stop(stop_id: int):
     - stop_lat
     - stop_lon
     """
-    # TODO: return dict or something else
-    assert _stop_df is not None
-    r = _stop_df[_stop_df.stop_id == stop_id]
-    if len(r) == 0:
-        raise ValueError(f"Cannot find stops with id {stop_id}")
-    return r.iloc[0]
+    return _use(get_feed_by_id(stop_id)).get_stop(stop_id)
+
+
+def get_stop_coordinates(stop_ids: List[int]) -> List[Tuple[float, float]]:
+    """:return: (lat, lon) of the stops in the same order"""
+    by_feed: Dict[Feed, List[int]] = {}
+    for i in stop_ids:
+        by_feed.setdefault(get_feed_by_id(i), []).append(i)
+    coords: Dict[int, Tuple[float, float]] = {}
+    for f, ids in by_feed.items():
+        coords.update(zip(ids, _use(f).get_stop_coordinates(ids)))
+    return [coords[i] for i in stop_ids]
 
 
 def geo_dist(la1, lo1, la2, lo2):
@@ -126,18 +269,10 @@ def geo_dist(la1, lo1, la2, lo2):
 
 def get_nearest_stops(lat, lon, n=5):
     """
-    Get the n stops closest to the given coordinates.
-
-    Function uses approximate distance estimation.
-    Error is about cos(max_lat)/cos(min_lat)
+    Get the n stops closest to the given coordinates,
+    in the feed covering them.
     """
-    # Exact distance:
-    # 2*R * sin(dLat/2)^2 + sin(dLon/2)^2 * cos(lat1)*cos(lat2)
-    # Approximate distance:
-    # 2*R * (dLat/2)^2 + (dLon/2)^2 * cos(center_lat)^2 ==
-    # == 1/2 * dLat^2 + (dLon * cos(center_lat))^2
-    res = list(_stop_rtree_idx.nearest((lat, lon * _koeff), num_results=n))
-    return res
+    return _use(get_feed_by_location(lat, lon)).get_nearest_stops(lat, lon, n)
 
 
 def get_stops_by_route(route_id: int, direction_id: int):
@@ -145,21 +280,48 @@ def get_stops_by_route(route_id: int, direction_id: int):
     Returns the list of stops in the correct order.
     :return: list of stop_id
     """
-    assert _trips_df is not None
-    assert _stop_times_df is not None
-    if not (_trips_df.route_id == route_id).any():
-        raise ValueError(f"Cannot find trips for route_id={route_id}")
-    trip_ids = _trips_df[
-        (_trips_df.route_id == route_id) & (_trips_df.direction_id == direction_id)
-    ].trip_id.unique()
-    # There are different 'trip' records, but stops sequence doesn't
-    # depend on it. It depends only on route_id and direction_id. Difference
-    # between 'trip' records is in other fields like arrival_time.
-    # I checked it myself.
-    # So, let's use trip_ids[0]
-    stops = _stop_times_df[_stop_times_df.trip_id == trip_ids[0]]
-    ret = stops[["stop_id", "stop_sequence"]].sort_values("stop_sequence")
-    return list(ret.stop_id)
+    return _use(get_feed_by_id(route_id)).get_stops_by_route(route_id, direction_id)
+
+
+def get_route_stats(route_id: int, direction_id: int) -> Optional[RouteStats]:
+    """
+    :return: trip count, first and last departure and headways,
+    precomputed at feed load; None if the route has no trips
+    """
+    return _use(get_feed_by_id(route_id)).get_route_stats(route_id, direction_id)
+
+
+def get_route_shape(
+    route_id: int, direction_id: int
+) -> Optional[List[Tuple[float, float]]]:
+    """
+    :return: points (lat, lon) of the route path from shapes.txt,
+    None if the feed has no shape for the route
+    """
+    return _use(get_feed_by_id(route_id)).get_route_shape(route_id, direction_id)
+
+
+def get_stops_in_bbox(
+    min_lat: float, min_lon: float, max_lat: float, max_lon: float
+) -> List[int]:
+    """:return: stop_ids inside the bounding box"""
+    ret: List[int] = []
+    for f in _feeds:
+        a = f.bbox()
+        if a[0] <= max_lat and min_lat <= a[2] and a[1] <= max_lon and min_lon <= a[3]:
+            ret += _use(f).get_stops_in_bbox((min_lat, min_lon, max_lat, max_lon))
+    return ret
+
+
+def get_feed_version() -> str:
+    """
+    :return: identifier of the feed files, changes when
+    any feed is updated
+    """
+    h = hashlib.sha1()
+    for f in _feeds:
+        h.update(f"{f.name}:{f.version()};".encode())
+    return h.hexdigest()[:12]
 
 
 def get_direction_by_stop(stop_id: int, route_id: int):
@@ -172,66 +334,122 @@ def get_direction_by_stop(stop_id: int, route_id: int):
         raise KeyError
 
 
-def get_forecast_by_stop(stopID):
+def get_forecast_by_stop(stopID) -> List[Arrival]:
     """
     Requests arrival time forecast for a particular stop.
 
-    See also forecast_json_to_text() for human-readable result.
+    See also forecast_to_text() for human-readable result.
     Data from site: transport.orgp.spb.ru
     """
-    assert get_stop(int(stopID)) is not None
-    data_url = (
-        "https://transport.orgp.spb.ru/\
-Portal/transport/internalapi/forecast/bystop?stopID="
-        + str(stopID)
-    )
-    d = requests.get(data_url)
-    if d.status_code != 200:
-        raise ValueError
-    forecast_json = d.content
-    return json.loads(forecast_json)
+    feed = _use(get_feed_by_id(int(stopID)))
+    assert feed.get_stop(int(stopID)) is not None
+    return feed.get_forecast(int(stopID))
 
 
-def search_stop_groups_by_name(query: str, cutoff=0.5) -> List[str]:
+def search_stop_groups_by_name(query: str, cutoff=0.5) -> List[int]:
     """Searches in stop_names in lowercase, drops duplicates
-    :return: List of stop names in lowercase. Each stop name in
-    lowercase may correspond to different stop_name
+    :return: List of stop group ids. Each stop group
+    may correspond to different stop_name
     """
-    assert _stop_df is not None
-    stop_names = _stop_df.stop_name.str.lower().unique()
-    result = process.extractBests(
-        query, stop_names, scorer=fuzz.token_sort_ratio, limit=10
-    )
-    result = [i[0] for i in result if i[1] > cutoff]
-    return result
+    result: List[Tuple[int, int]] = []
+    for f in _feeds:
+        result += _indexed(f).search_stop_groups_by_name(query, limit=10)
+    result.sort(key=lambda i: -i[0])
+    return [i[1] for i in result[:10] if i[0] > cutoff]
+
+
+def get_stop_group(group_id: int) -> StopGroup:
+    return _use(get_feed_by_id(group_id)).get_stop_group(group_id)
 
 
-def get_stops_in_group(stop_name: str) -> List[int]:
+def get_stop_group_by_stop(stop_id: int) -> StopGroup:
+    return _use(get_feed_by_id(stop_id)).get_stop_group_by_stop(stop_id)
+
+
+def get_stop_neighbours(stop_id: int) -> List[Tuple[int, float]]:
     """
-    :param stop_name: stop name in lowercase
-    :return: list of stop_id
+    :return: [(stop_id, meters)] for the stops within walking radius,
+    nearest first
     """
-    assert _stop_df is not None
-    res = _stop_df[_stop_df.stop_name.str.lower() == stop_name].stop_id
-    return list(res)
+    feed = _use(get_feed_by_id(stop_id))
+    return _built(feed, lambda: feed.get_stop_neighbours(stop_id))
 
 
 def get_routes_by_stop(stop_id: int) -> List[Tuple[int, int]]:
     """
     :return: list of (route_id, direction_id)
     """
-    assert _stop_times_df is not None
-    assert _trips_df is not None
-    # stop_id -> list(trip_id)
-    t_trips = _stop_times_df[_stop_times_df.stop_id == stop_id].trip_id.unique()
-    # list(trip_id) -> DataFrame((route_id, direction_id))
-    t = _trips_df[_trips_df.trip_id.isin(t_trips)][
-        ["route_id", "direction_id"]
-    ].drop_duplicates()
-    # DataFrame((route_id, direction_id)) -> list(tuple(route_id, direction))
-    ret = [(i[1].route_id, i[1].direction_id) for i in t.iterrows()]
-    return ret
+    return _use(get_feed_by_id(stop_id)).get_routes_by_stop(stop_id)
+
+
+def get_planner(feed: Optional[Feed] = None) -> "Planner":
+    """Compiles the journey planner of the feed on the first call."""
+    feed = _use(feed or default_feed())
+    return _built(feed, feed.get_planner)
+
+
+def get_active_services(
+    date: datetime, feed: Optional[Feed] = None
+) -> Optional[List[str]]:
+    """
+    :return: service_ids running on the date, None if the feed
+    has no calendar
+    """
+    return _use(feed or default_feed()).get_active_services(date)
+
+
+def plan_journey(
+    origin: Union[int, Tuple[float, float]],
+    destination: Union[int, Tuple[float, float]],
+    departure: datetime,
+) -> List["Journey"]:
+    """
+    :param origin: stop_id or (lat, lon)
+    :param destination: stop_id or (lat, lon)
+    :param departure: local time
+    :return: journeys with different number of transfers,
+    see Planner.plan()
+    """
+
+    def feed_of(point) -> Feed:
+        if isinstance(point, tuple):
+            return get_feed_by_location(*point)
+        return get_feed_by_id(point)
+
+    feed = feed_of(origin)
+    if feed_of(destination) is not feed:
+        # there are no journeys between cities
+        return []
+    planner = get_planner(feed)
+
+    def endpoints(point) -> Dict[int, int]:
+        if isinstance(point, tuple):
+            return planner.stops_near(point[0], point[1], radius=600)
+        feed.get_stop(point)
+        return {point: 0}
+
+    from planner import best_journeys
+
+    origins, destinations = endpoints(origin), endpoints(destination)
+    seconds = departure.hour * 3600 + departure.minute * 60 + departure.second
+    journeys = planner.plan(
+        origins,
+        destinations,
+        seconds,
+        services=get_active_services(departure, feed),
+    )
+    day = 24 * 3600
+    if seconds + day <= planner.last_departure:
+        # night trips of the previous service day, their times are >= 24:00
+        previous = planner.plan(
+            origins,
+            destinations,
+            seconds + day,
+            services=get_active_services(departure - timedelta(days=1), feed),
+        )
+        journeys = best_journeys(journeys + [j.shifted(-day) for j in previous])
+    return journeys
 
 
-_load_databases()
-_preprocess_stops()
+for _config in _load_feed_configs():
+    add_feed(_config)
@@ -0,0 +1,149 @@
+"""
+Favourite stops of the users.
+
+Stored in SQLite (WAL mode). The connection lives in its own thread,
+so handlers never wait for the disk: reads go through an in-memory
+cache and writes are collected and committed in batches.
+"""
+import asyncio
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MAX_FAVOURITES = 10
+
+
+class FavouritesStore:
+    """
+    :param path: SQLite database file
+    :param flush_interval: how often pending writes are committed, seconds
+    :param max_batch: commit earlier if there are so many pending writes
+    """
+
+    def __init__(self, path: str, flush_interval: float = 0.5, max_batch=500):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        # sqlite3 connection can be used only in the thread that created it
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._cache: Dict[int, List[int]] = {}
+        # (add or remove, user_id, stop_id)
+        self._pending: List[Tuple[bool, int, int]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_now = asyncio.Event()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS favourites (
+                    user_id INTEGER NOT NULL,
+                    stop_id INTEGER NOT NULL,
+                    added REAL NOT NULL DEFAULT (julianday('now')),
+                    seq INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, stop_id)
+                ) WITHOUT ROWID"""
+            )
+            # rows of one batch have the same "added", seq keeps their order
+            columns = [
+                i[1] for i in self._conn.execute("PRAGMA table_info(favourites)")
+            ]
+            if "seq" not in columns:
+                self._conn.execute(
+                    "ALTER TABLE favourites ADD COLUMN seq INTEGER NOT NULL DEFAULT 0"
+                )
+            self._conn.commit()
+        return self._conn
+
+    def _select(self, user_id: int) -> List[int]:
+        rows = self._connect().execute(
+            "SELECT stop_id FROM favourites WHERE user_id = ? ORDER BY seq, added",
+            (user_id,),
+        )
+        return [i[0] for i in rows]
+
+    def _write(self, batch: List[Tuple[bool, int, int]]):
+        conn = self._connect()
+        with conn:
+            for add, user_id, stop_id in batch:
+                if add:
+                    conn.execute(
+                        "INSERT OR IGNORE INTO favourites (user_id, stop_id, seq)"
+                        " VALUES (?, ?, (SELECT COALESCE(MAX(seq), 0) + 1"
+                        " FROM favourites WHERE user_id = ?))",
+                        (user_id, stop_id, user_id),
+                    )
+                else:
+                    conn.execute(
+                        "DELETE FROM favourites WHERE user_id = ? AND stop_id = ?",
+                        (user_id, stop_id),
+                    )
+
+    async def _run_in_thread(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def get(self, user_id: int) -> List[int]:
+        """:return: stop_ids in the order they were added"""
+        if user_id not in self._cache:
+            stops = await self._run_in_thread(self._select, user_id)
+            # pending writes were applied to the cache only
+            self._cache.setdefault(user_id, stops)
+        return list(self._cache[user_id])
+
+    async def add(self, user_id: int, stop_id: int) -> bool:
+        """:return: False if there are too many favourites already"""
+        stops = await self.get(user_id)
+        if stop_id in stops:
+            return True
+        if len(stops) >= MAX_FAVOURITES:
+            return False
+        self._cache[user_id].append(stop_id)
+        self._enqueue((True, user_id, stop_id))
+        return True
+
+    async def remove(self, user_id: int, stop_id: int):
+        stops = await self.get(user_id)
+        if stop_id in stops:
+            self._cache[user_id].remove(stop_id)
+            self._enqueue((False, user_id, stop_id))
+
+    def _enqueue(self, op: Tuple[bool, int, int]):
+        self._pending.append(op)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if len(self._pending) >= self.max_batch:
+            self._flush_now.set()
+
+    async def _flush_loop(self):
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Commits pending writes."""
+        batch, self._pending = self._pending, []
+        if batch:
+            try:
+                await self._run_in_thread(self._write, batch)
+            except sqlite3.Error:
+                logger.exception("cannot save favourites")
+                self._pending = batch + self._pending
+                raise
+
+    async def close(self):
+        await self.flush()
+        if self._conn is not None:
+            await self._run_in_thread(self._conn.close)
+        self._executor.shutdown()
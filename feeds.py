@@ -0,0 +1,816 @@
+"""
+GTFS feeds of different cities.
+
+A Feed keeps the tables and indexes of one feed. Ids of stops, routes
+and stop groups are shifted by the id_offset of the feed, so ids of
+different feeds never collide and the feed can be found by an id
+alone (see data.get_feed_by_id). The SPb feed has offset 0, so its ids
+are the same as in the feed files.
+
+Tables are loaded on the first use and can be unloaded to free memory,
+the next use loads them again. The index of stop names is small, it
+stays in memory and is saved next to the feed files, so searches don't
+load unloaded feeds, even after a restart.
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import zipfile
+import hashlib
+import logging
+import threading
+from bisect import bisect_left
+from random import choice
+from typing import (
+    Optional,
+    List,
+    Tuple,
+    Dict,
+    NamedTuple,
+    Set,
+    TYPE_CHECKING,
+)
+from datetime import datetime
+
+from forecasts import Arrival, decode_forecast
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from rtree import index as rtree_index  # type: ignore
+    from planner import Planner
+    from neighbours import NeighbourGraph
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# ids of a feed are in [id_offset, id_offset + FEED_ID_SPAN)
+FEED_ID_SPAN = 10_000_000
+FORECAST_TIMEOUT = 5  # seconds
+
+BBox = Tuple[float, float, float, float]  # min_lat, min_lon, max_lat, max_lon
+
+
+class FeedConfig(NamedTuple):
+    """
+    :param directory: where the feed files are
+    :param url: feed.zip to download if there are no files
+    :param forecast_url: arrival forecasts API, stop_id is appended
+    :param id_offset: multiple of FEED_ID_SPAN
+    :param walking_radius: stops closer than that are neighbours
+        (transfers, similar stops), meters
+    :param bbox: (min_lat, min_lon, max_lat, max_lon) of the stops,
+        otherwise it is known after the first load
+    """
+
+    name: str
+    directory: str
+    url: Optional[str] = None
+    forecast_url: Optional[str] = None
+    id_offset: int = 0
+    walking_radius: float = 300
+    bbox: Optional[BBox] = None
+
+
+class StopGroup(NamedTuple):
+    """Stops with the same name (in lowercase)."""
+
+    group_id: int
+    name: str
+    stop_ids: List[int]
+    lat: float
+    lon: float
+    routes: List[Tuple[int, int]]
+    # stop_name as it is in the feed
+    title: str
+
+
+# time of day bands for headways, hours since midnight of the service day
+HEADWAY_BANDS = [(6, 10), (10, 16), (16, 20), (20, 24)]
+
+
+class RouteStats(NamedTuple):
+    """
+    Schedule of a (route_id, direction_id) on its busiest service day.
+
+    :param trips: number of trips
+    :param first_departure: seconds since midnight, from the first stop
+    :param last_departure: may be >= 24 hours for trips after midnight
+    :param headways: median interval between departures in each
+        of HEADWAY_BANDS, seconds, None if there are no such trips
+    """
+
+    trips: int
+    first_departure: int
+    last_departure: int
+    headways: Tuple[Optional[int], ...]
+
+
+def compute_route_stats(
+    trips: "pd.DataFrame", stop_times: "pd.DataFrame"
+) -> Dict[Tuple[int, int], RouteStats]:
+    """
+    :param trips: trip_id, route_id, direction_id and optional service_id
+    :param stop_times: trip_id, stop_sequence, departure_time
+    """
+    import numpy as np
+    import pandas as pd
+    from planner import parse_gtfs_time
+
+    if len(stop_times) == 0:
+        return {}
+    first = stop_times.loc[
+        stop_times.groupby("trip_id").stop_sequence.idxmin(),
+        ["trip_id", "departure_time"],
+    ]
+    t = first.merge(trips, on="trip_id")
+    t["dep"] = parse_gtfs_time(t.departure_time)
+    if "service_id" not in t.columns:
+        t["service_id"] = 0
+    key = ["route_id", "direction_id"]
+    # routes run differently on weekdays and weekends,
+    # take the service with the most trips
+    counts = t.groupby(key + ["service_id"]).size().rename("n").reset_index()
+    busiest = counts.sort_values("n", ascending=False).drop_duplicates(key)
+    t = t.merge(busiest[key + ["service_id"]], on=key + ["service_id"])
+    t = t.sort_values(key + ["dep"])
+
+    gap = t.dep.diff().to_numpy(dtype=float, copy=True)
+    same = (t.route_id.to_numpy()[1:] == t.route_id.to_numpy()[:-1]) & (
+        t.direction_id.to_numpy()[1:] == t.direction_id.to_numpy()[:-1]
+    )
+    gap[0] = np.nan
+    gap[1:][~same] = np.nan
+    hour = t.dep.to_numpy() / 3600
+    band = np.full(len(t), -1)
+    for n, (start, end) in enumerate(HEADWAY_BANDS):
+        band[(hour >= start) & (hour < end)] = n
+    t["gap"] = gap
+    t["band"] = band
+
+    spans = t.groupby(key).dep.agg(["size", "min", "max"])
+    headways = (
+        t[(t.band >= 0) & t.gap.notna()]
+        .groupby(key + ["band"])
+        .gap.median()
+        .unstack()
+        .reindex(index=spans.index, columns=range(len(HEADWAY_BANDS)))
+    )
+    ret = {}
+    for (route_id, direction_id), n, first_dep, last_dep, h in zip(
+        spans.index,
+        spans["size"].tolist(),
+        spans["min"].tolist(),
+        spans["max"].tolist(),
+        headways.to_numpy().tolist(),
+    ):
+        ret[(int(route_id), int(direction_id))] = RouteStats(
+            trips=n,
+            first_departure=int(first_dep),
+            last_departure=int(last_dep),
+            headways=tuple(None if pd.isna(i) else int(i) for i in h),
+        )
+    return ret
+
+
+def normalize_name(name: str) -> List[str]:
+    """Lowercase words without punctuation, "ё" is replaced by "е"."""
+    return re.findall(r"\w+", name.lower().replace("ё", "е"))
+
+
+def deep_getsizeof(obj, seen: Optional[Set[int]] = None) -> int:
+    """
+    :return: size of the object with the containers, arrays and
+    tables it refers to, bytes; objects in seen are not counted again
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if hasattr(obj, "nbytes") and hasattr(obj, "dtype"):
+        # NumPy array
+        return int(obj.nbytes)
+    if hasattr(obj, "memory_usage") and hasattr(obj, "columns"):
+        return int(obj.memory_usage(deep=True).sum())
+    total = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            total += deep_getsizeof(k, seen) + deep_getsizeof(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for i in obj:
+            total += deep_getsizeof(i, seen)
+    elif hasattr(obj, "__dict__"):
+        total += deep_getsizeof(vars(obj), seen)
+    return total
+
+
+class StopNameIndex:
+    """
+    Names of the stop groups of a feed, for the searches.
+
+    :param names: group_id -> name of the group
+    :param route_counts: group_id -> number of routes of the group
+    """
+
+    def __init__(self, names: Dict[int, str], route_counts: Dict[int, int]):
+        entries = sorted(
+            {
+                (word, group_id)
+                for group_id, name in names.items()
+                for word in normalize_name(name)
+            }
+        )
+        # sorted (word, group_id) for all words of normalized stop group names
+        self.words = [i[0] for i in entries]
+        self.groups = [i[1] for i in entries]
+        self.names = names
+        self.route_counts = route_counts
+
+    @classmethod
+    def from_stop_groups(cls, stop_groups: Dict[int, StopGroup]) -> "StopNameIndex":
+        return cls(
+            {i: g.name for i, g in stop_groups.items()},
+            {i: len(g.routes) for i, g in stop_groups.items()},
+        )
+
+    def to_json(self) -> list:
+        """:return: [[group_id, name, route count], ...]"""
+        return [[i, name, self.route_counts[i]] for i, name in self.names.items()]
+
+    @classmethod
+    def from_json(cls, groups: list) -> "StopNameIndex":
+        return cls({i[0]: i[1] for i in groups}, {i[0]: i[2] for i in groups})
+
+    def groups_by_word_prefix(self, prefix: str) -> Set[int]:
+        ret = set()
+        i = bisect_left(self.words, prefix)
+        while i < len(self.words) and self.words[i].startswith(prefix):
+            ret.add(self.groups[i])
+            i += 1
+        return ret
+
+    def search_by_prefix(self, key: str, limit: int) -> List[tuple]:
+        """
+        :param key: normalized query, words joined with spaces
+        :return: sorted list of (rank, group_id)
+        """
+        words = key.split()
+        if not words:
+            return []
+        found = self.groups_by_word_prefix(words[0])
+        for w in words[1:]:
+            found &= self.groups_by_word_prefix(w)
+
+        def rank(group_id: int):
+            name = self.names[group_id]
+            normalized = " ".join(normalize_name(name))
+            return (
+                normalized != key,
+                not normalized.startswith(key),
+                -self.route_counts[group_id],
+                name,
+            )
+
+        return sorted((rank(i), i) for i in found)[:limit]
+
+    def search_by_name(self, query: str, limit: int) -> List[Tuple[int, int]]:
+        """:return: list of (score, group_id) of the fuzzy search"""
+        from fuzzywuzzy import process, fuzz
+
+        result = process.extractBests(
+            query, self.names, scorer=fuzz.token_sort_ratio, limit=limit
+        )
+        return [(i[1], i[2]) for i in result]
+
+    def memory_usage(self) -> int:
+        return deep_getsizeof(self)
+
+
+class FeedTables:
+    """Loaded tables and indexes of a feed, never changed after loading."""
+
+    REQUIRED_FILES = ["routes.txt", "stops.txt", "stop_times.txt", "trips.txt"]
+
+    def __init__(self, config: FeedConfig):
+        self.config = config
+        self.planner: Optional["Planner"] = None
+        self.neighbours: Optional["NeighbourGraph"] = None
+        self._memory: Optional[int] = None
+        self._lazy_memory: Tuple[tuple, int] = ((), 0)
+        self._load_databases()
+        self._preprocess_stops()
+        self._preprocess_routes_by_stop()
+        self._preprocess_stop_groups()
+        self._preprocess_name_index()
+        self._preprocess_route_stats()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.config.directory, name)
+
+    def _load_databases(self):
+        logger.info(f"loading {self.config.name} databases...")
+        import pandas as pd
+
+        if not all(os.path.exists(self._path(i)) for i in self.REQUIRED_FILES):
+            logger.warning("downloading files...")
+            update_feed_files(self.config)
+            logger.info("files downloaded")
+        self.route_df = pd.read_csv(self._path("routes.txt"))
+        self.stop_df = pd.read_csv(self._path("stops.txt"))
+        self.stop_times_df = pd.read_csv(self._path("stop_times.txt"))
+        self.trips_df = pd.read_csv(self._path("trips.txt"))
+        self.calendar_df: Optional[pd.DataFrame] = None
+        if os.path.exists(self._path("calendar.txt")):
+            self.calendar_df = pd.read_csv(self._path("calendar.txt"))
+        self.shapes_df: Optional[pd.DataFrame] = None
+        if os.path.exists(self._path("shapes.txt")):
+            self.shapes_df = pd.read_csv(self._path("shapes.txt"))
+        offset = self.config.id_offset
+        if offset:
+            self.route_df["route_id"] += offset
+            self.stop_df["stop_id"] += offset
+            self.stop_times_df["stop_id"] += offset
+            self.trips_df["route_id"] += offset
+
+    def _preprocess_stops(self):
+        logger.info("preprocessing stops...")
+        from rtree import index as rtree_index  # type: ignore
+
+        s = self.stop_df
+        self.bbox: BBox = (
+            float(s.stop_lat.min()),
+            float(s.stop_lon.min()),
+            float(s.stop_lat.max()),
+            float(s.stop_lon.max()),
+        )
+        _center_lat = (s.stop_lat.max() + s.stop_lat.min()) / 2
+        # approx. distance = sqrt(dLat^2 + (dLon*cos(lat))^2)
+        # koeff = cos(lat)
+        self.koeff = math.cos(math.radians(_center_lat))
+        self.stop_rtree_idx = rtree_index.Index()
+        for i in s[["stop_id", "stop_lat", "stop_lon"]].itertuples():
+            self.stop_rtree_idx.add(i.stop_id, (i.stop_lat, i.stop_lon * self.koeff))
+
+    def _preprocess_routes_by_stop(self):
+        logger.info("preprocessing routes by stop...")
+        t = (
+            self.stop_times_df[["stop_id", "trip_id"]]
+            .merge(self.trips_df[["trip_id", "route_id", "direction_id"]], on="trip_id")
+            .drop_duplicates(["stop_id", "route_id", "direction_id"])
+        )
+        self.routes_by_stop: Dict[int, List[Tuple[int, int]]] = {}
+        for stop_id, route_id, direction_id in zip(
+            t.stop_id.tolist(), t.route_id.tolist(), t.direction_id.tolist()
+        ):
+            self.routes_by_stop.setdefault(stop_id, []).append((route_id, direction_id))
+
+    def _load_stop_group_ids(self) -> Dict[str, int]:
+        try:
+            with open(self._path("stop_group_ids.json"), "r") as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return {}
+
+    def _preprocess_stop_groups(self):
+        """
+        Builds the table of stop groups.
+
+        Group ids are kept in stop_group_ids.json, so a group gets
+        the same id after feed update if its name is unchanged.
+        """
+        logger.info("preprocessing stop groups...")
+        ids = self._load_stop_group_ids()
+        next_id = max(ids.values(), default=-1) + 1
+        names = self.stop_df.stop_name.str.lower()
+        offset = self.config.id_offset
+        self.stop_groups: Dict[int, StopGroup] = {}
+        self.stop_group_by_name: Dict[str, int] = {}
+        self.stop_group_by_stop: Dict[int, int] = {}
+        for name, g in self.stop_df.groupby(names, sort=True):
+            if name not in ids:
+                ids[name] = next_id
+                next_id += 1
+            group_id = ids[name] + offset
+            stop_ids = g.stop_id.tolist()
+            routes: List[Tuple[int, int]] = []
+            for i in stop_ids:
+                routes += [r for r in self.routes_by_stop.get(i, []) if r not in routes]
+            self.stop_groups[group_id] = StopGroup(
+                group_id=group_id,
+                name=name,
+                stop_ids=stop_ids,
+                lat=float(g.stop_lat.mean()),
+                lon=float(g.stop_lon.mean()),
+                routes=routes,
+                title=g.stop_name.iloc[0],
+            )
+            self.stop_group_by_name[name] = group_id
+            for i in stop_ids:
+                self.stop_group_by_stop[i] = group_id
+        with open(self._path("stop_group_ids.json"), "w") as f:
+            f.write(json.dumps(ids, ensure_ascii=False))
+
+    def _preprocess_name_index(self):
+        logger.info("preprocessing stop names index...")
+        self.name_index = StopNameIndex.from_stop_groups(self.stop_groups)
+
+    def _preprocess_route_stats(self):
+        logger.info("preprocessing route schedules...")
+        self.route_stats = compute_route_stats(self.trips_df, self.stop_times_df)
+
+    def memory_usage(self) -> int:
+        """:return: approximate size of the tables and indexes, bytes"""
+        if self._memory is None:
+            self._memory = self._tables_memory_usage()
+        # the planner and the graph are built later, on demand
+        key = (id(self.neighbours), id(self.planner))
+        if self._lazy_memory[0] != key:
+            # the planner shares arrays with the graph
+            seen: Set[int] = set()
+            self._lazy_memory = (
+                key,
+                deep_getsizeof(self.neighbours, seen)
+                + deep_getsizeof(self.planner, seen),
+            )
+        return self._memory + self._lazy_memory[1]
+
+    def _tables_memory_usage(self) -> int:
+        # deep memory usage takes a while, the tables are never
+        # changed, so it is computed once
+        seen: Set[int] = set()
+        total = 0
+        for i in [
+            self.route_df,
+            self.stop_df,
+            self.stop_times_df,
+            self.trips_df,
+            self.calendar_df,
+            self.shapes_df,
+            self.routes_by_stop,
+            self.stop_groups,
+            self.stop_group_by_name,
+            self.stop_group_by_stop,
+            self.name_index,
+            self.route_stats,
+        ]:
+            if i is not None:
+                total += deep_getsizeof(i, seen)
+        # r-tree: about 100 bytes per entry
+        total += 100 * len(self.stop_df)
+        return total
+
+
+def update_feed_files(config: FeedConfig):
+    import requests
+
+    if config.url is None:
+        raise FileNotFoundError(f"there are no files of the {config.name} feed")
+    archive = config.directory.rstrip("/") + ".zip"
+    with open(archive, "wb") as f:
+        r = requests.get(config.url)
+        f.write(r.content)
+        f.close()
+    with zipfile.ZipFile(archive) as z:
+        z.extractall(config.directory)
+    os.remove(archive)
+
+
+class Feed:
+    """
+    One GTFS feed. Methods load the tables if they are not loaded.
+
+    Methods taking ids expect ids of this feed (with id_offset).
+    """
+
+    def __init__(self, config: FeedConfig, pinned: bool = False):
+        """:param pinned: the feed is never unloaded"""
+        self.config = config
+        self.name = config.name
+        self.pinned = pinned
+        self.forecast_url = config.forecast_url
+        self.last_used = 0.0
+        self._tables: Optional[FeedTables] = None
+        self._lock = threading.Lock()
+        self._planner_lock = threading.Lock()
+        self._bbox_file = os.path.join(config.directory, "bbox.json")
+        self._bbox: Optional[BBox] = None
+        if config.bbox is not None:
+            self._bbox = tuple(config.bbox)  # type: ignore
+        else:
+            try:
+                with open(self._bbox_file, "r") as f:
+                    self._bbox = tuple(json.loads(f.read()))  # type: ignore
+            except FileNotFoundError:
+                pass
+        self._name_index_file = os.path.join(config.directory, "name_index.json")
+        self._name_index = self._load_name_index()
+
+    def __repr__(self):
+        return f"Feed({self.name!r}, loaded={self.loaded})"
+
+    @property
+    def loaded(self) -> bool:
+        return self._tables is not None
+
+    def tables(self) -> FeedTables:
+        """
+        Loads the feed if needed. Safe to call from several threads:
+        the others wait until loading is done.
+
+        Callers keep the returned object for the whole call, so
+        unload() in another thread doesn't break them.
+        """
+        self.last_used = time.monotonic()
+        t = self._tables
+        if t is not None:
+            return t
+        with self._lock:
+            if self._tables is None:
+                try:
+                    t = FeedTables(self.config)
+                except Exception:
+                    logger.exception(f"cannot load the {self.name} feed")
+                    raise
+                self._tables = t
+                self._name_index = t.name_index
+                self._save_bbox(t.bbox)
+                self._save_name_index(t.name_index)
+                logger.info(
+                    f"{self.name} feed is loaded, "
+                    f"{t.memory_usage() / 2**20:.0f} MiB"
+                )
+            return self._tables
+
+    def unload(self):
+        """Frees the tables, the name index stays."""
+        with self._lock:
+            if self._tables is not None:
+                logger.info(f"unloading {self.name} feed")
+                self._tables = None
+
+    def memory_usage(self) -> int:
+        """:return: approximate memory used by the feed, 0 if not loaded"""
+        t = self._tables
+        return 0 if t is None else t.memory_usage()
+
+    @property
+    def name_indexed(self) -> bool:
+        """The stop names can be searched without loading the feed."""
+        return self._name_index is not None
+
+    def name_index(self) -> StopNameIndex:
+        """Loads the feed if it was never loaded."""
+        if self._name_index is None:
+            self.tables()
+        assert self._name_index is not None
+        return self._name_index
+
+    def _load_name_index(self) -> Optional[StopNameIndex]:
+        try:
+            with open(self._name_index_file, "r") as f:
+                saved = json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        if saved["version"] != self.version():
+            # the feed files were updated since
+            return None
+        return StopNameIndex.from_json(saved["groups"])
+
+    def _save_name_index(self, name_index: StopNameIndex):
+        with open(self._name_index_file, "w") as f:
+            saved = {"version": self.version(), "groups": name_index.to_json()}
+            f.write(json.dumps(saved, ensure_ascii=False))
+
+    def _save_bbox(self, bbox: BBox):
+        self._bbox = bbox
+        with open(self._bbox_file, "w") as f:
+            f.write(json.dumps(bbox))
+
+    def bbox(self) -> BBox:
+        """
+        Known without loading the feed if it is in the config
+        or the feed was loaded once.
+        """
+        if self._bbox is None:
+            self.tables()
+        assert self._bbox is not None
+        return self._bbox
+
+    def contains_id(self, id: int) -> bool:
+        return self.config.id_offset <= id < self.config.id_offset + FEED_ID_SPAN
+
+    def version(self) -> str:
+        """:return: identifier of the feed files, changes on update"""
+        h = hashlib.sha1()
+        if os.path.isdir(self.config.directory):
+            for name in sorted(os.listdir(self.config.directory)):
+                if name.endswith(".txt"):
+                    st = os.stat(os.path.join(self.config.directory, name))
+                    h.update(f"{name}:{st.st_size}:{st.st_mtime_ns};".encode())
+        return h.hexdigest()[:12]
+
+    def get_route(self, route_id: int) -> "pd.Series":
+        """
+        :return: Series object with properties:
+        - route_short_name
+        - route_transport_type
+        - route_long_name
+        """
+        t = self.tables()
+        r = t.route_df[t.route_df.route_id == route_id]
+        if len(r) == 0:
+            raise ValueError(
+                f"""Cannot find routes with id {route_id},
+                maybe your databases (feed) are outdated?"""
+            )
+        return r.iloc[0]
+
+    def get_random_stop_id(self) -> int:
+        return choice(self.tables().stop_df.stop_id)
+
+    def get_stop(self, stop_id: int) -> "pd.Series":
+        """
+        :param stop_id: aka stop_code
+        :return: Series object with properties:
+        - stop_name
+        - transport_type
+        - stop_lat
+        - stop_lon
+        """
+        t = self.tables()
+        r = t.stop_df[t.stop_df.stop_id == stop_id]
+        if len(r) == 0:
+            raise ValueError(f"Cannot find stops with id {stop_id}")
+        return r.iloc[0]
+
+    def get_stop_coordinates(self, stop_ids: List[int]) -> List[Tuple[float, float]]:
+        """
+        :return: (lat, lon) of the stops in the same order, one lookup
+        for all of them, unlike get_stop()
+        """
+        t = self.tables()
+        s = t.stop_df[t.stop_df.stop_id.isin(stop_ids)].drop_duplicates("stop_id")
+        s = s.set_index("stop_id").reindex(stop_ids)
+        missing = s.index[s.stop_lat.isna()]
+        if len(missing):
+            raise ValueError(f"Cannot find stops with id {missing[0]}")
+        return list(zip(s.stop_lat.tolist(), s.stop_lon.tolist()))
+
+    def get_nearest_stops(self, lat: float, lon: float, n: int = 5) -> List[int]:
+        """
+        Function uses approximate distance estimation.
+        Error is about cos(max_lat)/cos(min_lat)
+        """
+        # Exact distance:
+        # 2*R * sin(dLat/2)^2 + sin(dLon/2)^2 * cos(lat1)*cos(lat2)
+        # Approximate distance:
+        # 2*R * (dLat/2)^2 + (dLon/2)^2 * cos(center_lat)^2 ==
+        # == 1/2 * dLat^2 + (dLon * cos(center_lat))^2
+        t = self.tables()
+        return list(t.stop_rtree_idx.nearest((lat, lon * t.koeff), num_results=n))
+
+    def get_stops_in_bbox(self, bbox: BBox) -> List[int]:
+        t = self.tables()
+        min_lat, min_lon, max_lat, max_lon = bbox
+        return list(
+            t.stop_rtree_idx.intersection(
+                (min_lat, min_lon * t.koeff, max_lat, max_lon * t.koeff)
+            )
+        )
+
+    def get_stops_by_route(self, route_id: int, direction_id: int) -> List[int]:
+        t = self.tables()
+        if not (t.trips_df.route_id == route_id).any():
+            raise ValueError(f"Cannot find trips for route_id={route_id}")
+        trip_ids = t.trips_df[
+            (t.trips_df.route_id == route_id)
+            & (t.trips_df.direction_id == direction_id)
+        ].trip_id.unique()
+        # There are different 'trip' records, but stops sequence doesn't
+        # depend on it. It depends only on route_id and direction_id. Difference
+        # between 'trip' records is in other fields like arrival_time.
+        # I checked it myself.
+        # So, let's use trip_ids[0]
+        stops = t.stop_times_df[t.stop_times_df.trip_id == trip_ids[0]]
+        ret = stops[["stop_id", "stop_sequence"]].sort_values("stop_sequence")
+        return list(ret.stop_id)
+
+    def get_route_shape(
+        self, route_id: int, direction_id: int
+    ) -> Optional[List[Tuple[float, float]]]:
+        t = self.tables()
+        if t.shapes_df is None or "shape_id" not in t.trips_df.columns:
+            return None
+        shape_ids = t.trips_df[
+            (t.trips_df.route_id == route_id)
+            & (t.trips_df.direction_id == direction_id)
+        ].shape_id.dropna()
+        if len(shape_ids) == 0:
+            return None
+        shape = t.shapes_df[t.shapes_df.shape_id == shape_ids.iloc[0]]
+        if len(shape) == 0:
+            return None
+        shape = shape.sort_values("shape_pt_sequence")
+        return list(zip(shape.shape_pt_lat.tolist(), shape.shape_pt_lon.tolist()))
+
+    def get_route_stats(self, route_id: int, direction_id: int) -> Optional[RouteStats]:
+        return self.tables().route_stats.get((route_id, direction_id))
+
+    def get_forecast(self, stop_id: int) -> List[Arrival]:
+        import requests
+
+        if self.forecast_url is None:
+            raise ValueError(f"there are no forecasts for the {self.name} feed")
+        offset = self.config.id_offset
+        d = requests.get(
+            self.forecast_url + str(stop_id - offset), timeout=FORECAST_TIMEOUT
+        )
+        if d.status_code != 200:
+            raise ValueError(f"forecast request failed: HTTP {d.status_code}")
+        arrivals = decode_forecast(d.content)
+        if offset:
+            arrivals = [a._replace(route_id=a.route_id + offset) for a in arrivals]
+        return arrivals
+
+    def search_stop_groups_by_name(
+        self, query: str, limit: int = 10
+    ) -> List[Tuple[int, int]]:
+        """:return: list of (score, group_id)"""
+        return self.name_index().search_by_name(query, limit)
+
+    def search_stop_groups_by_prefix(self, key: str, limit: int) -> List[tuple]:
+        """
+        :param key: normalized query, words joined with spaces
+        :return: sorted list of (rank, group_id), ranks of different
+        feeds are comparable
+        """
+        return self.name_index().search_by_prefix(key, limit)
+
+    def get_stop_group(self, group_id: int) -> StopGroup:
+        try:
+            return self.tables().stop_groups[group_id]
+        except KeyError:
+            raise ValueError(f"Cannot find stop group with id {group_id}")
+
+    def get_stop_group_by_stop(self, stop_id: int) -> StopGroup:
+        t = self.tables()
+        try:
+            return t.stop_groups[t.stop_group_by_stop[stop_id]]
+        except KeyError:
+            raise ValueError(f"Cannot find stops with id {stop_id}")
+
+    def get_routes_by_stop(self, stop_id: int) -> List[Tuple[int, int]]:
+        return list(self.tables().routes_by_stop.get(stop_id, []))
+
+    def get_neighbour_graph(self) -> "NeighbourGraph":
+        """Builds the graph of stops within walking_radius on the first call."""
+        from neighbours import NeighbourGraph
+
+        t = self.tables()
+        if t.neighbours is None:
+            logger.info(f"building {self.name} stop neighbourhood graph...")
+            s = t.stop_df
+            t.neighbours = NeighbourGraph(
+                s.stop_id.to_numpy(),
+                s.stop_lat.to_numpy(),
+                s.stop_lon.to_numpy(),
+                self.config.walking_radius,
+            )
+        return t.neighbours
+
+    def get_stop_neighbours(self, stop_id: int) -> List[Tuple[int, float]]:
+        """:return: [(stop_id, meters)] within walking_radius, nearest first"""
+        self.get_stop(stop_id)
+        return self.get_neighbour_graph().neighbours(stop_id)
+
+    def get_planner(self) -> "Planner":
+        """Compiles the journey planner on the first call."""
+        from planner import Planner
+
+        t = self.tables()
+        if t.planner is None:
+            # compiling takes seconds, the other threads wait for it
+            with self._planner_lock:
+                if t.planner is None:
+                    neighbours = self.get_neighbour_graph()
+                    logger.info(f"compiling {self.name} journey planner...")
+                    t.planner = Planner(
+                        t.stop_df, t.trips_df, t.stop_times_df, neighbours=neighbours
+                    )
+        return t.planner
+
+    def get_active_services(self, date: datetime) -> Optional[List[str]]:
+        """
+        :return: service_ids running on the date, None if the feed
+        has no calendar
+        """
+        c = self.tables().calendar_df
+        if c is None:
+            return None
+        weekday = date.strftime("%A").lower()
+        d = int(date.strftime("%Y%m%d"))
+        c = c[(c[weekday] == 1) & (c.start_date <= d) & (c.end_date >= d)]
+        return list(c.service_id.astype(str))
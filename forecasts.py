@@ -0,0 +1,388 @@
+"""
+Resilient access to the arrival forecasts.
+
+ForecastCache serves the last known forecast while it is refreshed in
+background (stale-while-revalidate), and CircuitBreaker stops calling
+the upstream API while it is failing. Prewarmer refreshes forecasts
+of the most popular stops before they expire.
+"""
+import json
+import time
+import heapq
+import logging
+import threading
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+# arrival times in the upstream API are local
+MSK = timezone(timedelta(hours=3))
+
+
+class Arrival(NamedTuple):
+    route_id: int
+    time: datetime
+
+    def minutes_until(self, now: Optional[datetime] = None) -> int:
+        now = now or datetime.now(MSK)
+        return max(0, int((self.time - now).total_seconds() // 60))
+
+
+def decode_forecast(raw: Union[bytes, str]) -> List[Arrival]:
+    """
+    Decodes upstream response, e.g.
+    {"success": true, "result": [{"routeId": "1347",
+    "arrivingTime": "2022-05-20 12:34:56", ...}, ...]}
+
+    :return: arrivals sorted by time
+    """
+    d = json.loads(raw)
+    if not d.get("success"):
+        raise ValueError(f"forecast request failed: {d!r:.200}")
+    ret = []
+    for p in d["result"]:
+        t = p["arrivingTime"]
+        # "YYYY-MM-DD HH:MM:SS", slicing is much faster than strptime
+        arrival_time = datetime(
+            int(t[0:4]),
+            int(t[5:7]),
+            int(t[8:10]),
+            int(t[11:13]),
+            int(t[14:16]),
+            int(t[17:19]),
+            tzinfo=MSK,
+        )
+        ret.append(Arrival(int(p["routeId"]), arrival_time))
+    ret.sort(key=lambda a: a.time)
+    return ret
+
+
+class ForecastUnavailable(Exception):
+    """There is no forecast to show: upstream fails and nothing is cached."""
+
+
+class CircuitOpenError(ForecastUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    """
+    After failure_threshold failures in a row the circuit opens and
+    calls are rejected for reset_timeout seconds. Then one probe call
+    is let through (half-open): success closes the circuit, failure
+    opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (
+                self.state == self.OPEN
+                and self.clock() - self._opened_at >= self.reset_timeout
+            ):
+                logger.info("circuit half-open, probing upstream")
+                self.state = self.HALF_OPEN
+                return True
+            # open, or half-open with the probe in flight
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("circuit closed")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"circuit opened after {self.failures} failures")
+                self.state = self.OPEN
+                self._opened_at = self.clock()
+
+    def call(self, func: Callable, *args):
+        if not self.allow():
+            raise CircuitOpenError("upstream is unavailable")
+        try:
+            ret = func(*args)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return ret
+
+
+class CachedForecast(NamedTuple):
+    """
+    :param age: seconds since the forecast was fetched
+    :param stale: the forecast is older than ttl, a newer one
+        is being fetched
+    """
+
+    data: Any
+    fetched_at: float
+    age: float
+    stale: bool = False
+
+
+class PopularityTracker:
+    """
+    Counts requests per stop, old requests are forgotten exponentially:
+    a request made half_life seconds ago counts as 1/2.
+    """
+
+    def __init__(
+        self, half_life: float = 600.0, clock: Callable[[], float] = time.monotonic
+    ):
+        self.half_life = half_life
+        self.clock = clock
+        self._scores: Dict[int, Tuple[float, float]] = {}  # stop -> (score, time)
+        self._lock = threading.Lock()
+
+    def _decayed(self, score: float, t: float, now: float) -> float:
+        return score * 0.5 ** ((now - t) / self.half_life)
+
+    def hit(self, stop_id: int):
+        now = self.clock()
+        with self._lock:
+            score, t = self._scores.get(stop_id, (0.0, now))
+            self._scores[stop_id] = (self._decayed(score, t, now) + 1, now)
+
+    def score(self, stop_id: int) -> float:
+        score, t = self._scores.get(stop_id, (0.0, 0.0))
+        return self._decayed(score, t, self.clock())
+
+    def top(self, k: int, min_score: float = 0.0) -> List[int]:
+        """:return: k most popular stop_ids with score at least min_score"""
+        now = self.clock()
+        with self._lock:
+            scores = [
+                (self._decayed(s, t, now), i) for i, (s, t) in self._scores.items()
+            ]
+            # forget stops nobody looks at
+            for score, i in scores:
+                if score < 0.01:
+                    del self._scores[i]
+        return [i for score, i in heapq.nlargest(k, scores) if score >= min_score]
+
+
+class ForecastCache:
+    """
+    :param fetch: requests the forecast for stop_id from upstream
+    :param ttl: forecast is fresh during ttl seconds
+    :param max_age: older forecasts are never shown
+    :param popularity: counts views of the stops, if given
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[int], Any],
+        ttl: float = 20.0,
+        max_age: float = 180.0,
+        breaker: Optional[CircuitBreaker] = None,
+        clock: Callable[[], float] = time.monotonic,
+        max_workers: int = 4,
+        popularity: Optional[PopularityTracker] = None,
+    ):
+        self.fetch = fetch
+        self.popularity = popularity
+        self.views = 0
+        # views served from cache without waiting for upstream
+        self.warm_views = 0
+        self.ttl = ttl
+        self.max_age = max_age
+        self.clock = clock
+        self.breaker = breaker or CircuitBreaker(clock=clock)
+        self._entries: Dict[int, tuple] = {}  # stop_id -> (data, fetched_at)
+        self._refreshing: Dict[int, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="forecast"
+        )
+
+    def get(self, stop_id: int) -> CachedForecast:
+        """
+        Blocks only if there is no forecast younger than max_age,
+        call it in a thread then (see is_cached).
+
+        :return: fresh forecast, or the last known one while a newer
+        one is fetched in background
+        :raise ForecastUnavailable: if there is nothing to show
+        """
+        self.views += 1
+        if self.popularity is not None:
+            self.popularity.hit(stop_id)
+        age = self.age(stop_id)
+        if age is None or age >= self.max_age:
+            return self.refresh(stop_id)
+        data, fetched_at = self._entries[stop_id]
+        if age < self.ttl:
+            self.warm_views += 1
+            return CachedForecast(data, fetched_at, age)
+        # the open circuit rejects the revalidation at once
+        self.revalidate(stop_id)
+        return CachedForecast(data, fetched_at, age, True)
+
+    def is_cached(self, stop_id: int) -> bool:
+        """:return: True if get() returns at once"""
+        age = self.age(stop_id)
+        return age is not None and age < self.max_age
+
+    def age(self, stop_id: int) -> Optional[float]:
+        """:return: age of the cached forecast, None if there is none"""
+        entry = self._entries.get(stop_id)
+        if entry is None:
+            return None
+        return self.clock() - entry[1]
+
+    def is_refreshing(self, stop_id: int) -> bool:
+        return stop_id in self._refreshing
+
+    def warm_ratio(self) -> float:
+        """:return: fraction of views served with a fresh cached forecast"""
+        return self.warm_views / self.views if self.views else 0.0
+
+    def revalidate(
+        self, stop_id: int, executor: Optional[ThreadPoolExecutor] = None
+    ) -> Future:
+        """
+        Refreshes forecast in background, once per stop at a time.
+
+        :param executor: runs the refresh instead of the cache's own one
+        :return: the refresh of the stop that is already in progress,
+            or the new one
+        """
+        with self._lock:
+            f = self._refreshing.get(stop_id)
+            if f is None:
+                f = (executor or self._executor).submit(self.refresh, stop_id)
+                self._refreshing[stop_id] = f
+                # called at once if the future is already done
+                f.add_done_callback(lambda _: self._refreshing.pop(stop_id, None))
+        return f
+
+    def refresh(self, stop_id: int) -> CachedForecast:
+        """Requests the forecast from upstream and caches it."""
+        try:
+            data = self.breaker.call(self.fetch, stop_id)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logger.warning(f"cannot get forecast for stop {stop_id}: {e!r}")
+            raise ForecastUnavailable(str(e)) from e
+        now = self.clock()
+        self._entries[stop_id] = (data, now)
+        return CachedForecast(data, now, 0.0)
+
+
+class Prewarmer:
+    """
+    Refreshes forecasts of top_k most popular stops shortly (lead
+    seconds) before they expire, so views of these stops are served
+    from cache. A stop has to be viewed at least min_score times
+    recently (see PopularityTracker) to be prewarmed.
+
+    Prewarming uses its own max_concurrency threads and is paused while
+    upstream is failing, so it doesn't slow down user requests.
+    """
+
+    def __init__(
+        self,
+        cache: ForecastCache,
+        popularity: PopularityTracker,
+        top_k: int = 30,
+        min_score: float = 2.0,
+        interval: float = 2.0,
+        lead: float = 5.0,
+        max_concurrency: int = 2,
+        report_interval: float = 600.0,
+    ):
+        self.cache = cache
+        self.popularity = popularity
+        self.top_k = top_k
+        self.min_score = min_score
+        self.interval = interval
+        self.lead = lead
+        self.report_interval = report_interval
+        self._budget = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="prewarm"
+        )
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.prewarmed = 0
+
+    def run_once(self) -> List[Future]:
+        """Starts refreshing the popular stops that are about to expire."""
+        if self.cache.breaker.state != CircuitBreaker.CLOSED:
+            return []
+        started = []
+        for stop_id in self.popularity.top(self.top_k, self.min_score):
+            age = self.cache.age(stop_id)
+            if age is not None and age < self.cache.ttl - self.lead:
+                continue
+            if self.cache.is_refreshing(stop_id):
+                continue
+            if not self._budget.acquire(blocking=False):
+                break
+            # shares the in-flight refreshes with the views of the stop
+            f = self.cache.revalidate(stop_id, self._executor)
+            f.add_done_callback(self._done)
+            started.append(f)
+        return started
+
+    def _done(self, f: Future):
+        self._budget.release()
+        if not f.cancelled() and f.exception() is None:
+            self.prewarmed += 1
+
+    def _run(self):
+        last_report = time.monotonic()
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("prewarming failed")
+            if time.monotonic() - last_report >= self.report_interval:
+                last_report = time.monotonic()
+                logger.info(
+                    f"forecast views: {self.cache.views}, "
+                    f"served warm: {self.cache.warm_ratio():.1%}, "
+                    f"prewarmed: {self.prewarmed}"
+                )
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,363 @@
+"""
+Dispatcher middlewares.
+
+CallbackDedupMiddleware collapses double taps: while a callback of
+some message is handled, the same callbacks of the message are
+answered at once and dropped. edit_if_changed() skips edits that
+would not change the message.
+
+AdmissionControl bounds the number of updates handled at once.
+
+ReadinessMiddleware answers "try later" while the data the handlers
+need is being loaded, so they never wait for it on the event loop.
+"""
+import time
+import json
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Deque,
+    Dict,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import MessageNotModified
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MessageKey = Tuple[int, int]  # (chat_id, message_id)
+
+
+def message_key(message: Optional[types.Message]) -> Optional[MessageKey]:
+    if message is None or message.chat is None:
+        return None
+    return (message.chat.id, message.message_id)
+
+
+class CallbackDedupMiddleware(BaseMiddleware):
+    """
+    :param max_age: seconds, handling that takes longer is considered
+        lost and doesn't block the button anymore
+    """
+
+    def __init__(self, max_age: float = 30.0):
+        super().__init__()
+        self.max_age = max_age
+        # (message, callback data) -> start time
+        self._in_flight: Dict[Tuple[MessageKey, str], float] = {}
+        self.collapsed = 0
+
+    def is_in_flight(self, key: Tuple[MessageKey, str]) -> bool:
+        started = self._in_flight.get(key)
+        return started is not None and time.monotonic() - started < self.max_age
+
+    async def on_pre_process_callback_query(
+        self, callback: types.CallbackQuery, data: dict
+    ):
+        message = message_key(callback.message)
+        if message is None:
+            return
+        key = (message, callback.data)
+        if self.is_in_flight(key):
+            self.collapsed += 1
+            await callback.answer()
+            raise CancelHandler()
+        self._in_flight[key] = time.monotonic()
+        data["callback_key"] = key
+
+    async def on_post_process_callback_query(
+        self, callback: types.CallbackQuery, results: list, data: dict
+    ):
+        key = data.get("callback_key")
+        if key is not None:
+            self._in_flight.pop(key, None)
+
+
+class LastRenders:
+    """Fingerprints of the last content of the edited messages."""
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._renders: "OrderedDict[MessageKey, str]" = OrderedDict()
+
+    def update(self, key: MessageKey, fingerprint: str) -> bool:
+        """:return: False if the message already has this content"""
+        if self._renders.get(key) == fingerprint:
+            self._renders.move_to_end(key)
+            return False
+        self._renders[key] = fingerprint
+        self._renders.move_to_end(key)
+        if len(self._renders) > self.maxsize:
+            self._renders.popitem(last=False)
+        return True
+
+    def forget(self, key: MessageKey):
+        self._renders.pop(key, None)
+
+
+last_renders = LastRenders()
+
+
+def _fingerprint(text: str, reply_markup, kwargs: dict) -> str:
+    markup = reply_markup.as_json() if reply_markup is not None else ""
+    return json.dumps([text, markup, sorted(kwargs.items())], ensure_ascii=False)
+
+
+async def edit_if_changed(
+    message: types.Message, text: str, reply_markup=None, **kwargs
+) -> bool:
+    """
+    Edits the text of the message unless it is the same as shown.
+
+    :return: True if the message was edited
+    """
+    key = message_key(message)
+    if key is not None and not last_renders.update(
+        key, _fingerprint(text, reply_markup, kwargs)
+    ):
+        return False
+    try:
+        await message.edit_text(text, reply_markup=reply_markup, **kwargs)
+    except MessageNotModified:
+        # e.g. the message was rendered before restart
+        return False
+    except Exception:
+        if key is not None:
+            last_renders.forget(key)
+        raise
+    return True
+
+
+class ClassLimits(NamedTuple):
+    """
+    :param concurrency: updates of the class handled at once
+    :param queue_size: updates waiting for their turn, the others
+        are shed
+    :param max_wait: seconds in the queue before the update is shed
+    :param degrade: instead of shedding, handle the update right away
+        in degraded (cheap) mode: the handler gets overloaded=True
+    """
+
+    concurrency: int
+    queue_size: int
+    max_wait: float
+    degrade: bool = False
+
+
+DEFAULT_LIMITS = {
+    "callback": ClassLimits(concurrency=8, queue_size=100, max_wait=10),
+    "command": ClassLimits(concurrency=4, queue_size=50, max_wait=10),
+    "location": ClassLimits(concurrency=4, queue_size=30, max_wait=5),
+    # fuzzy search is the most expensive one, the prefix search is cheap
+    "search": ClassLimits(concurrency=2, queue_size=10, max_wait=3, degrade=True),
+}
+
+TRY_AGAIN = "⏳ Сейчас слишком много запросов, попробуйте ещё раз через минуту"
+
+
+class _UpdateClass:
+    def __init__(self, limits: ClassLimits):
+        self.limits = limits
+        self.running = 0
+        self.waiting: Deque[asyncio.Future] = deque()
+        self.stats = {"admitted": 0, "queued": 0, "shed": 0, "degraded": 0}
+
+    async def acquire(self) -> bool:
+        """:return: True if got a slot, False if the update should be shed"""
+        if self.running < self.limits.concurrency and not self.waiting:
+            self.running += 1
+            return True
+        if len(self.waiting) >= self.limits.queue_size:
+            return False
+        self.stats["queued"] += 1
+        f = asyncio.get_running_loop().create_future()
+        self.waiting.append(f)
+        try:
+            await asyncio.wait_for(asyncio.shield(f), self.limits.max_wait)
+        except asyncio.TimeoutError:
+            if not f.done():
+                self.waiting.remove(f)
+                f.cancel()
+                return False
+        except asyncio.CancelledError:
+            if f.done():
+                # the slot was handed over, but nobody will use it
+                self.release()
+            else:
+                self.waiting.remove(f)
+                f.cancel()
+            raise
+        # the slot was handed over by release()
+        return True
+
+    def release(self):
+        while self.waiting:
+            f = self.waiting.popleft()
+            if not f.done():
+                f.set_result(None)
+                return
+        self.running -= 1
+
+
+class AdmissionControl(BaseMiddleware):
+    """
+    Bounded concurrency and queues per class of updates (callbacks,
+    commands, locations, searches), so a spike of expensive requests
+    doesn't slow down everything else. Every user may have at most
+    max_per_user updates being handled or queued.
+
+    Shed updates get a quick "try again" reply.
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, ClassLimits]] = None,
+        max_per_user: int = 3,
+        report_interval: float = 600.0,
+    ):
+        super().__init__()
+        self.max_per_user = max_per_user
+        self.report_interval = report_interval
+        self._classes = {
+            name: _UpdateClass(lim) for name, lim in (limits or DEFAULT_LIMITS).items()
+        }
+        self._per_user: Dict[int, int] = {}
+        self._last_report = time.monotonic()
+
+    @staticmethod
+    def classify(update: Any) -> Optional[str]:
+        """:return: class of the message or callback, None - not limited"""
+        if isinstance(update, types.CallbackQuery):
+            return "callback"
+        if update.location is not None:
+            return "location"
+        if update.text:
+            return "command" if update.is_command() else "search"
+        return None
+
+    async def _admit(self, update: Any, data: dict) -> bool:
+        """:return: False if the update is shed"""
+        name = self.classify(update)
+        if name is None or name not in self._classes or "admission" in data:
+            return True
+        c = self._classes[name]
+        user_id = update.from_user.id if update.from_user else 0
+        if self._per_user.get(user_id, 0) >= self.max_per_user:
+            c.stats["shed"] += 1
+            return False
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        admitted = False
+        try:
+            if await c.acquire():
+                c.stats["admitted"] += 1
+                data["admission"] = (name, user_id, True)
+            elif c.limits.degrade:
+                c.stats["degraded"] += 1
+                data["admission"] = (name, user_id, False)
+                data["overloaded"] = True
+            else:
+                c.stats["shed"] += 1
+                return False
+            admitted = True
+        finally:
+            # also if the update was cancelled while waiting in the queue
+            if not admitted:
+                self._release_user(user_id)
+        return True
+
+    def _release_user(self, user_id: int):
+        self._per_user[user_id] -= 1
+        if self._per_user[user_id] == 0:
+            del self._per_user[user_id]
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        if not await self._admit(message, data):
+            await message.reply(TRY_AGAIN)
+            raise CancelHandler()
+
+    async def on_process_callback_query(
+        self, callback: types.CallbackQuery, data: dict
+    ):
+        if not await self._admit(callback, data):
+            await callback.answer(TRY_AGAIN)
+            raise CancelHandler()
+
+    def _done(self, data: dict):
+        admission = data.pop("admission", None)
+        if admission is not None:
+            name, user_id, has_slot = admission
+            if has_slot:
+                self._classes[name].release()
+            self._release_user(user_id)
+        if time.monotonic() - self._last_report >= self.report_interval:
+            self._last_report = time.monotonic()
+            logger.info(f"admission control: {self.stats()}")
+
+    async def on_post_process_message(
+        self, message: types.Message, results: list, data: dict
+    ):
+        self._done(data)
+
+    async def on_post_process_callback_query(
+        self, callback: types.CallbackQuery, results: list, data: dict
+    ):
+        self._done(data)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """:return: {class: {running, waiting, admitted, queued, shed, degraded}}"""
+        return {
+            name: dict(running=c.running, waiting=len(c.waiting), **c.stats)
+            for name, c in self._classes.items()
+        }
+
+
+NOT_READY = "⏳ Бот загружается, попробуйте ещё раз через минуту"
+
+
+class ReadinessMiddleware(BaseMiddleware):
+    """
+    :param is_ready: returns True when the handlers can be called,
+        must be fast and never block
+    :param commands: commands handled before that, e.g. /start
+    """
+
+    def __init__(
+        self, is_ready: Callable[[], bool], commands: Collection[str] = ("start",)
+    ):
+        super().__init__()
+        self.is_ready = is_ready
+        self.commands = commands
+        self.rejected = 0
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        if self.is_ready() or message.get_command(pure=True) in self.commands:
+            return
+        self.rejected += 1
+        await message.reply(NOT_READY)
+        raise CancelHandler()
+
+    async def on_process_callback_query(
+        self, callback: types.CallbackQuery, data: dict
+    ):
+        if self.is_ready():
+            return
+        self.rejected += 1
+        await callback.answer(NOT_READY)
+        raise CancelHandler()
+
+    async def on_process_inline_query(self, query: types.InlineQuery, data: dict):
+        if self.is_ready():
+            return
+        self.rejected += 1
+        await query.answer([], cache_time=1)
+        raise CancelHandler()
@@ -0,0 +1,101 @@
+"""
+Stop neighbourhood graph: for every stop, the stops within walking
+radius with the distances to them, as CSR arrays.
+
+The graph is built with a grid join: stops are put into square
+cells of radius size, so the neighbours of a stop are in the 3x3
+cells around it. Candidate pairs of all stops are produced at once,
+one NumPy pass per cell offset.
+"""
+import math
+from typing import List, Tuple
+
+import numpy as np
+
+EARTH_RADIUS = 6371000  # meters
+
+
+def project(lat: np.ndarray, lon: np.ndarray, center_lat: float) -> np.ndarray:
+    """Equirectangular projection, meters"""
+    k = math.radians(1) * EARTH_RADIUS
+    return np.column_stack((lat * k, lon * k * math.cos(math.radians(center_lat))))
+
+
+def _expand_ranges(lo: np.ndarray, hi: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: (n, k) pairs: k takes all values of [lo[n], hi[n])
+    for every n, without a Python loop
+    """
+    counts = hi - lo
+    n = np.repeat(np.arange(len(lo)), counts)
+    starts = np.cumsum(counts) - counts
+    k = np.repeat(lo - starts, counts) + np.arange(counts.sum())
+    return n, k
+
+
+class NeighbourGraph:
+    """
+    :param stop_ids: the order of stops in the graph
+    :param radius: meters
+
+    Neighbours of stop number i are idx[ptr[i]:ptr[i + 1]] (indices
+    of stops in stop_ids), sorted by distance dist[ptr[i]:ptr[i + 1]].
+    """
+
+    def __init__(
+        self, stop_ids: np.ndarray, lat: np.ndarray, lon: np.ndarray, radius: float
+    ):
+        self.radius = radius
+        self.stop_ids = np.asarray(stop_ids)
+        self._stop_idx = {s: i for i, s in enumerate(self.stop_ids.tolist())}
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        n = len(self.stop_ids)
+        if n == 0:
+            self.ptr = np.zeros(1, dtype=np.int64)
+            self.idx = np.zeros(0, dtype=np.int32)
+            self.dist = np.zeros(0, dtype=np.float32)
+            return
+        xy = project(lat, lon, float((lat.max() + lat.min()) / 2))
+
+        cell = np.floor((xy - xy.min(axis=0)) / radius).astype(np.int64)
+        width = int(cell[:, 1].max()) + 3
+        key = cell[:, 0] * width + cell[:, 1]
+        order = np.argsort(key, kind="stable")
+        sorted_key = key[order]
+
+        src: List[np.ndarray] = []
+        dst: List[np.ndarray] = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                k = key + dx * width + dy
+                lo = np.searchsorted(sorted_key, k, "left")
+                hi = np.searchsorted(sorted_key, k, "right")
+                i, j = _expand_ranges(lo, hi)
+                src.append(i)
+                dst.append(order[j])
+        i = np.concatenate(src)
+        j = np.concatenate(dst)
+        d = np.hypot(*(xy[i] - xy[j]).T)
+        keep = (d <= radius) & (i != j)
+        i, j, d = i[keep], j[keep], d[keep]
+
+        by_stop_and_dist = np.lexsort((d, i))
+        i = i[by_stop_and_dist]
+        self.idx = j[by_stop_and_dist].astype(np.int32)
+        self.dist = d[by_stop_and_dist].astype(np.float32)
+        self.ptr = np.searchsorted(i, np.arange(n + 1))
+
+    def degree(self, i: int) -> int:
+        return int(self.ptr[i + 1] - self.ptr[i])
+
+    def neighbours(self, stop_id: int) -> List[Tuple[int, float]]:
+        """:return: [(stop_id, meters)] sorted by distance"""
+        i = self._stop_idx[stop_id]
+        s = slice(self.ptr[i], self.ptr[i + 1])
+        return list(zip(self.stop_ids[self.idx[s]].tolist(), self.dist[s].tolist()))
+
+    def memory_usage(self) -> int:
+        return (
+            self.ptr.nbytes + self.idx.nbytes + self.dist.nbytes + self.stop_ids.nbytes
+        )
@@ -0,0 +1,436 @@
+"""
+Journey planner over GTFS tables (RAPTOR, round-based).
+
+The feed is compiled once into arrays:
+
+- a *pattern* is a sequence of stops served by some trips of one
+  (route_id, direction_id); trips of a pattern are sorted by departure
+- for each pattern there are (n_trips, n_stops) arrays of arrival and
+  departure times in seconds since midnight of the service day
+- stop -> patterns and stop -> footpaths are CSR arrays, footpaths
+  come from the stop neighbourhood graph (neighbours.py)
+
+Round k of the search finds the earliest arrival at every stop using
+at most k vehicles, so the result is the set of journeys that are best
+by (arrival time, number of transfers).
+"""
+from typing import Optional, List, Tuple, Dict, NamedTuple, Iterable
+
+import numpy as np
+import pandas as pd
+
+from neighbours import NeighbourGraph, project
+
+
+INF = np.iinfo(np.int32).max
+
+
+class Leg(NamedTuple):
+    """
+    :param kind: "walk" or "ride"
+    :param from_stop: stop_id, None - from the origin location
+    :param to_stop: stop_id, None - to the destination location
+    :param departure: seconds since midnight
+    :param arrival: seconds since midnight
+    """
+
+    kind: str
+    from_stop: Optional[int]
+    to_stop: Optional[int]
+    departure: int
+    arrival: int
+    route_id: Optional[int] = None
+    direction_id: Optional[int] = None
+
+
+class Journey(NamedTuple):
+    legs: List[Leg]
+
+    @property
+    def departure(self) -> int:
+        return self.legs[0].departure
+
+    @property
+    def arrival(self) -> int:
+        return self.legs[-1].arrival
+
+    @property
+    def transfers(self) -> int:
+        return max(0, sum(1 for i in self.legs if i.kind == "ride") - 1)
+
+    def shifted(self, seconds: int) -> "Journey":
+        """:return: the same journey with all times moved by seconds"""
+        return Journey(
+            [
+                leg._replace(
+                    departure=leg.departure + seconds, arrival=leg.arrival + seconds
+                )
+                for leg in self.legs
+            ]
+        )
+
+
+def best_journeys(journeys: Iterable[Journey]) -> List[Journey]:
+    """
+    :return: the best journey by arrival for each number of transfers
+    that arrives earlier than with fewer transfers, like Planner.plan()
+    """
+    result: List[Journey] = []
+    for j in sorted(journeys, key=lambda j: (j.transfers, j.arrival)):
+        if not result or j.arrival < result[-1].arrival:
+            result.append(j)
+    return result
+
+
+def parse_gtfs_time(times: pd.Series) -> np.ndarray:
+    """'HH:MM:SS' (hours may be >= 24) -> seconds since midnight"""
+    t = times.str.split(":", expand=True).astype(np.int32)
+    return (t[0] * 3600 + t[1] * 60 + t[2]).to_numpy(dtype=np.int32)
+
+
+class Planner:
+    """
+    :param stops: DataFrame with stop_id, stop_lat, stop_lon
+    :param trips: DataFrame with trip_id, route_id, direction_id
+        and optional service_id
+    :param stop_times: DataFrame with trip_id, stop_id, stop_sequence,
+        arrival_time, departure_time
+    :param transfer_radius: max walking distance between stops, meters
+    :param walking_speed: m/s
+    :param neighbours: graph of the same stops to take footpaths
+        from, its radius is used as transfer_radius
+    """
+
+    def __init__(
+        self,
+        stops: pd.DataFrame,
+        trips: pd.DataFrame,
+        stop_times: pd.DataFrame,
+        transfer_radius: float = 300,
+        walking_speed: float = 1.2,
+        neighbours: Optional[NeighbourGraph] = None,
+    ):
+        self.transfer_radius = transfer_radius
+        self.walking_speed = walking_speed
+        self.stop_ids = stops.stop_id.to_numpy()
+        self._stop_idx = {s: i for i, s in enumerate(self.stop_ids.tolist())}
+        self._center_lat = float((stops.stop_lat.max() + stops.stop_lat.min()) / 2)
+        self._lat = stops.stop_lat.to_numpy()
+        self._lon = stops.stop_lon.to_numpy()
+        self._xy = project(self._lat, self._lon, self._center_lat)
+        self._compile_patterns(trips, stop_times)
+        self._compile_footpaths(neighbours)
+
+    def _compile_patterns(self, trips: pd.DataFrame, stop_times: pd.DataFrame):
+        st = stop_times[
+            ["trip_id", "stop_id", "stop_sequence", "arrival_time", "departure_time"]
+        ].sort_values(["trip_id", "stop_sequence"])
+        st = st[st.stop_id.isin(self._stop_idx)]
+        stop_idx = st.stop_id.map(self._stop_idx).to_numpy(dtype=np.int32)
+        arr = parse_gtfs_time(st.arrival_time)
+        dep = parse_gtfs_time(st.departure_time)
+        trip_ids = st.trip_id.to_numpy()
+        # boundaries of the trips in the sorted stop_times
+        starts = np.flatnonzero(np.r_[True, trip_ids[1:] != trip_ids[:-1]])
+        ends = np.r_[starts[1:], len(trip_ids)]
+
+        t = trips.set_index("trip_id").reindex(trip_ids[starts])
+        if "service_id" in t.columns:
+            services, trip_service = np.unique(
+                t.service_id.astype(str), return_inverse=True
+            )
+        else:
+            services = np.array(["default"])
+            trip_service = np.zeros(len(starts), dtype=np.int64)
+        self.services: List[str] = services.tolist()
+        # trips of a service day may run past midnight (times >= 24:00)
+        self.last_departure = int(dep.max()) if len(dep) else 0
+
+        patterns: Dict[Tuple, List[int]] = {}
+        for n, (route_id, direction_id, s, e) in enumerate(
+            zip(t.route_id.tolist(), t.direction_id.tolist(), starts, ends)
+        ):
+            key = (int(route_id), int(direction_id), stop_idx[s:e].tobytes())
+            patterns.setdefault(key, []).append(n)
+
+        self.pattern_route: List[Tuple[int, int]] = []
+        self.pattern_stops: List[np.ndarray] = []
+        self.pattern_arr: List[np.ndarray] = []
+        self.pattern_dep: List[np.ndarray] = []
+        self.pattern_service: List[np.ndarray] = []
+        for (route_id, direction_id, _), trip_nums in patterns.items():
+            s0 = starts[trip_nums[0]]
+            n_stops = ends[trip_nums[0]] - s0
+            rows = starts[trip_nums][:, None] + np.arange(n_stops)[None, :]
+            order = np.argsort(dep[rows[:, 0]], kind="stable")
+            rows = rows[order]
+            self.pattern_route.append((route_id, direction_id))
+            self.pattern_stops.append(stop_idx[s0 : s0 + n_stops])
+            self.pattern_arr.append(arr[rows])
+            self.pattern_dep.append(dep[rows])
+            service = trip_service[trip_nums][order]
+            self.pattern_service.append(service.astype(np.int32))
+
+        # stop -> (pattern, position in pattern), CSR
+        sp = [
+            (s, p, pos)
+            for p, stops in enumerate(self.pattern_stops)
+            for pos, s in enumerate(stops.tolist())
+        ]
+        sp.sort()
+        a = np.array(sp, dtype=np.int32).reshape(-1, 3)
+        self._sp_ptr = np.searchsorted(a[:, 0], np.arange(len(self.stop_ids) + 1))
+        self._sp_pattern = a[:, 1]
+        self._sp_pos = a[:, 2]
+
+    def _compile_footpaths(self, neighbours: Optional[NeighbourGraph]):
+        """stop -> stops within transfer_radius, CSR"""
+        if neighbours is None:
+            neighbours = NeighbourGraph(
+                self.stop_ids, self._lat, self._lon, self.transfer_radius
+            )
+        elif not np.array_equal(neighbours.stop_ids, self.stop_ids):
+            raise ValueError("neighbours are built for other stops")
+        self.transfer_radius = neighbours.radius
+        self._fp_ptr = neighbours.ptr
+        self._fp_idx = neighbours.idx
+        self._fp_time = (neighbours.dist / self.walking_speed).astype(np.int32)
+
+    def stops_near(
+        self, lat: float, lon: float, radius: Optional[float] = None
+    ) -> Dict[int, int]:
+        """
+        :return: {stop_id: walking time in seconds} for the stops
+        within radius (transfer_radius by default)
+        """
+        radius = radius or self.transfer_radius
+        p = project(np.array([lat]), np.array([lon]), self._center_lat)[0]
+        d = np.hypot(*(self._xy - p).T)
+        nb = np.flatnonzero(d <= radius)
+        return {
+            int(self.stop_ids[i]): int(d[i] / self.walking_speed) for i in nb.tolist()
+        }
+
+    def plan(
+        self,
+        origins: Dict[int, int],
+        destinations: Dict[int, int],
+        departure: int,
+        max_transfers: int = 4,
+        max_duration: int = 3 * 3600,
+        services: Optional[Iterable[str]] = None,
+    ) -> List[Journey]:
+        """
+        :param origins: {stop_id: walking time to the stop, seconds}
+        :param destinations: {stop_id: walking time from the stop, seconds}
+        :param departure: seconds since midnight
+        :param services: active service_ids, all trips if None
+        :return: journeys, the best by arrival for each number of
+        transfers that arrives earlier than with fewer transfers
+        """
+        n = len(self.stop_ids)
+        if services is None:
+            active = np.ones(len(self.services), dtype=bool)
+        else:
+            active = np.isin(self.services, list(services))
+        limit = departure + max_duration
+        targets = np.array(
+            [self._stop_idx[s] for s in destinations if s in self._stop_idx],
+            dtype=np.int32,
+        )
+        target_walk = np.array(
+            [destinations[s] for s in destinations if s in self._stop_idx],
+            dtype=np.int32,
+        )
+        best = np.full(n, INF, dtype=np.int32)
+        taus = [np.full(n, INF, dtype=np.int32)]
+        parents: List[Dict[int, tuple]] = [{}]
+        for s, walk in origins.items():
+            if s in self._stop_idx:
+                i = self._stop_idx[s]
+                if departure + walk < taus[0][i]:
+                    taus[0][i] = best[i] = departure + walk
+                    parents[0][i] = ("origin", walk)
+        marked = np.flatnonzero(taus[0] < INF)
+        # walking from the origin stops is allowed too
+        marked = np.union1d(
+            marked, self._relax_footpaths(taus[0], best, marked, parents[0])
+        )
+
+        for k in range(1, max_transfers + 2):
+            if len(marked) == 0:
+                break
+            prev = taus[-1]
+            tau = prev.copy()
+            parent: Dict[int, tuple] = {}
+            bound = self._target_bound(best, targets, target_walk, limit)
+            queue: Dict[int, int] = {}
+            for s in marked.tolist():
+                for j in range(self._sp_ptr[s], self._sp_ptr[s + 1]):
+                    p = self._sp_pattern[j]
+                    queue[p] = min(queue.get(p, INF), self._sp_pos[j])
+            improved: List[int] = []
+            for p, pos in queue.items():
+                improved += self._scan_pattern(
+                    p, pos, prev, tau, best, bound, active, limit, parent
+                )
+            marked = np.unique(np.array(improved, dtype=np.int32))
+            marked = np.union1d(
+                marked, self._relax_footpaths(tau, best, marked, parent)
+            )
+            taus.append(tau)
+            parents.append(parent)
+        return self._journeys(taus, parents, targets, target_walk, departure)
+
+    @staticmethod
+    def _target_bound(best, targets, target_walk, limit) -> int:
+        if len(targets) == 0:
+            return limit
+        return min(limit, int((best[targets].astype(np.int64) + target_walk).min()))
+
+    def _scan_pattern(
+        self, p, pos, prev, tau, best, bound, active, limit, parent
+    ) -> List[int]:
+        stops = self.pattern_stops[p][pos:]
+        first_dep = self.pattern_dep[p][:, 0]
+        rows = slice(0, np.searchsorted(first_dep, limit, side="right"))
+        dep = self.pattern_dep[p][rows, pos:]
+        arr = self.pattern_arr[p][rows, pos:]
+        n_trips = dep.shape[0]
+        if n_trips == 0:
+            return []
+        ok = (dep >= prev[stops][None, :]) & active[self.pattern_service[p][rows]][
+            :, None
+        ]
+        # the earliest trip that can be boarded at each stop
+        board = np.where(ok.any(axis=0), ok.argmax(axis=0), n_trips)
+        length = len(stops)
+        # trip in use when arriving at each stop and where it was boarded
+        key = np.minimum.accumulate(board * length + np.arange(length))
+        key = np.r_[n_trips * length, key[:-1]]
+        trip = key // length
+        board_pos = key % length
+        on_trip = np.flatnonzero(trip < n_trips)
+        if len(on_trip) == 0:
+            return []
+        arrival = np.full(length, INF, dtype=np.int32)
+        arrival[on_trip] = arr[trip[on_trip], on_trip]
+        better = np.flatnonzero(
+            (arrival < best[stops]) & (arrival < bound) & (arrival < tau[stops])
+        )
+        improved = []
+        for j in better.tolist():
+            s = stops[j]
+            if arrival[j] < tau[s]:
+                tau[s] = best[s] = arrival[j]
+                parent[s] = (
+                    "ride",
+                    p,
+                    int(trip[j]),
+                    pos + int(board_pos[j]),
+                    pos + j,
+                )
+                improved.append(s)
+        return improved
+
+    def _relax_footpaths(self, tau, best, marked, parent) -> np.ndarray:
+        if len(marked) == 0:
+            return np.array([], dtype=np.int32)
+        counts = self._fp_ptr[marked + 1] - self._fp_ptr[marked]
+        src = np.repeat(marked, counts)
+        j = np.concatenate(
+            [np.arange(self._fp_ptr[s], self._fp_ptr[s + 1]) for s in marked]
+        ).astype(np.int64)
+        if len(j) == 0:
+            return np.array([], dtype=np.int32)
+        dst = self._fp_idx[j]
+        t = tau[src].astype(np.int64) + self._fp_time[j]
+        improved = []
+        for s, d, time in zip(src.tolist(), dst.tolist(), t.tolist()):
+            if time < tau[d] and time < best[d]:
+                tau[d] = best[d] = time
+                parent[d] = ("walk", s)
+                improved.append(d)
+        return np.array(improved, dtype=np.int32)
+
+    def _journeys(self, taus, parents, targets, target_walk, departure):
+        journeys: List[Journey] = []
+        best_arrival = INF
+        for k in range(1, len(taus)):
+            if len(targets) == 0:
+                break
+            total = taus[k][targets].astype(np.int64) + target_walk
+            i = int(np.argmin(total))
+            if total[i] >= best_arrival or taus[k][targets[i]] >= INF:
+                continue
+            best_arrival = int(total[i])
+            legs = self._reconstruct(taus, parents, k, int(targets[i]), departure)
+            if legs is None:
+                continue
+            if target_walk[i] > 0:
+                legs.append(
+                    Leg(
+                        "walk",
+                        legs[-1].to_stop if legs else None,
+                        None,
+                        legs[-1].arrival if legs else departure,
+                        best_arrival,
+                    )
+                )
+            if len(legs) == 0:
+                # the origin is the destination
+                break
+            # may have no rides if walking all the way is the fastest
+            journeys.append(Journey(legs))
+        return journeys
+
+    def _reconstruct(self, taus, parents, k, s, departure) -> Optional[List[Leg]]:
+        legs: List[Leg] = []
+        while True:
+            par = parents[k].get(s)
+            if par is None:
+                # not improved in this round, look in the previous ones
+                if k == 0:
+                    return None
+                k -= 1
+                continue
+            if par[0] == "origin":
+                if par[1] > 0:
+                    legs.append(
+                        Leg("walk", None, self._sid(s), departure, departure + par[1])
+                    )
+                break
+            if par[0] == "walk":
+                src = par[1]
+                legs.append(
+                    Leg(
+                        "walk",
+                        self._sid(src),
+                        self._sid(s),
+                        int(taus[k][src]),
+                        int(taus[k][s]),
+                    )
+                )
+                s = src
+                continue
+            _, p, trip, board_pos, alight_pos = par
+            board_stop = int(self.pattern_stops[p][board_pos])
+            route_id, direction_id = self.pattern_route[p]
+            legs.append(
+                Leg(
+                    "ride",
+                    self._sid(board_stop),
+                    self._sid(s),
+                    int(self.pattern_dep[p][trip, board_pos]),
+                    int(self.pattern_arr[p][trip, alight_pos]),
+                    route_id,
+                    direction_id,
+                )
+            )
+            s = board_stop
+            k -= 1
+        legs.reverse()
+        return legs
+
+    def _sid(self, i: int) -> int:
+        return int(self.stop_ids[i])
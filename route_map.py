@@ -0,0 +1,166 @@
+"""
+Route map images, drawn with NumPy, without any tile service.
+
+RouteMapCache keeps rendered images on disk and Telegram file_ids of
+the sent ones, so every route is drawn once per feed version.
+"""
+import os
+import json
+import math
+import zlib
+import struct
+import threading
+from typing import Tuple, Optional, Sequence
+
+import numpy as np
+
+Point = Tuple[float, float]  # (lat, lon)
+
+BACKGROUND = (245, 243, 238)
+GRID = (228, 225, 218)
+CONTEXT_STOP = (200, 200, 200)
+LINE = (40, 110, 220)
+STOP_BORDER = (40, 40, 40)
+STOP_FILL = (255, 255, 255)
+FIRST_STOP = (30, 160, 60)
+LAST_STOP = (210, 40, 40)
+
+
+def encode_png(img: np.ndarray) -> bytes:
+    """:param img: (height, width, 3) uint8 array"""
+    h, w, _ = img.shape
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        c = struct.pack(">I", len(data)) + kind + data
+        return c + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    # every row starts with filter type 0 (none)
+    raw = np.hstack((np.zeros((h, 1), np.uint8), img.reshape(h, w * 3))).tobytes()
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+class Canvas:
+    """Maps (lat, lon) inside bbox onto an image of the given size."""
+
+    def __init__(self, points: Sequence[Point], size: int = 640, margin: int = 30):
+        lat = np.array([p[0] for p in points])
+        lon = np.array([p[1] for p in points])
+        self.k = math.cos(math.radians((lat.max() + lat.min()) / 2))
+        # a little bit more than a point for the one-stop routes
+        span = max(lat.max() - lat.min(), (lon.max() - lon.min()) * self.k, 1e-3)
+        self.scale = (size - 2 * margin) / span
+        self.lat0 = (lat.max() + lat.min()) / 2
+        self.lon0 = (lon.max() + lon.min()) / 2
+        self.size = size
+        self.img = np.empty((size, size, 3), np.uint8)
+        self.img[:] = BACKGROUND
+
+    def project(self, points: Sequence[Point]) -> np.ndarray:
+        """:return: (n, 2) array of (x, y) pixel coordinates"""
+        p = np.asarray(points, dtype=float).reshape(-1, 2)
+        x = (p[:, 1] - self.lon0) * self.k * self.scale + self.size / 2
+        y = (self.lat0 - p[:, 0]) * self.scale + self.size / 2
+        return np.column_stack((x, y))
+
+    def grid(self, step: int = 40):
+        self.img[::step, :] = GRID
+        self.img[:, ::step] = GRID
+
+    def discs(self, xy: np.ndarray, radius: float, color):
+        """Draws filled circles centered in xy."""
+        r = int(math.ceil(radius))
+        dy, dx = np.mgrid[-r : r + 1, -r : r + 1]
+        inside = dx**2 + dy**2 <= radius**2
+        dx, dy = dx[inside], dy[inside]
+        c = np.rint(xy).astype(int)
+        x = (c[:, 0:1] + dx[None, :]).ravel()
+        y = (c[:, 1:2] + dy[None, :]).ravel()
+        ok = (x >= 0) & (x < self.size) & (y >= 0) & (y < self.size)
+        self.img[y[ok], x[ok]] = color
+
+    def polyline(self, xy: np.ndarray, width: float, color):
+        """Draws a line through xy: discs stamped every half of a pixel."""
+        if len(xy) < 2:
+            return
+        seg = np.diff(xy, axis=0)
+        n = np.maximum(1, np.ceil(np.hypot(*seg.T) * 2)).astype(int)
+        t = np.concatenate([np.arange(k) / k for k in n])
+        start = np.repeat(xy[:-1], n, axis=0)
+        samples = start + np.repeat(seg, n, axis=0) * t[:, None]
+        self.discs(np.vstack((samples, xy[-1:])), width / 2, color)
+
+
+def render_route_map(
+    line: Sequence[Point],
+    stops: Sequence[Point],
+    context: Sequence[Point] = (),
+    size: int = 640,
+) -> bytes:
+    """
+    :param line: points of the route path (shape or just the stops)
+    :param stops: stops of the route in order
+    :param context: other stops to draw in gray, for orientation
+    :return: PNG image
+    """
+    c = Canvas(list(line) + list(stops), size=size)
+    c.grid()
+    if len(context):
+        c.discs(c.project(context), 1.5, CONTEXT_STOP)
+    c.polyline(c.project(line), 5, LINE)
+    xy = c.project(stops)
+    c.discs(xy, 5, STOP_BORDER)
+    c.discs(xy, 3.2, STOP_FILL)
+    c.discs(xy[:1], 7, FIRST_STOP)
+    c.discs(xy[-1:], 7, LAST_STOP)
+    return encode_png(c.img)
+
+
+class RouteMapCache:
+    """
+    Rendered maps are kept in directory/<feed_version>/, together with
+    file_ids.json: Telegram file_id of each already sent map.
+    """
+
+    def __init__(self, directory: str, feed_version: str):
+        self.directory = os.path.join(directory, feed_version)
+        os.makedirs(self.directory, exist_ok=True)
+        self._file_ids_path = os.path.join(self.directory, "file_ids.json")
+        self._lock = threading.Lock()
+        try:
+            with open(self._file_ids_path, "r") as f:
+                self._file_ids = json.loads(f.read())
+        except FileNotFoundError:
+            self._file_ids = {}
+
+    def path(self, route_id: int, direction: int) -> str:
+        return os.path.join(self.directory, f"{route_id}_{direction}.png")
+
+    def get_file_id(self, route_id: int, direction: int) -> Optional[str]:
+        return self._file_ids.get(f"{route_id}_{direction}")
+
+    def set_file_id(self, route_id: int, direction: int, file_id: str):
+        with self._lock:
+            self._file_ids[f"{route_id}_{direction}"] = file_id
+            tmp = self._file_ids_path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(json.dumps(self._file_ids))
+            os.replace(tmp, self._file_ids_path)
+
+    def get_or_render(self, route_id: int, direction: int, render) -> str:
+        """
+        :param render: returns PNG image, called if there is no file yet
+        :return: path to the image
+        """
+        path = self.path(route_id, direction)
+        if not os.path.exists(path):
+            png = render()
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(png)
+            os.replace(tmp, path)
+        return path
@@ -0,0 +1,112 @@
+"""
+Measures the journey planner on a synthetic network of the given size.
+
+The defaults are about the size of the SPb feed. Example:
+
+    python scripts/bench_planner.py --stops 7000 --trips 48000 -q 200
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from neighbours import NeighbourGraph  # noqa: E402
+from planner import Planner  # noqa: E402
+
+
+def synthetic_feed(n_stops: int, n_routes: int, n_trips: int, stops_per_trip: int):
+    """
+    :return: (stops, trips, stop_times) of random routes over stops
+    scattered in a city-sized box
+    """
+    rng = np.random.default_rng(0)
+    stops = pd.DataFrame(
+        {
+            "stop_id": np.arange(n_stops) + 1,
+            "stop_lat": 59.8 + rng.random(n_stops) * 0.25,
+            "stop_lon": 30.1 + rng.random(n_stops) * 0.45,
+        }
+    )
+    # a route goes along a random walk over nearby stops
+    order = np.argsort(stops.stop_lat.to_numpy() + stops.stop_lon.to_numpy())
+    route_stops = []
+    for _ in range(n_routes):
+        first = rng.integers(0, n_stops - stops_per_trip * 4)
+        steps = rng.integers(1, 5, stops_per_trip)
+        route_stops.append(order[first + np.cumsum(steps)] + 1)
+
+    route = rng.integers(0, n_routes, n_trips)
+    direction = rng.integers(0, 2, n_trips)
+    start = rng.integers(5 * 3600, 25 * 3600, n_trips)
+    trips = pd.DataFrame(
+        {
+            "trip_id": np.arange(n_trips),
+            "route_id": route,
+            "direction_id": direction,
+            "service_id": "all",
+        }
+    )
+    stop_ids = np.array([route_stops[r] for r in route])
+    stop_ids[direction == 1] = stop_ids[direction == 1][:, ::-1]
+    times = start[:, None] + np.arange(stops_per_trip)[None, :] * 120
+    hms = pd.Series(times.ravel())
+    hms = (
+        (hms // 3600).map("{:02}".format)
+        + ":"
+        + (hms // 60 % 60).map("{:02}".format)
+        + ":"
+        + (hms % 60).map("{:02}".format)
+    )
+    stop_times = pd.DataFrame(
+        {
+            "trip_id": np.repeat(np.arange(n_trips), stops_per_trip),
+            "stop_id": stop_ids.ravel(),
+            "stop_sequence": np.tile(np.arange(stops_per_trip) + 1, n_trips),
+            "arrival_time": hms,
+            "departure_time": hms,
+        }
+    )
+    return stops, trips, stop_times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--stops", type=int, default=7000)
+    parser.add_argument("--routes", type=int, default=400)
+    parser.add_argument("--trips", type=int, default=48000)
+    parser.add_argument("--stops-per-trip", type=int, default=25)
+    parser.add_argument("-q", type=int, default=100, help="number of queries")
+    args = parser.parse_args()
+
+    stops, trips, stop_times = synthetic_feed(
+        args.stops, args.routes, args.trips, args.stops_per_trip
+    )
+    print(f"{len(stops)} stops, {len(trips)} trips, {len(stop_times)} stop times")
+
+    t = time.perf_counter()
+    graph = NeighbourGraph(
+        stops.stop_id.to_numpy(),
+        stops.stop_lat.to_numpy(),
+        stops.stop_lon.to_numpy(),
+        300,
+    )
+    graph_time = time.perf_counter() - t
+    t = time.perf_counter()
+    planner = Planner(stops, trips, stop_times, neighbours=graph)
+    compile_time = time.perf_counter() - t
+    print(f"neighbour graph: {graph_time:.2f} s, planner compile: {compile_time:.2f} s")
+
+    rng = np.random.default_rng(1)
+    durations = []
+    for _ in range(args.q):
+        a, b = rng.choice(stops.stop_id.to_numpy(), 2, replace=False)
+        t = time.perf_counter()
+        planner.plan({int(a): 0}, {int(b): 0}, int(rng.integers(7, 20)) * 3600)
+        durations.append(time.perf_counter() - t)
+    p50, p95 = np.percentile(durations, [50, 95]) * 1000
+    print(f"query: p50 {p50:.0f} ms, p95 {p95:.0f} ms")
@@ -0,0 +1,325 @@
+"""
+Replays recorded and synthetic updates into the bot dispatcher.
+
+Telegram is replaced with a stubbed Bot and the forecast API with a local
+stub server, so the whole run is offline. Example:
+
+    python scripts/load_test.py -n 2000 -c 50 --latency 0.2 --bot-latency 0.05 \
+        --recorded saved_messages.jsonl
+"""
+import os
+import sys
+import json
+import time
+import types as pytypes
+import random
+import asyncio
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, Any, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+try:
+    import bot_conf  # noqa: F401
+except ImportError:
+    # The bot is stubbed, so any well-formed token is enough
+    _conf = pytypes.ModuleType("bot_conf")
+    _conf.BOT_TOKEN = "123456789:AAHdqTcvCH1vGWJxfSeofSAs0K5PALDsaw0"  # type: ignore
+    sys.modules["bot_conf"] = _conf
+
+from aiogram import Bot, Dispatcher, types  # noqa: E402
+
+import data  # noqa: E402
+import bot_aiogram  # noqa: E402
+from forecasts import MSK  # noqa: E402
+from middlewares import AdmissionControl  # noqa: E402
+from log_messages import iter_all_messages  # noqa: E402
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SEARCH_QUERIES = ["невский", "московская", "пр. культуры", "нарвская", "садовая"]
+SAMPLE_STOPS = [15495, 2080]
+SAMPLE_LOCATION = (59.928048, 30.348679)
+
+
+class StubForecastHandler(BaseHTTPRequestHandler):
+    """Answers with an arrival in a few minutes for each route of the stop."""
+
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        stop_id = int(self.path.rsplit("=", 1)[1])
+        now = datetime.now(MSK)
+        result = [
+            {
+                "routeId": str(route_id),
+                "arrivingTime": (now + timedelta(minutes=3 + 4 * n)).strftime(
+                    "%Y-%m-%d %H:%M:%S"
+                ),
+            }
+            for n, (route_id, _) in enumerate(data.get_routes_by_stop(stop_id))
+        ]
+        body = json.dumps({"success": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_forecast_server(latency: float) -> ThreadingHTTPServer:
+    """Starts the stub server in a daemon thread and points data.py to it."""
+    handler = type("Handler", (StubForecastHandler,), {"latency": latency})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    data.default_feed().forecast_url = (
+        f"http://127.0.0.1:{port}/forecast/bystop?stopID="
+    )
+    return server
+
+
+def _stub_message(chat_id: int, message_id: int = 1) -> Dict[str, Any]:
+    return {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "LoadTest"},
+    }
+
+
+class StubRequest:
+    """
+    Replacement for Bot.request: answers like Telegram, without network.
+
+    :param latency: round trip to Telegram, seconds
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def __call__(self, method: str, payload=None, files=None) -> Any:
+        await asyncio.sleep(self.latency)
+        return _stub_response(method, payload or {})
+
+
+def _stub_response(method: str, payload: Dict[str, Any]) -> Any:
+    if method in ("answerCallbackQuery", "deleteMessage", "answerInlineQuery"):
+        return True
+    chat_id = int(payload.get("chat_id", 0) or 0)
+    msg = _stub_message(chat_id, int(payload.get("message_id", 1) or 1))
+    if "text" in payload:
+        msg["text"] = payload["text"]
+    return msg
+
+
+def user(uid: int) -> Dict[str, Any]:
+    return {"id": uid, "is_bot": False, "first_name": "LoadTest"}
+
+
+def text_update(uid: int, text: str) -> Dict[str, Any]:
+    return {"message": dict(_stub_message(uid), text=text)}
+
+
+def location_update(uid: int, lat: float, lon: float) -> Dict[str, Any]:
+    m = _stub_message(uid)
+    m["location"] = {"latitude": lat, "longitude": lon}
+    return {"message": m}
+
+
+def callback_update(uid: int, cb_data: str) -> Dict[str, Any]:
+    return {
+        "callback_query": {
+            "id": str(random.getrandbits(48)),
+            "from": user(uid),
+            "chat_instance": str(uid),
+            "data": cb_data,
+            "message": dict(_stub_message(uid), text="..."),
+        }
+    }
+
+
+def synthetic_update(uid: int, mix: Dict[str, float]) -> Tuple[str, Dict[str, Any]]:
+    """:return: (kind, update without update_id)"""
+    kind = random.choices(list(mix), weights=list(mix.values()))[0]
+    if kind == "search":
+        return kind, text_update(uid, random.choice(SEARCH_QUERIES))
+    if kind == "location":
+        lat, lon = SAMPLE_LOCATION
+        jitter = (random.uniform(-0.02, 0.02), random.uniform(-0.02, 0.02))
+        return kind, location_update(uid, lat + jitter[0], lon + jitter[1])
+    stop_id = random.choice(SAMPLE_STOPS)
+    cb_data = random.choice(
+        [
+            f"BusStopMsgBlock refresh {stop_id}",
+            f"SearchStopsMsgBlock group {data.get_stop_group_by_stop(stop_id).group_id}",
+            "common pass",
+        ]
+    )
+    return "callback", callback_update(uid, cb_data)
+
+
+def load_recorded(path: str) -> List[Tuple[str, Dict[str, Any]]]:
+    """Reads messages saved by scripts/log_messages.py, the rotated
+    backups too, and wraps them into updates. Messages the bot doesn't
+    handle (stickers, photos, etc) are skipped."""
+    ret = []
+    for m in iter_all_messages(path):
+        # the same classes as in admission control
+        kind = AdmissionControl.classify(types.Message(**m))
+        if kind is not None:
+            ret.append((kind, {"message": m}))
+    return ret
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    s = sorted(values)
+    k = min(len(s) - 1, max(0, int(round(p / 100 * (len(s) - 1)))))
+    return s[k]
+
+
+async def monitor_loop_lag(lags: List[float], stop: asyncio.Event, interval=0.01):
+    """Measures how late the event loop wakes up after a sleep."""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        t = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - t - interval)
+
+
+async def run(
+    dp: Dispatcher,
+    updates: List[Tuple[str, Dict[str, Any]]],
+    concurrency: int,
+    rate: Optional[float],
+) -> Dict[str, Any]:
+    latencies: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    lags: List[float] = []
+    stop = asyncio.Event()
+    sem = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def one(n: int, kind: str, upd: Dict[str, Any], t: float):
+        # latency is counted from arrival, so it includes queueing
+        async with sem:
+            update = types.Update(update_id=n, **upd)
+            try:
+                await dp.process_update(update)
+            except Exception:
+                logger.warning("update failed", exc_info=True)
+                errors[kind] = errors.get(kind, 0) + 1
+            latencies.setdefault(kind, []).append(loop.time() - t)
+
+    lag_task = asyncio.create_task(monitor_loop_lag(lags, stop))
+    started = loop.time()
+    tasks = []
+    for n, (kind, upd) in enumerate(updates):
+        tasks.append(asyncio.create_task(one(n, kind, upd, loop.time())))
+        if rate:
+            await asyncio.sleep(1 / rate)
+    await asyncio.gather(*tasks)
+    elapsed = loop.time() - started
+    stop.set()
+    await lag_task
+    return {
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "errors": errors,
+        "lags": lags,
+    }
+
+
+def print_report(res: Dict[str, Any]):
+    total = sum(len(v) for v in res["latencies"].values())
+    print(f"updates: {total}, elapsed: {res['elapsed']:.2f} s")
+    print(f"throughput: {total / res['elapsed']:.1f} updates/s")
+    print(f"{'kind':<10}{'count':>8}{'errors':>8}{'p50':>9}{'p90':>9}{'p99':>9}")
+    all_lat = []
+    for kind, lat in sorted(res["latencies"].items()):
+        all_lat += lat
+        print(
+            f"{kind:<10}{len(lat):>8}{res['errors'].get(kind, 0):>8}"
+            + "".join(f"{percentile(lat, p) * 1000:>7.0f}ms" for p in (50, 90, 99))
+        )
+    print(
+        f"{'all':<10}{len(all_lat):>8}{sum(res['errors'].values()):>8}"
+        + "".join(f"{percentile(all_lat, p) * 1000:>7.0f}ms" for p in (50, 90, 99))
+    )
+    lags = res["lags"]
+    print(
+        "event loop lag: "
+        + ", ".join(f"p{p}={percentile(lags, p) * 1000:.0f}ms" for p in (50, 99))
+        + f", max={max(lags, default=0) * 1000:.0f}ms"
+    )
+    print("admission control:")
+    for kind, stats in bot_aiogram.admission.stats().items():
+        print(f"  {kind:<10}" + ", ".join(f"{k}={v}" for k, v in stats.items()))
+
+
+def parse_mix(s: str) -> Dict[str, float]:
+    mix = {}
+    for part in s.split(","):
+        k, v = part.split("=")
+        mix[k.strip()] = float(v)
+    if not set(mix).issubset({"search", "location", "callback"}):
+        raise argparse.ArgumentTypeError(f"unknown update kind in {s}")
+    return mix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay recorded and synthetic updates into the dispatcher"
+    )
+    parser.add_argument("-n", type=int, default=500, help="number of updates")
+    parser.add_argument(
+        "-c", type=int, default=20, help="max updates processed concurrently"
+    )
+    parser.add_argument("--rate", type=float, help="updates per second (default: max)")
+    parser.add_argument("--users", type=int, default=100, help="distinct users")
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default="search=0.3,location=0.2,callback=0.5",
+        help="ratios of synthetic update kinds",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.1, help="stub forecast latency, s"
+    )
+    parser.add_argument(
+        "--bot-latency", type=float, default=0.05, help="Telegram round trip, s"
+    )
+    parser.add_argument("--recorded", metavar="file", help="recorded messages")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    random.seed(args.seed)
+    start_stub_forecast_server(args.latency)
+    bot_aiogram.bot.request = StubRequest(args.bot_latency)  # type: ignore
+    Bot.set_current(bot_aiogram.bot)
+    Dispatcher.set_current(bot_aiogram.dp)
+
+    # loading is not what is measured
+    data.ensure_loaded()
+    recorded = load_recorded(args.recorded) if args.recorded else []
+    updates = []
+    for i in range(args.n):
+        if recorded and random.random() < 0.5:
+            updates.append(random.choice(recorded))
+        else:
+            updates.append(synthetic_update(random.randrange(args.users), args.mix))
+    res = asyncio.run(run(bot_aiogram.dp, updates, args.c, args.rate))
+    print_report(res)
@@ -1,56 +1,210 @@
+import os
 import json
+import time
+import queue
+import asyncio
 import logging
 import argparse
+import threading
+from typing import Iterator, Dict, Any, List, Optional
 
-from aiogram import Bot, Dispatcher, executor, types, filters
+from aiogram import Bot, Dispatcher, executor, types
 
 logging.basicConfig(level=logging.INFO)
 
-
-BOT_TOKEN = None
-with open("../bot_conf.py", "r") as f:
-    for line in f:
-        if line.find("BOT_TOKEN") >= 0:
-            assert line.startswith("BOT_TOKEN")
-            assert line.count("'") == 2
-            BOT_TOKEN = line.split("'")[1]
-            break
-    else:
-        raise ValueError("Bot token not found")
+logger = logging.getLogger(__name__)
 
 SAVE_ALL = False
-OUT_FILE = "saved_messages.json"
+OUT_FILE = "saved_messages.jsonl"
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+def read_bot_token(path: str = "../bot_conf.py") -> str:
+    with open(path, "r") as f:
+        for line in f:
+            if line.find("BOT_TOKEN") >= 0:
+                assert line.startswith("BOT_TOKEN")
+                assert line.count("'") == 2
+                return line.split("'")[1]
+    raise ValueError("Bot token not found")
+
+
+class MessageRecorder:
+    """
+    Appends messages to a newline-delimited JSON file.
+
+    Writing is done by a background thread in batches, so recording
+    never blocks the event loop and costs O(1) per message.
+
+    :param fsync: "always" - fsync after every batch,
+        "interval" - at most once per fsync_interval seconds,
+        "never" - leave it to the OS
+    :param max_bytes: rotate the file when it grows bigger (0 - never);
+        old files are renamed to path.1, path.2, ... path.backup_count
+    """
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        fsync: str = "interval",
+        fsync_interval: float = 5.0,
+        max_bytes: int = 0,
+        backup_count: int = 5,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}")
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.written = 0
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._file = open(path, "a", encoding="utf-8")
+        self._last_fsync = time.monotonic()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def record(self, message: Dict[str, Any]):
+        """Enqueues message, never blocks."""
+        self._queue.put(json.dumps(message, ensure_ascii=False))
+
+    def close(self):
+        """Writes everything enqueued and closes the file."""
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch: List[str] = []
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+        self._sync(force=True)
+
+    def _write(self, batch: List[str]):
+        self._file.write("\n".join(batch) + "\n")
+        self.written += len(batch)
+        self._sync()
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _sync(self, force: bool = False):
+        self._file.flush()
+        now = time.monotonic()
+        if (
+            force
+            or self.fsync == "always"
+            or (
+                self.fsync == "interval"
+                and now - self._last_fsync >= self.fsync_interval
+            )
+        ):
+            if self.fsync != "never":
+                os.fsync(self._file.fileno())
+            self._last_fsync = now
+
+    def _rotate(self):
+        self._sync(force=True)
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+
+def iter_messages(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Reads saved messages one by one.
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(bot)
+    Supports newline-delimited JSON and the old format (one JSON list).
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == "[":
+            yield from json.loads(f.read())
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def message_files(path: str) -> List[str]:
+    """
+    :return: backups rotated by MessageRecorder, oldest first,
+    then the file itself
+    """
+    n = 0
+    while os.path.exists(f"{path}.{n + 1}"):
+        n += 1
+    files = [f"{path}.{i}" for i in range(n, 0, -1)]
+    if os.path.exists(path) or not files:
+        files.append(path)
+    return files
+
+
+def iter_all_messages(path: str) -> Iterator[Dict[str, Any]]:
+    """Reads saved messages from the file and its backups, oldest first."""
+    for i in message_files(path):
+        yield from iter_messages(i)
+
+
+recorder: Optional[MessageRecorder] = None
+
+# one message and its prompt at a time, so the answer is for that message
+_prompt_lock = asyncio.Lock()
 
 
-@dp.message_handler()
 async def log_message(message: types.Message):
-    global SAVE_ALL
-    print("Received message:")
-    print(message)
-    if SAVE_ALL or input("Save? [y]/n:").strip() in ["", "y"]:
-        save_message(message)
+    async with _prompt_lock:
+        print("Received message:")
+        print(message)
+        if not SAVE_ALL:
+            # input() must not block the event loop
+            loop = asyncio.get_running_loop()
+            answer = await loop.run_in_executor(None, input, "Save? [y]/n:")
+            if answer.strip() not in ["", "y"]:
+                return
+    save_message(message)
 
 
 def save_message(message: types.Message):
-    msgs = []
-    try:
-        f = open(OUT_FILE, "r")
-        msgs = json.loads(f.read())
-    except FileNotFoundError:
-        pass
-    msgs.append(json.loads(str(message)))
-    with open(OUT_FILE, "w") as f:
-        f.write(json.dumps(msgs))
+    assert recorder is not None
+    recorder.record(message.to_python())
 
 
 def print_messages():
-    with open(OUT_FILE, "r") as f:
-        msgs = json.loads(f.read())
-        for i in msgs:
-            print(types.Message(**i))
+    for i in iter_all_messages(OUT_FILE):
+        print(types.Message(**i))
 
 
 if __name__ == "__main__":
@@ -61,12 +215,31 @@ if __name__ == "__main__":
     parser.add_argument(
         "-a", action="store_true", help="save all messages without prompt"
     )
-    parser.add_argument("--output", metavar="file", type=str, help="output file")
+    parser.add_argument(
+        "--output", metavar="file", type=str, default=OUT_FILE, help="output file"
+    )
+    parser.add_argument(
+        "--fsync", choices=FSYNC_POLICIES, default="interval", help="fsync policy"
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        default=64 * 1024 * 1024,
+        help="rotate output file at this size, 0 - never",
+    )
     args = parser.parse_args()
+    OUT_FILE = args.output
     if args.list:
         print_messages()
         exit()
 
     SAVE_ALL = args.a
-    OUT_FILE = args.output
-    executor.start_polling(dp, skip_updates=True)
+    recorder = MessageRecorder(OUT_FILE, fsync=args.fsync, max_bytes=args.max_bytes)
+    bot = Bot(token=read_bot_token())
+    dp = Dispatcher(bot)
+    dp.register_message_handler(log_message, content_types=types.ContentTypes.ANY)
+    try:
+        executor.start_polling(dp, skip_updates=True)
+    finally:
+        recorder.close()
+        logger.info(f"{recorder.written} messages saved to {OUT_FILE}")
@@ -1,17 +1,30 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pandas as pd
 import pytest
 from aiogram.types import InlineKeyboardMarkup
 
+import bot_aiogram
+from forecasts import MSK, Arrival
 from bot_aiogram import (
     get_forecast_by_stop,
+    forecast_to_text,
+    get_trip_point,
+    pop_trip_point,
+    set_trip_point,
     stop_info,
+    favourites_message,
     make_keyboard,
+    make_paginator,
 )
 
 
 def test_get_forecast_by_stop():
     f = get_forecast_by_stop(15495)
-    assert f["success"]
-    assert f["result"]
+    assert f
+    assert all(isinstance(a, Arrival) for a in f)
+    assert [a.time for a in f] == sorted(a.time for a in f)
 
 
 def test_stop_info():
@@ -21,6 +34,64 @@ def test_stop_info():
         assert stop_info(i)
 
 
+def test_forecast_to_text(monkeypatch):
+    route = pd.Series({"transport_type": "bus", "route_short_name": "3"})
+    monkeypatch.setattr(bot_aiogram, "get_route", lambda route_id: route)
+    now = datetime.now(MSK)
+    arrivals = [
+        Arrival(1, now - timedelta(minutes=2)),
+        Arrival(1, now + timedelta(minutes=5, seconds=30)),
+    ]
+    text = forecast_to_text(arrivals)
+    # the bus that has already passed is not shown
+    assert text.count("\n") == 1 and "(5 мин)" in text
+    assert "⚠️" not in text
+    assert "⚠️ данные получены 2 мин. назад" in forecast_to_text(arrivals, 90)
+    assert "не найдено" in forecast_to_text(arrivals[:1])
+
+
+def test_trip_points(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot_aiogram.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(bot_aiogram, "MAX_TRIP_POINTS", 2)
+    set_trip_point(1, "s15495")
+    assert get_trip_point(1) == "s15495"
+    assert pop_trip_point(1) == "s15495"
+    assert get_trip_point(1) is None
+    # the point is forgotten after a while
+    set_trip_point(1, "s15495")
+    now[0] += bot_aiogram.TRIP_POINT_TTL + 1
+    assert get_trip_point(1) is None
+    # and the oldest points are dropped
+    for user_id in [1, 2, 3]:
+        set_trip_point(user_id, "s2080")
+    assert get_trip_point(1) is None
+    assert get_trip_point(3) == "s2080"
+
+
+def test_favourites_message_removed_stop(monkeypatch):
+    class Favourites:
+        async def get(self, user_id):
+            return [15495, 99999]
+
+    def get_stop(stop_id):
+        if stop_id == 99999:
+            raise ValueError(f"Cannot find stops with id {stop_id}")
+        return pd.Series({"stop_name": "Пл. Восстания"})
+
+    def info(stop_id):
+        get_stop(stop_id)
+        return "*Пл. Восстания*\n3 — 5 мин\n", None
+
+    monkeypatch.setattr(bot_aiogram, "favourites", Favourites())
+    monkeypatch.setattr(bot_aiogram, "get_stop", get_stop)
+    monkeypatch.setattr(bot_aiogram, "stop_info", info)
+    msg = asyncio.run(favourites_message(1))
+    assert "*99999*\n_прогноз недоступен_" in msg["text"]
+    buttons = [row[0].text for row in msg["reply_markup"].inline_keyboard[:2]]
+    assert buttons == ["Пл. Восстания", "99999"]
+
+
 def test_make_keyboard():
     # TODO: use pytest parametrising
     buttons_lists = [
@@ -67,3 +138,28 @@ def test_make_keyboard():
             make_keyboard([], columns=c)
         with pytest.raises(ValueError):
             make_keyboard(buttons_lists[-1], columns=c)
+
+
+@pytest.mark.parametrize("count", [20, 100, 10000])
+def test_make_paginator_resolves_only_current_page(count):
+    calls = []
+
+    def item(i):
+        calls.append(i)
+        return (f"item {i}", f"cb {i}")
+
+    msg, kbd = make_paginator(count, item, "prev", "next", cur_page=1, page_size=10)
+    assert calls == list(range(10, 20))
+    assert "*11.* item 10" in msg
+    assert f"_11 - 20 из {count}_" in msg
+    assert kbd.inline_keyboard[0][0].callback_data == "cb 10"
+
+
+def test_make_paginator_last_page():
+    msg, kbd = make_paginator(
+        25, lambda i: (str(i), str(i)), "prev", "next", cur_page=2, page_size=10
+    )
+    assert "_21 - 25 из 25_" in msg
+    ctrls = kbd.inline_keyboard[-1]
+    assert ctrls[0].callback_data == "prev"
+    assert ctrls[-1].callback_data == "common pass"
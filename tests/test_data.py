@@ -8,6 +8,12 @@ from data import (
     geo_dist,
     get_nearest_stops,
     get_stops_by_route,
+    get_routes_by_stop,
+    get_stop_group,
+    get_stop_group_by_stop,
+    search_stop_groups_by_name,
+    search_stop_groups_by_prefix,
+    normalize_name,
 )
 
 
@@ -167,3 +173,39 @@ def test_get_stops_by_route():
 def test_get_stops_by_route_errors():
     with pytest.raises(ValueError):
         get_stops_by_route(312, 0)
+
+
+def test_stop_groups():
+    g = get_stop_group_by_stop(2080)
+    assert g.name == 'ст. метро "московская"'
+    assert 2080 in g.stop_ids
+    assert get_stop_group(g.group_id) == g
+    for i in g.stop_ids:
+        assert get_stop(i).stop_name.lower() == g.name
+    # bus 114
+    assert (1347, 0) in g.routes
+    assert set(get_routes_by_stop(2080)).issubset(g.routes)
+    with pytest.raises(ValueError):
+        get_stop_group(-1)
+    with pytest.raises(ValueError):
+        get_stop_group_by_stop(12345)
+
+
+def test_search_stop_groups_by_name():
+    res = search_stop_groups_by_name('ст. метро "московская"')
+    assert res[0] == get_stop_group_by_stop(2080).group_id
+
+
+def test_normalize_name():
+    assert normalize_name('СТ. МЕТРО "МОСКОВСКАЯ"') == ["ст", "метро", "московская"]
+    assert normalize_name("Щёлково, ул.") == ["щелково", "ул"]
+
+
+def test_search_stop_groups_by_prefix():
+    group_id = get_stop_group_by_stop(2080).group_id
+    assert group_id in search_stop_groups_by_prefix("моск")
+    assert group_id in search_stop_groups_by_prefix("метро моск")
+    assert search_stop_groups_by_prefix('Ст. метро "Московская"')[0] == group_id
+    assert search_stop_groups_by_prefix("") == []
+    assert search_stop_groups_by_prefix("qwertyuiop") == []
+    assert len(search_stop_groups_by_prefix("с", limit=5)) == 5
@@ -0,0 +1,51 @@
+import asyncio
+
+from favourites import FavouritesStore, MAX_FAVOURITES
+
+
+def test_favourites_store(tmp_path):
+    path = str(tmp_path / "fav.sqlite")
+
+    async def fill():
+        store = FavouritesStore(path, flush_interval=0.01)
+        assert await store.get(1) == []
+        assert await store.add(1, 15495)
+        assert await store.add(1, 2080)
+        assert await store.add(1, 2080)
+        assert await store.add(2, 2080)
+        await store.remove(1, 15495)
+        # the cache is updated before the write is committed
+        assert await store.get(1) == [2080]
+        await asyncio.sleep(0.05)
+        await store.close()
+
+    async def read():
+        store = FavouritesStore(path)
+        ret = (await store.get(1), await store.get(2), await store.get(3))
+        await store.close()
+        return ret
+
+    asyncio.run(fill())
+    assert asyncio.run(read()) == ([2080], [2080], [])
+
+
+def test_favourites_limit(tmp_path):
+    # not in numeric order, all are committed in one batch
+    stops = [15495 - 1000 * i if i % 2 else 100 + i for i in range(MAX_FAVOURITES)]
+
+    async def run():
+        store = FavouritesStore(str(tmp_path / "fav.sqlite"))
+        for i in stops:
+            assert await store.add(1, i)
+        assert not await store.add(1, 12345)
+        await store.close()
+        store = FavouritesStore(str(tmp_path / "fav.sqlite"))
+        assert await store.get(1) == stops
+        await store.remove(1, stops[0])
+        assert await store.add(1, stops[0])
+        await store.close()
+        store = FavouritesStore(str(tmp_path / "fav.sqlite"))
+        assert await store.get(1) == stops[1:] + stops[:1]
+        await store.close()
+
+    asyncio.run(run())
@@ -0,0 +1,186 @@
+import pandas as pd
+import pytest
+
+import data
+from feeds import Feed, FeedConfig, FEED_ID_SPAN, compute_route_stats
+
+
+def write_feed(directory, lat, lon):
+    """Two stops and a route between them near (lat, lon)."""
+    directory.mkdir()
+    (directory / "routes.txt").write_text(
+        "route_id,route_short_name,route_long_name,transport_type\n"
+        "7,7,Туда - Сюда,bus\n"
+    )
+    (directory / "stops.txt").write_text(
+        "stop_id,stop_name,stop_lat,stop_lon,transport_type\n"
+        f"1,Вокзал,{lat},{lon},bus\n"
+        f"2,Площадь,{lat + 0.01},{lon + 0.01},bus\n"
+    )
+    (directory / "trips.txt").write_text(
+        "route_id,service_id,trip_id,direction_id\n7,1,t1,0\n"
+    )
+    (directory / "stop_times.txt").write_text(
+        "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+        "t1,08:00:00,08:00:00,1,1\n"
+        "t1,08:10:00,08:10:00,2,2\n"
+    )
+
+
+@pytest.fixture
+def two_feeds(tmp_path, monkeypatch):
+    write_feed(tmp_path / "spb", 59.9, 30.3)
+    write_feed(tmp_path / "msk", 55.7, 37.6)
+    spb = Feed(FeedConfig("spb", str(tmp_path / "spb")), pinned=True)
+    msk = Feed(FeedConfig("msk", str(tmp_path / "msk"), id_offset=FEED_ID_SPAN))
+    monkeypatch.setattr(data, "_feeds", [spb, msk])
+    data._search_stop_groups_by_prefix.cache_clear()
+    yield spb, msk
+    data._search_stop_groups_by_prefix.cache_clear()
+
+
+def test_feed_ids(two_feeds):
+    spb, msk = two_feeds
+    assert not spb.loaded and not msk.loaded
+    assert data.get_stop(1).stop_name == "Вокзал"
+    assert data.get_stop(FEED_ID_SPAN + 2).stop_name == "Площадь"
+    assert data.get_stops_by_route(FEED_ID_SPAN + 7, 0) == [
+        FEED_ID_SPAN + 1,
+        FEED_ID_SPAN + 2,
+    ]
+    assert data.get_routes_by_stop(FEED_ID_SPAN + 1) == [(FEED_ID_SPAN + 7, 0)]
+    # the stops are more than 1 km apart
+    assert data.get_stop_neighbours(FEED_ID_SPAN + 1) == []
+    group = data.get_stop_group_by_stop(FEED_ID_SPAN + 1)
+    assert msk.contains_id(group.group_id)
+    assert data.get_stop_group(group.group_id).stop_ids == [FEED_ID_SPAN + 1]
+    assert sorted(data.search_stop_groups_by_prefix("вокз")) == [
+        data.get_stop_group_by_stop(1).group_id,
+        group.group_id,
+    ]
+    with pytest.raises(ValueError):
+        data.get_stop(5 * FEED_ID_SPAN)
+
+
+def test_stop_coordinates(two_feeds):
+    assert data.get_stop_coordinates([FEED_ID_SPAN + 2, 1, FEED_ID_SPAN + 2]) == [
+        (55.71, 37.61),
+        (59.9, 30.3),
+        (55.71, 37.61),
+    ]
+    assert data.get_stop_coordinates([]) == []
+    with pytest.raises(ValueError):
+        data.get_stop_coordinates([1, 3])
+
+
+def test_feed_by_location(two_feeds):
+    spb, msk = two_feeds
+    assert data.get_nearest_stops(55.71, 37.61, n=1) == [FEED_ID_SPAN + 2]
+    assert data.get_nearest_stops(59.9, 30.3, n=1) == [1]
+    # outside of all feeds: the nearest one
+    assert data.get_feed_by_location(56, 38) is msk
+    # the bounding box is known without loading the feed
+    msk.unload()
+    assert Feed(msk.config).bbox() == msk.bbox()
+    assert data.get_feed_by_location(55.7, 37.6) is msk
+    assert not msk.loaded
+
+
+def test_feed_eviction(two_feeds, monkeypatch):
+    spb, msk = two_feeds
+    data.get_stop(1)
+    data.get_stop(FEED_ID_SPAN + 1)
+    usage = data.memory_usage()
+    assert set(usage) == {"spb", "msk"} and all(i > 0 for i in usage.values())
+
+    # there is memory only for one feed, the pinned one stays loaded
+    monkeypatch.setattr(data, "MAX_FEEDS_MEMORY", usage["spb"])
+    data.evict_feeds()
+    assert spb.loaded and not msk.loaded
+    assert data.memory_usage() == {"spb": usage["spb"]}
+    # and the evicted one is loaded again when needed
+    assert data.get_stop(FEED_ID_SPAN + 1).stop_name == "Вокзал"
+    assert msk.loaded
+
+
+def test_search_unloaded_feed(two_feeds, monkeypatch):
+    spb, msk = two_feeds
+    data.get_stop(1)
+    data.get_stop(FEED_ID_SPAN + 1)
+    monkeypatch.setattr(data, "MAX_FEEDS_MEMORY", spb.memory_usage())
+    data.evict_feeds()
+    assert not msk.loaded
+    # the name index stays in memory, searches don't load the feed
+    found = data.search_stop_groups_by_prefix("площ")
+    assert sorted(found) == [
+        data.get_stop_group_by_stop(2).group_id,
+        FEED_ID_SPAN + data.get_stop_group_by_stop(2).group_id,
+    ]
+    assert sorted(data.search_stop_groups_by_name("площадь")[:2]) == sorted(found)
+    assert not msk.loaded
+
+
+def test_name_index_after_restart(two_feeds, monkeypatch):
+    spb, msk = two_feeds
+    group_id = data.get_stop_group_by_stop(FEED_ID_SPAN + 2).group_id
+    # a new process: the saved index is used, the feed isn't loaded
+    msk = Feed(msk.config)
+    monkeypatch.setattr(data, "_feeds", [spb, msk])
+    assert msk.name_indexed and not msk.loaded
+    assert group_id in data.search_stop_groups_by_prefix("площ")
+    assert not msk.loaded
+    # the feed files are updated: the index is stale
+    stops = msk.config.directory + "/stops.txt"
+    with open(stops, "a") as f:
+        f.write("3,Рынок,55.72,37.62,bus\n")
+    assert not Feed(msk.config).name_indexed
+
+
+def test_bbox_in_config(two_feeds):
+    spb, msk = two_feeds
+    bbox = (55.6, 37.5, 55.8, 37.7)
+    feed = Feed(msk.config._replace(bbox=bbox))
+    assert feed.bbox() == bbox and not feed.loaded
+
+
+def test_feed_eviction_after_planner(two_feeds, monkeypatch):
+    spb, msk = two_feeds
+    data.get_stop(1)
+    data.get_stop(FEED_ID_SPAN + 1)
+    usage = data.memory_usage()
+    monkeypatch.setattr(data, "MAX_FEEDS_MEMORY", sum(usage.values()))
+    # the planner and the neighbour graph are counted once built
+    data.get_planner(spb)
+    assert spb.memory_usage() > usage["spb"]
+    assert spb.loaded and not msk.loaded
+
+
+def test_route_stats():
+    # route 1: every 10 minutes 07:00-08:00, then every 30 minutes until 11:00
+    # on weekdays, and a few trips on weekends
+    deps = [7 * 60 + 10 * i for i in range(7)] + [8 * 60 + 30 * i for i in range(1, 7)]
+    rows = [("wd", 1, 0, m) for m in deps] + [("we", 1, 0, 9 * 60), ("we", 1, 0, 600)]
+    # route 2 runs after midnight
+    rows += [("wd", 2, 1, 23 * 60 + 40), ("wd", 2, 1, 24 * 60 + 10)]
+    trips = pd.DataFrame(
+        [(f"t{n}", s, r, d) for n, (s, r, d, _) in enumerate(rows)],
+        columns=["trip_id", "service_id", "route_id", "direction_id"],
+    )
+    stop_times = pd.DataFrame(
+        [
+            (f"t{n}", seq, f"{(m + seq) // 60:02}:{(m + seq) % 60:02}:00")
+            for n, (_, _, _, m) in enumerate(rows)
+            for seq in (2, 1)
+        ],
+        columns=["trip_id", "stop_sequence", "departure_time"],
+    )
+    stats = compute_route_stats(trips, stop_times)
+    assert set(stats) == {(1, 0), (2, 1)}
+    s = stats[(1, 0)]
+    assert s.trips == 13
+    assert s.first_departure == (7 * 60 + 1) * 60
+    assert s.last_departure == (11 * 60 + 1) * 60
+    assert s.headways == (600, 1800, None, None)
+    s = stats[(2, 1)]
+    assert s.trips == 2 and s.last_departure == (24 * 60 + 11) * 60
+    assert s.headways == (None, None, None, None)
@@ -0,0 +1,251 @@
+import json
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from forecasts import (
+    MSK,
+    Arrival,
+    decode_forecast,
+    CircuitBreaker,
+    CircuitOpenError,
+    ForecastCache,
+    ForecastUnavailable,
+    PopularityTracker,
+    Prewarmer,
+)
+
+
+class FaultyUpstream:
+    """Local forecast server, fails while `failing` is set."""
+
+    def __init__(self):
+        self.failing = False
+        self.requests = 0
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                upstream.requests += 1
+                if upstream.failing:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                body = json.dumps({"success": True, "result": []}).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/?stopID="
+
+    def fetch(self, stop_id):
+        r = requests.get(self.url + str(stop_id), timeout=1)
+        if r.status_code != 200:
+            raise ValueError(f"HTTP {r.status_code}")
+        return r.json()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def upstream():
+    u = FaultyUpstream()
+    yield u
+    u.server.shutdown()
+
+
+def test_circuit_breaker_opens_and_recovers(upstream):
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10, clock=clock)
+    cache = ForecastCache(upstream.fetch, breaker=breaker, clock=clock)
+    upstream.failing = True
+    for i in range(3):
+        with pytest.raises(ForecastUnavailable):
+            cache.get(i)
+    assert breaker.state == CircuitBreaker.OPEN
+    # upstream is not called while the circuit is open
+    with pytest.raises(CircuitOpenError):
+        cache.get(1)
+    assert upstream.requests == 3
+    # failed probe opens the circuit again
+    clock.now = 10
+    with pytest.raises(ForecastUnavailable):
+        cache.get(1)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert upstream.requests == 4
+    # successful probe closes it
+    upstream.failing = False
+    clock.now = 20
+    assert cache.get(1).data["success"]
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert cache.get(2).data["success"]
+
+
+def test_stale_while_revalidate(upstream):
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=clock)
+    cache = ForecastCache(
+        upstream.fetch, ttl=20, max_age=180, breaker=breaker, clock=clock
+    )
+    assert not cache.is_cached(15495)
+    f = cache.get(15495)
+    assert not f.stale
+    clock.now = 10
+    assert cache.get(15495).age == 10
+    assert upstream.requests == 1
+
+    # expired: served at once and revalidated in background
+    clock.now = 100
+    assert cache.is_cached(15495)
+    f = cache.get(15495)
+    assert f.stale and f.age == 100
+    cache.revalidate(15495).result()
+    f = cache.get(15495)
+    assert not f.stale and f.fetched_at == 100
+    assert upstream.requests == 2
+
+    # upstream fails: the last known forecast is served with its age
+    upstream.failing = True
+    for now in [150, 160]:
+        clock.now = now
+        f = cache.get(15495)
+        assert f.stale and f.age == now - 100
+        with pytest.raises(ForecastUnavailable):
+            cache.revalidate(15495).result()
+    assert breaker.state == CircuitBreaker.OPEN
+    # the circuit is open, upstream is not called
+    clock.now = 170
+    assert cache.get(15495).stale
+    with pytest.raises(CircuitOpenError):
+        cache.revalidate(15495).result()
+    assert upstream.requests == 4
+
+    # too old forecasts are not shown
+    clock.now = 1000
+    assert not cache.is_cached(15495)
+    with pytest.raises(ForecastUnavailable):
+        cache.get(15495)
+
+
+def test_slow_upstream_doesnt_block_cached():
+    clock = Clock()
+    gate = threading.Event()
+    gate.set()
+
+    def fetch(stop_id):
+        assert gate.wait(5)
+        return {"success": True, "result": []}
+
+    cache = ForecastCache(fetch, ttl=20, clock=clock)
+    cache.get(1)
+    gate.clear()
+    clock.now = 30
+    # returns while the revalidation waits for upstream
+    assert cache.get(1).stale
+    assert cache.is_refreshing(1)
+    gate.set()
+    cache.revalidate(1).result()
+    assert not cache.get(1).stale
+
+
+def test_popularity_tracker():
+    clock = Clock()
+    p = PopularityTracker(half_life=100, clock=clock)
+    for i in range(8):
+        p.hit(15495)
+    for i in range(3):
+        p.hit(2080)
+    assert p.top(1) == [15495]
+    assert p.score(15495) == pytest.approx(8)
+    clock.now = 100
+    assert p.score(15495) == pytest.approx(4)
+    for i in range(3):
+        p.hit(2080)
+    # 2080: 3/2 + 3 > 8/2
+    assert p.top(2) == [2080, 15495]
+    assert p.top(2, min_score=4.2) == [2080]
+
+
+def test_prewarmer():
+    clock = Clock()
+    fetched = []
+    gate = threading.Event()
+    gate.set()
+
+    def fetch(stop_id):
+        gate.wait()
+        fetched.append(stop_id)
+        return {"success": True, "result": []}
+
+    popularity = PopularityTracker(clock=clock)
+    cache = ForecastCache(fetch, ttl=20, clock=clock, popularity=popularity)
+    prewarmer = Prewarmer(
+        cache, popularity, top_k=3, min_score=1.5, lead=5, max_concurrency=1
+    )
+    for stop_id in [1, 1, 1, 2, 2, 3]:
+        cache.get(stop_id)
+    assert cache.warm_ratio() == pytest.approx(3 / 6)
+    fetched.clear()
+
+    # nothing is about to expire
+    clock.now = 10
+    assert prewarmer.run_once() == []
+    # the concurrency budget is not exceeded
+    clock.now = 16
+    gate.clear()
+    started = prewarmer.run_once()
+    assert len(started) == 1
+    assert prewarmer.run_once() == []
+    # a view of the stop being prewarmed waits for the same refresh
+    assert cache.is_refreshing(1)
+    assert cache.revalidate(1) is started[0]
+    gate.set()
+    started[0].result()
+    for f in prewarmer.run_once():
+        f.result()
+    # only the top stops are refreshed, the stop viewed once is not
+    assert sorted(fetched) == [1, 2]
+    assert prewarmer.prewarmed == 2
+    clock.now = 25
+    cache.get(1)
+    cache.get(2)
+    assert cache.warm_views == 5
+    prewarmer.stop()
+
+
+def test_decode_forecast():
+    raw = json.dumps(
+        {
+            "success": True,
+            "result": [
+                {"routeId": "1347", "arrivingTime": "2022-05-20 12:34:56"},
+                {"routeId": "306", "arrivingTime": "2022-05-20 12:30:00"},
+            ],
+        }
+    )
+    a = decode_forecast(raw)
+    assert a == [
+        Arrival(306, datetime(2022, 5, 20, 12, 30, tzinfo=MSK)),
+        Arrival(1347, datetime(2022, 5, 20, 12, 34, 56, tzinfo=MSK)),
+    ]
+    now = datetime(2022, 5, 20, 12, 20, 30, tzinfo=MSK)
+    assert [i.minutes_until(now) for i in a] == [9, 14]
+    assert a[0].minutes_until(datetime(2022, 5, 20, 13, 0, tzinfo=MSK)) == 0
+    assert decode_forecast('{"success": true, "result": []}') == []
+    with pytest.raises(ValueError):
+        decode_forecast('{"success": false}')
@@ -0,0 +1,139 @@
+import os
+import sys
+import json
+import time
+import asyncio
+
+import pytest
+from aiogram import types
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+)
+
+import log_messages  # noqa: E402
+from log_messages import MessageRecorder, iter_messages, iter_all_messages  # noqa: E402
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_recorder_batches(tmp_path):
+    path = str(tmp_path / "messages.jsonl")
+    r = MessageRecorder(path, batch_size=3, flush_interval=10, fsync="never")
+    for i in range(7):
+        r.record({"n": i})
+    # full batches are written at once, the rest waits for flush_interval
+    wait_for(lambda: r.written == 6)
+    time.sleep(0.05)
+    assert r.written == 6
+    r.close()
+    assert r.written == 7
+    assert [m["n"] for m in iter_messages(path)] == list(range(7))
+
+
+def test_recorder_rotation(tmp_path):
+    path = str(tmp_path / "messages.jsonl")
+    r = MessageRecorder(
+        path, batch_size=1, flush_interval=0.01, max_bytes=30, backup_count=2
+    )
+    for i in range(20):
+        r.record({"text": "x" * 10, "n": i})
+    r.close()
+    names = sorted(os.listdir(tmp_path))
+    assert names == ["messages.jsonl", "messages.jsonl.1", "messages.jsonl.2"]
+    kept = [m["n"] for m in iter_all_messages(path)]
+    # the oldest files are dropped
+    assert kept == list(range(20))[-len(kept) :]
+    assert os.path.getsize(path + ".1") >= 30
+
+
+@pytest.mark.parametrize(
+    "policy, expected", [("always", 4), ("interval", 1), ("never", 0)]
+)
+def test_recorder_fsync(tmp_path, monkeypatch, policy, expected):
+    synced = []
+    monkeypatch.setattr(log_messages.os, "fsync", synced.append)
+    r = MessageRecorder(
+        str(tmp_path / "messages.jsonl"),
+        batch_size=1,
+        flush_interval=0.01,
+        fsync=policy,
+        fsync_interval=60,
+    )
+    for i in range(3):
+        r.record({"n": i})
+        wait_for(lambda: r.written == i + 1)
+    r.close()
+    # "interval" syncs on close only, "always" also after each batch
+    assert len(synced) == expected
+    with pytest.raises(ValueError):
+        MessageRecorder(str(tmp_path / "other.jsonl"), fsync="sometimes")
+
+
+def test_iter_messages(tmp_path):
+    ndjson = tmp_path / "new.jsonl"
+    ndjson.write_text('{"n": 1}\n\n{"n": 2}\n', encoding="utf-8")
+    assert list(iter_messages(str(ndjson))) == [{"n": 1}, {"n": 2}]
+    old = tmp_path / "old.json"
+    old.write_text('\n [{"n": 1}, {"n": 2}]', encoding="utf-8")
+    assert list(iter_messages(str(old))) == [{"n": 1}, {"n": 2}]
+
+
+def test_iter_all_messages(tmp_path):
+    path = tmp_path / "messages.jsonl"
+    (tmp_path / "messages.jsonl.2").write_text('{"n": 1}\n')
+    (tmp_path / "messages.jsonl.1").write_text('[{"n": 2}]')
+    path.write_text('{"n": 3}\n')
+    assert [m["n"] for m in iter_all_messages(str(path))] == [1, 2, 3]
+    # just rotated, nothing recorded since
+    path.unlink()
+    assert [m["n"] for m in iter_all_messages(str(path))] == [1, 2]
+    with pytest.raises(FileNotFoundError):
+        list(iter_all_messages(str(tmp_path / "other.jsonl")))
+
+
+def test_prompts_one_at_a_time(tmp_path, monkeypatch):
+    events = []
+    answers = {"1": "y", "2": "n", "3": ""}
+
+    def fake_print(*args):
+        if isinstance(args[0], types.Message):
+            events.append(("message", args[0].text))
+
+    def fake_input(prompt):
+        # the user reads the screen and answers about the last message
+        time.sleep(0.02)
+        n = events[-1][1]
+        events.append(("input", n))
+        return answers[n]
+
+    monkeypatch.setattr("builtins.print", fake_print)
+    monkeypatch.setattr("builtins.input", fake_input)
+    monkeypatch.setattr(log_messages, "SAVE_ALL", False)
+    path = str(tmp_path / "messages.jsonl")
+    monkeypatch.setattr(log_messages, "recorder", MessageRecorder(path))
+
+    async def run():
+        await asyncio.gather(
+            *[
+                log_messages.log_message(
+                    types.Message(
+                        message_id=int(n),
+                        date=0,
+                        chat={"id": 1, "type": "private"},
+                        text=n,
+                    )
+                )
+                for n in answers
+            ]
+        )
+
+    asyncio.run(run())
+    log_messages.recorder.close()
+    assert events == [(kind, n) for n in answers for kind in ["message", "input"]]
+    assert [m["text"] for m in iter_messages(path)] == ["1", "3"]
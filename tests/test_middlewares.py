@@ -0,0 +1,292 @@
+import asyncio
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.utils.exceptions import MessageNotModified
+
+from middlewares import (
+    AdmissionControl,
+    CallbackDedupMiddleware,
+    ClassLimits,
+    LastRenders,
+    NOT_READY,
+    ReadinessMiddleware,
+    TRY_AGAIN,
+    edit_if_changed,
+)
+
+TOKEN = "123456789:AAHdqTcvCH1vGWJxfSeofSAs0K5PALDsaw0"
+
+
+def callback_update(update_id: int, message_id: int, data: str) -> types.Update:
+    return types.Update(
+        update_id=update_id,
+        callback_query={
+            "id": str(update_id),
+            "from": {"id": 1, "is_bot": False, "first_name": "A"},
+            "chat_instance": "1",
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": 0,
+                "chat": {"id": 1, "type": "private"},
+                "text": "Обновить",
+            },
+        },
+    )
+
+
+def make_bot(sent: list, not_modified=False) -> Bot:
+    bot = Bot(token=TOKEN)
+
+    async def request(method, data=None, *args, **kwargs):
+        sent.append((method, data))
+        if not_modified and method == "editMessageText":
+            raise MessageNotModified("message is not modified")
+        if method == "sendMessage":
+            return {"message_id": 100, "date": 0, "chat": {"id": 1, "type": "private"}}
+        return True
+
+    bot.request = request  # type: ignore
+    return bot
+
+
+def test_callback_dedup():
+    sent: list = []
+    calls = []
+
+    async def run():
+        bot = make_bot(sent)
+        dp = Dispatcher(bot)
+        Bot.set_current(bot)
+        dedup = CallbackDedupMiddleware()
+        dp.middleware.setup(dedup)
+        release = asyncio.Event()
+
+        @dp.callback_query_handler()
+        async def handler(callback: types.CallbackQuery):
+            calls.append(callback.data)
+            await release.wait()
+            await callback.answer()
+
+        first = asyncio.create_task(dp.process_update(callback_update(1, 10, "a")))
+        await asyncio.sleep(0)
+        # double tap is dropped
+        await dp.process_update(callback_update(2, 10, "a"))
+        # other buttons of the message and other messages are not affected
+        button = asyncio.create_task(dp.process_update(callback_update(3, 10, "b")))
+        other = asyncio.create_task(dp.process_update(callback_update(4, 11, "a")))
+        await asyncio.sleep(0)
+        assert calls == ["a", "b", "a"]
+        assert dedup.collapsed == 1
+        assert [m for m, _ in sent] == ["answerCallbackQuery"]
+        release.set()
+        await asyncio.gather(first, button, other)
+        # the button is free again
+        await dp.process_update(callback_update(5, 10, "a"))
+        assert calls == ["a", "b", "a", "a"]
+
+    asyncio.run(run())
+
+
+def test_edit_if_changed():
+    sent: list = []
+
+    async def run():
+        bot = make_bot(sent)
+        Bot.set_current(bot)
+        message = types.Message(
+            message_id=10, date=0, chat={"id": 1, "type": "private"}
+        )
+        assert await edit_if_changed(message, "text", parse_mode="markdown")
+        assert not await edit_if_changed(message, "text", parse_mode="markdown")
+        assert await edit_if_changed(message, "new text", parse_mode="markdown")
+        assert len(sent) == 2
+
+        # the message may have this content already, e.g. after restart
+        Bot.set_current(make_bot(sent, not_modified=True))
+        other = types.Message(message_id=11, date=0, chat={"id": 1, "type": "private"})
+        assert not await edit_if_changed(other, "text")
+
+    asyncio.run(run())
+
+
+def test_last_renders_size():
+    renders = LastRenders(maxsize=2)
+    assert renders.update((1, 1), "a")
+    assert renders.update((1, 2), "a")
+    assert not renders.update((1, 1), "a")
+    assert renders.update((1, 3), "a")
+    # (1, 2) is the least recently used
+    assert renders.update((1, 2), "a")
+    assert not renders.update((1, 3), "a")
+
+
+def message_update(update_id: int, user_id: int, text: str) -> types.Update:
+    return types.Update(
+        update_id=update_id,
+        message={
+            "message_id": update_id,
+            "date": 0,
+            "from": {"id": user_id, "is_bot": False, "first_name": "A"},
+            "chat": {"id": user_id, "type": "private"},
+            "text": text,
+        },
+    )
+
+
+def test_admission_control():
+    sent: list = []
+    handled = []
+
+    async def run():
+        bot = make_bot(sent)
+        dp = Dispatcher(bot)
+        Bot.set_current(bot)
+        admission = AdmissionControl(
+            limits={
+                "search": ClassLimits(1, 1, 0.2, degrade=True),
+                "command": ClassLimits(1, 1, 0.2),
+            },
+            max_per_user=1,
+        )
+        dp.middleware.setup(admission)
+        release = asyncio.Event()
+
+        @dp.message_handler()
+        async def handler(message: types.Message, overloaded: bool = False):
+            handled.append((message.text, overloaded))
+            if not overloaded:
+                await release.wait()
+
+        def replies():
+            return [d["text"] for m, d in sent if m == "sendMessage"]
+
+        # running and queued
+        a = asyncio.create_task(dp.process_update(message_update(1, 1, "/a")))
+        b = asyncio.create_task(dp.process_update(message_update(2, 2, "/b")))
+        await asyncio.sleep(0.01)
+        assert admission.stats()["command"]["running"] == 1
+        assert admission.stats()["command"]["waiting"] == 1
+        # the queue is full
+        await dp.process_update(message_update(3, 3, "/c"))
+        # the user already has a request in progress
+        await dp.process_update(message_update(4, 1, "невский"))
+        assert replies() == [TRY_AGAIN, TRY_AGAIN]
+        assert handled == [("/a", False)]
+
+        # searches are degraded instead of shedding
+        s1 = asyncio.create_task(dp.process_update(message_update(5, 5, "невский")))
+        s2 = asyncio.create_task(dp.process_update(message_update(6, 6, "невский")))
+        await asyncio.sleep(0.01)
+        await dp.process_update(message_update(7, 7, "невский"))
+        assert ("невский", True) in handled
+
+        release.set()
+        await asyncio.gather(a, b, s1, s2)
+        assert ("/b", False) in handled
+        stats = admission.stats()
+        assert stats["command"] == dict(
+            running=0, waiting=0, admitted=2, queued=1, shed=1, degraded=0
+        )
+        assert stats["search"] == dict(
+            running=0, waiting=0, admitted=2, queued=1, shed=1, degraded=1
+        )
+
+    asyncio.run(run())
+
+
+def test_admission_queue_timeout():
+    sent: list = []
+
+    async def run():
+        bot = make_bot(sent)
+        dp = Dispatcher(bot)
+        Bot.set_current(bot)
+        admission = AdmissionControl(limits={"command": ClassLimits(1, 5, 0.05)})
+        dp.middleware.setup(admission)
+        release = asyncio.Event()
+
+        @dp.message_handler()
+        async def handler(message: types.Message):
+            await release.wait()
+
+        a = asyncio.create_task(dp.process_update(message_update(1, 1, "/a")))
+        await asyncio.sleep(0.01)
+        # waited too long
+        await dp.process_update(message_update(2, 2, "/b"))
+        assert [d["text"] for m, d in sent] == [TRY_AGAIN]
+        release.set()
+        await a
+        assert admission.stats()["command"]["running"] == 0
+        assert admission.stats()["command"]["shed"] == 1
+
+    asyncio.run(run())
+
+
+def test_admission_cancelled_while_queued():
+    sent: list = []
+
+    async def run():
+        bot = make_bot(sent)
+        dp = Dispatcher(bot)
+        Bot.set_current(bot)
+        admission = AdmissionControl(
+            limits={"command": ClassLimits(1, 5, 10)}, max_per_user=1
+        )
+        dp.middleware.setup(admission)
+        release = asyncio.Event()
+        handled = []
+
+        @dp.message_handler()
+        async def handler(message: types.Message):
+            handled.append(message.text)
+            await release.wait()
+
+        a = asyncio.create_task(dp.process_update(message_update(1, 1, "/a")))
+        await asyncio.sleep(0.01)
+        b = asyncio.create_task(dp.process_update(message_update(2, 2, "/b")))
+        await asyncio.sleep(0.01)
+        b.cancel()
+        await asyncio.sleep(0.01)
+        release.set()
+        await a
+        # the user of the cancelled update may send another one
+        await dp.process_update(message_update(3, 2, "/c"))
+        assert handled == ["/a", "/c"]
+        assert sent == []
+
+    asyncio.run(run())
+
+
+def test_readiness():
+    sent: list = []
+    handled = []
+    ready = [False]
+
+    async def run():
+        bot = make_bot(sent)
+        dp = Dispatcher(bot)
+        Bot.set_current(bot)
+        readiness = ReadinessMiddleware(lambda: ready[0], commands=["start"])
+        dp.middleware.setup(readiness)
+
+        @dp.message_handler()
+        async def handler(message: types.Message):
+            handled.append(message.text)
+
+        @dp.callback_query_handler()
+        async def cb_handler(callback: types.CallbackQuery):
+            handled.append(callback.data)
+
+        await dp.process_update(message_update(1, 1, "/start"))
+        await dp.process_update(message_update(2, 1, "невский"))
+        await dp.process_update(callback_update(3, 10, "a"))
+        assert handled == ["/start"]
+        assert [d["text"] for m, d in sent] == [NOT_READY, NOT_READY]
+        ready[0] = True
+        await dp.process_update(message_update(4, 1, "невский"))
+        await dp.process_update(callback_update(5, 10, "a"))
+        assert handled == ["/start", "невский", "a"]
+        assert readiness.rejected == 2
+
+    asyncio.run(run())
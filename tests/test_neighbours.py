@@ -0,0 +1,42 @@
+import numpy as np
+
+from neighbours import NeighbourGraph, project
+
+
+def brute_force(lat, lon, radius):
+    xy = project(lat, lon, float((lat.max() + lat.min()) / 2))
+    ret = []
+    for i in range(len(lat)):
+        d = np.hypot(*(xy - xy[i]).T)
+        nb = np.flatnonzero(d <= radius)
+        ret.append(sorted((d[j], j) for j in nb if j != i))
+    return ret
+
+
+def test_neighbour_graph():
+    rng = np.random.default_rng(1)
+    n = 2000
+    lat = 59.9 + rng.random(n) * 0.1
+    lon = 30.3 + rng.random(n) * 0.2
+    stop_ids = np.arange(n) * 7 + 3
+    g = NeighbourGraph(stop_ids, lat, lon, radius=300)
+    expected = brute_force(lat, lon, 300)
+    assert len(g.ptr) == n + 1
+    for i in range(n):
+        s = slice(g.ptr[i], g.ptr[i + 1])
+        assert g.idx[s].tolist() == [j for _, j in expected[i]]
+        assert np.allclose(g.dist[s], [d for d, _ in expected[i]], atol=0.01)
+        assert g.degree(i) == len(expected[i])
+    i = int(np.argmax(np.diff(g.ptr)))
+    nb = g.neighbours(int(stop_ids[i]))
+    assert [s for s, _ in nb] == [int(stop_ids[j]) for _, j in expected[i]]
+    assert [d for _, d in nb] == sorted(d for _, d in nb)
+
+
+def test_neighbour_graph_edge_cases():
+    g = NeighbourGraph(np.array([1, 2, 3]), [59.9, 59.9, 60.0], [30.3, 30.3, 30.3], 50)
+    # the same place
+    assert g.neighbours(1) == [(2, 0.0)]
+    assert g.neighbours(3) == []
+    g = NeighbourGraph(np.array([], dtype=int), [], [], 300)
+    assert g.ptr.tolist() == [0]
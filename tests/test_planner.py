@@ -0,0 +1,128 @@
+import pandas as pd
+
+from planner import Planner, best_journeys
+
+
+def make_planner():
+    # Line 1: A - B - C, line 2: D - E, C and D are 100 m apart,
+    # line 3 goes A - E directly, but slowly
+    stops = pd.DataFrame(
+        {
+            "stop_id": [1, 2, 3, 4, 5],
+            "stop_lat": [59.90, 59.91, 59.92, 59.9209, 59.93],
+            "stop_lon": [30.30, 30.30, 30.30, 30.30, 30.30],
+        }
+    )
+    trips = pd.DataFrame(
+        {
+            "trip_id": [10, 11, 20, 30],
+            "route_id": [100, 100, 200, 300],
+            "direction_id": [0, 0, 0, 1],
+            "service_id": ["all", "weekend", "all", "all"],
+        }
+    )
+
+    def hms(minutes):
+        return f"{minutes // 60:02}:{minutes % 60:02}:00"
+
+    rows = [
+        (10, 1, 1, 8 * 60),
+        (10, 2, 2, 8 * 60 + 5),
+        (10, 3, 3, 8 * 60 + 10),
+        (11, 1, 1, 7 * 60 + 50),
+        (11, 2, 2, 7 * 60 + 55),
+        (11, 3, 3, 8 * 60),
+        (20, 4, 1, 8 * 60 + 15),
+        (20, 5, 2, 8 * 60 + 20),
+        (30, 1, 1, 8 * 60 + 1),
+        (30, 5, 2, 9 * 60),
+    ]
+    stop_times = pd.DataFrame(
+        {
+            "trip_id": [r[0] for r in rows],
+            "stop_id": [r[1] for r in rows],
+            "stop_sequence": [r[2] for r in rows],
+            "arrival_time": [hms(r[3]) for r in rows],
+            "departure_time": [hms(r[3]) for r in rows],
+        }
+    )
+    return Planner(stops, trips, stop_times)
+
+
+def test_plan_with_walking_transfer():
+    p = make_planner()
+    journeys = p.plan({1: 0}, {5: 0}, 7 * 3600 + 58 * 60, services=["all"])
+    # direct but slow, then faster with one transfer
+    assert [j.transfers for j in journeys] == [0, 1]
+    direct, fast = journeys
+    assert direct.legs[0].route_id == 300
+    assert direct.arrival == 9 * 3600
+    assert [leg.kind for leg in fast.legs] == ["ride", "walk", "ride"]
+    assert [leg.route_id for leg in fast.legs if leg.kind == "ride"] == [100, 200]
+    assert fast.legs[1].from_stop == 3 and fast.legs[1].to_stop == 4
+    assert fast.arrival == 8 * 3600 + 20 * 60
+
+
+def test_plan_respects_services_and_departure():
+    p = make_planner()
+    journeys = p.plan({1: 0}, {3: 0}, 7 * 3600 + 45 * 60, services=["weekend"])
+    assert len(journeys) == 1
+    assert journeys[0].arrival == 8 * 3600
+    journeys = p.plan({1: 0}, {3: 0}, 7 * 3600 + 45 * 60, services=["all"])
+    assert journeys[0].arrival == 8 * 3600 + 10 * 60
+    assert p.plan({1: 0}, {3: 0}, 9 * 3600) == []
+
+
+def test_stops_near():
+    p = make_planner()
+    near = p.stops_near(59.92, 30.30)
+    assert set(near) == {3, 4}
+    assert near[3] == 0
+
+
+def test_plan_walk_only():
+    p = make_planner()
+    journeys = p.plan({3: 0}, {4: 0}, 7 * 3600 + 58 * 60)
+    assert len(journeys) == 1
+    assert [leg.kind for leg in journeys[0].legs] == ["walk"]
+    assert journeys[0].legs[0].from_stop == 3 and journeys[0].legs[0].to_stop == 4
+    assert journeys[0].transfers == 0
+    assert p.plan({3: 0}, {3: 0}, 7 * 3600) == []
+
+
+def test_plan_night_trips():
+    stops = pd.DataFrame(
+        {"stop_id": [1, 2], "stop_lat": [59.90, 59.95], "stop_lon": [30.30, 30.30]}
+    )
+    trips = pd.DataFrame(
+        {"trip_id": [1], "route_id": [100], "direction_id": [0], "service_id": ["n"]}
+    )
+    stop_times = pd.DataFrame(
+        {
+            "trip_id": [1, 1],
+            "stop_id": [1, 2],
+            "stop_sequence": [1, 2],
+            "arrival_time": ["24:05:00", "24:20:00"],
+            "departure_time": ["24:05:00", "24:20:00"],
+        }
+    )
+    p = Planner(stops, trips, stop_times)
+    assert p.last_departure == 24 * 3600 + 20 * 60
+    # the trip belongs to the previous service day
+    journeys = p.plan({1: 0}, {2: 0}, 24 * 3600 + 2 * 60, services=["n"])
+    assert journeys[0].legs[0].departure == 24 * 3600 + 5 * 60
+    night = journeys[0].shifted(-24 * 3600)
+    assert (night.departure, night.arrival) == (5 * 60, 20 * 60)
+    today = p.plan({1: 0}, {2: 0}, 2 * 60, services=[])
+    assert today == []
+    assert best_journeys(today + [night]) == [night]
+
+
+def test_best_journeys():
+    p = make_planner()
+    journeys = p.plan({1: 0}, {5: 0}, 7 * 3600 + 58 * 60, services=["all"])
+    direct, fast = journeys
+    later = direct.shifted(60)
+    assert later.arrival == direct.arrival + 60
+    assert best_journeys([fast, later, direct]) == journeys
+    assert best_journeys([fast.shifted(3600), direct]) == [direct]
@@ -0,0 +1,75 @@
+import zlib
+import struct
+
+import numpy as np
+
+from route_map import (
+    encode_png,
+    render_route_map,
+    RouteMapCache,
+    LINE,
+    FIRST_STOP,
+    LAST_STOP,
+)
+
+
+def decode_png(png: bytes) -> np.ndarray:
+    assert png[:8] == b"\x89PNG\r\n\x1a\n"
+    pos = 8
+    idat = b""
+    while pos < len(png):
+        (length,) = struct.unpack(">I", png[pos : pos + 4])
+        kind = png[pos + 4 : pos + 8]
+        data = png[pos + 8 : pos + 8 + length]
+        (crc,) = struct.unpack(">I", png[pos + 8 + length : pos + 12 + length])
+        assert crc == zlib.crc32(kind + data) & 0xFFFFFFFF
+        if kind == b"IHDR":
+            w, h = struct.unpack(">II", data[:8])
+        elif kind == b"IDAT":
+            idat += data
+        pos += 12 + length
+    raw = np.frombuffer(zlib.decompress(idat), np.uint8).reshape(h, w * 3 + 1)
+    assert (raw[:, 0] == 0).all()
+    return raw[:, 1:].reshape(h, w, 3)
+
+
+def test_encode_png():
+    img = np.random.default_rng(0).integers(0, 256, (7, 5, 3), dtype=np.uint8)
+    assert (decode_png(encode_png(img)) == img).all()
+
+
+def test_render_route_map():
+    stops = [(59.93, 30.30), (59.94, 30.33), (59.95, 30.36)]
+    img = decode_png(render_route_map(stops, stops, [(59.935, 30.35)], size=200))
+    assert img.shape == (200, 200, 3)
+    colors = {tuple(i) for i in img.reshape(-1, 3)}
+    assert {LINE, FIRST_STOP, LAST_STOP} <= colors
+    # the first stop is south-west: bottom left corner
+    ys, xs = np.nonzero((img == FIRST_STOP).all(axis=2))
+    assert xs.mean() < 100 and ys.mean() > 100
+    # one stop route is drawn too
+    assert decode_png(render_route_map(stops[:1], stops[:1], size=50)).shape[0] == 50
+
+
+def test_route_map_cache(tmp_path):
+    rendered = []
+
+    def render():
+        rendered.append(1)
+        return b"png"
+
+    cache = RouteMapCache(str(tmp_path), "v1")
+    path = cache.get_or_render(1347, 0, render)
+    assert cache.get_or_render(1347, 0, render) == path
+    assert len(rendered) == 1
+    assert cache.get_file_id(1347, 0) is None
+    cache.set_file_id(1347, 0, "AgACAgI")
+
+    cache = RouteMapCache(str(tmp_path), "v1")
+    assert cache.get_file_id(1347, 0) == "AgACAgI"
+    assert cache.get_file_id(1347, 1) is None
+    # new feed version: everything is drawn again
+    cache = RouteMapCache(str(tmp_path), "v2")
+    assert cache.get_file_id(1347, 0) is None
+    cache.get_or_render(1347, 0, render)
+    assert len(rendered) == 2
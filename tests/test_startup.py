@@ -0,0 +1,73 @@
+import os
+import sys
+import json
+import subprocess
+
+# a restarted bot should answer /start within a second
+STARTUP_BUDGET = 1.0  # seconds
+
+HEAVY_MODULES = ["pandas", "numpy", "rtree", "fuzzywuzzy", "requests"]
+
+SCRIPT = """
+import sys, time, json, asyncio
+t = time.perf_counter()
+import bot_aiogram
+from aiogram import Bot, types
+imported = time.perf_counter() - t
+
+sent = []
+
+
+async def request(method, data=None, *args, **kwargs):
+    sent.append([method, (data or {}).get("text", "")])
+    return {"message_id": 2, "date": 0, "chat": {"id": 1, "type": "private"}}
+
+
+def update(n, text):
+    return types.Update(
+        update_id=n,
+        message={
+            "message_id": n,
+            "date": 0,
+            "from": {"id": n, "is_bot": False, "first_name": "A"},
+            "chat": {"id": n, "type": "private"},
+            "text": text,
+        },
+    )
+
+
+async def main():
+    # a search needs the feed, it must not hold up /start
+    await asyncio.gather(
+        bot_aiogram.dp.process_update(update(1, "невский")),
+        bot_aiogram.dp.process_update(update(2, "/start")),
+    )
+
+
+bot_aiogram.bot.request = request
+Bot.set_current(bot_aiogram.bot)
+asyncio.run(main())
+answered = time.perf_counter() - t
+heavy = [i for i in %r if i in sys.modules]
+print(json.dumps({"import": imported, "start": answered, "heavy": heavy, "sent": sent}))
+"""
+
+
+def test_startup_time():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run(
+        [sys.executable, "-c", SCRIPT % HEAVY_MODULES],
+        cwd=root,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    res = json.loads(out.splitlines()[-1])
+    print(f"import: {res['import']:.3f} s, /start answered: {res['start']:.3f} s")
+    # the feed and heavy dependencies are loaded on demand
+    assert res["heavy"] == []
+    assert [m for m, _ in res["sent"]] == ["sendMessage", "sendMessage"]
+    # the search is asked to wait until the feed is loaded
+    assert "загружается" in res["sent"][0][1]
+    assert res["sent"][1][1].startswith("Привет")
+    assert res["start"] < STARTUP_BUDGET